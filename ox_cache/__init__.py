@@ -5,7 +5,20 @@ system. See docs on the following for details:
 
   - OxCacheBase:        Base class all caches inherit from.
   - TimedExpiryMixin:   Mix-in for time-based expiration of cache elements.
+  - AdaptiveTTLMixin:   Mix-in to adapt per-key expiration to change rate.
   - RefreshDictMixin:   Mix-in to refresh full cache from a dict.
+  - RefreshAheadMixin:  Mix-in to refresh popular keys before they expire.
+  - NegativeCachingMixin: Mix-in to cache errors and not found results.
+  - ThreadLocalL0Mixin: Mix-in serving repeated hits from per-thread L0.
+  - GenerationalMixin:  Mix-in to invalidate cache or namespace in O(1).
+  - LazySequenceMixin:  Mix-in to cache iterators as shareable sequences.
+  - LRUReplacementMixin: Mix-in to evict least recently used elements.
+  - SampledLRUMixin:    Mix-in for approximate LRU by sampling.
+  - RandomReplacementMixin: Mix-in to evict random elements.
+  - CostAwareReplacementMixin: Mix-in to evict cheap to recompute (GDSF).
+  - NamespaceIndexMixin: Mix-in to reset/clean/count single namespaces.
+  - TagIndexMixin:      Mix-in to invalidate entries by tag or dependency.
+  - SortedKeyIndexMixin: Mix-in for prefix/range queries over base keys.
 
 The following illustrates how you can use these classes to create a
 simple cache which refreshes itself either when a set amount of time
@@ -80,17 +93,28 @@ import logging
 from ox_cache.core import (
     OxCacheBase, OxCacheFullKey, OxCacheItem)
 from ox_cache.mixins import (
-    RefreshDictMixin, TimedExpiryMixin, LRUReplacementMixin)
+    RefreshDictMixin, TimedExpiryMixin, AdaptiveTTLMixin,
+    RefreshAheadMixin, NegativeCachingMixin, NOT_FOUND, ThreadLocalL0Mixin,
+    GenerationalMixin, LazySequenceMixin,
+    LRUReplacementMixin, SampledLRUMixin, RandomReplacementMixin,
+    CostAwareReplacementMixin, NamespaceIndexMixin, TagIndexMixin,
+    SortedKeyIndexMixin)
 from ox_cache.memoizers import (
-    OxMemoizer, TimedMemoizer, LRUReplacementMemoizer)
+    OxMemoizer, TimedMemoizer, LRUReplacementMemoizer, LazySequenceMemoizer)
 
-VERSION = '1.3.2'
+VERSION = '2.0.0'
 
 if __name__ == '__main__':
     logging.info(
         'Imported various ox_cache classes:\n%s', '\n'.join([
             str(m) for m in [
                 OxCacheBase, OxCacheFullKey, OxCacheItem,
-                RefreshDictMixin, TimedExpiryMixin, LRUReplacementMixin,
-                OxMemoizer, TimedMemoizer, LRUReplacementMemoizer]
+                RefreshDictMixin, TimedExpiryMixin, AdaptiveTTLMixin,
+                RefreshAheadMixin, NegativeCachingMixin, ThreadLocalL0Mixin,
+                GenerationalMixin, LazySequenceMixin,
+                LRUReplacementMixin, SampledLRUMixin, RandomReplacementMixin,
+                CostAwareReplacementMixin, NamespaceIndexMixin,
+                TagIndexMixin, SortedKeyIndexMixin,
+                OxMemoizer, TimedMemoizer,
+                LRUReplacementMemoizer, LazySequenceMemoizer]
             ] + ['Nothing gets done when running this module as main.']))
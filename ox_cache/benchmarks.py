@@ -0,0 +1,557 @@
+"""Benchmark suite for ox_cache.
+
+This module provides a reproducible set of micro-benchmarks and
+simulations so that performance regressions in things like `get`,
+`make_key` or the mixin hooks can be caught. Results are written as
+JSON so two runs can be compared. From the command line do something
+like
+
+    python -m ox_cache.benchmarks run --output before.json
+    ... make changes ...
+    python -m ox_cache.benchmarks run --output after.json
+    python -m ox_cache.benchmarks compare before.json after.json
+
+The `compare` command exits with a non-zero status if any benchmark got
+worse by more than the threshold (10% by default) or is missing from the
+new results. Use `run --quick` for a fast smoke run with smaller sizes
+(e.g., skipping `clean` on 1M entries).
+
+Each benchmark is a function registered with the `benchmark` decorator
+which returns a dict mapping result names to Measurement instances. You
+can run a subset by name:
+
+>>> from ox_cache import benchmarks
+>>> results = benchmarks.run_benchmarks(['make_key'], quick=True)
+>>> sorted(results['results'])[:2]
+['make_key.opts_0', 'make_key.opts_1']
+>>> results['results']['make_key.opts_0']['unit']
+'sec/op'
+
+Comparing two sets of results reports anything which got worse:
+
+>>> old = {'results': {'get.hit': {'value': 1.0, 'unit': 'sec/op',
+...                                'better': 'lower'}}}
+>>> new = {'results': {'get.hit': {'value': 1.5, 'unit': 'sec/op',
+...                                'better': 'lower'}}}
+>>> benchmarks.compare_results(old, new)
+[('get.hit', 1.0, 1.5, 0.5)]
+>>> benchmarks.compare_results(old, old)
+[]
+
+Benchmarks in the old results which are missing from the new ones are
+reported with None for the new value and change:
+
+>>> benchmarks.compare_results(old, {'results': {}})
+[('get.hit', 1.0, None, None)]
+"""
+
+import argparse
+import bisect
+import collections
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from ox_cache import trace
+from ox_cache.core import OxCacheBase
+from ox_cache.locks import ReadWriteLock
+from ox_cache.mixins import (
+    LRUReplacementMixin, RandomReplacementMixin, SampledLRUMixin,
+    CostAwareReplacementMixin, TimedExpiryMixin)
+from ox_cache.memoizers import (
+    OxMemoizer, TimedMemoizer, LRUReplacementMemoizer)
+
+
+Measurement = collections.namedtuple('Measurement', [
+    'value', 'unit', 'better'])
+Measurement.__doc__ = '''Result of a single benchmark measurement.
+
+  - value:   Measured value.
+  - unit:    String describing the unit (e.g., 'sec/op', 'ops/sec').
+  - better:  Either 'lower' or 'higher' to indicate which way is better.
+'''
+
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name):
+    """Decorator to register a benchmark function under the given name.
+
+    The function will be called as func(quick=quick) and must return a
+    dict mapping sub-names to Measurement instances.
+    """
+    def decorator(func):
+        "Register func in BENCHMARKS."
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+def time_per_call(func, args_list, repeat=3):
+    """Return best time in seconds per call of func over args_list.
+
+    :param func:       Callable to time.
+
+    :param args_list:  List of single arguments to call func with.
+
+    :param repeat=3:   How many times to repeat the loop; we keep the best.
+    """
+    best = None
+    for dummy in range(repeat):
+        start = time.perf_counter()
+        for arg in args_list:
+            func(arg)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / max(1, len(args_list))
+
+
+def _square(x):
+    "Simple function to memoize in benchmarks."
+    return x * x
+
+
+class _IdentityCache(OxCacheBase):
+    "Cache whose value is just the key."
+
+    def make_value(self, key, **opts):
+        return key
+
+
+class _TimedIdentityCache(TimedExpiryMixin, _IdentityCache):
+    "Timed cache whose value is just the key."
+
+
+def _cache_factories():
+    "Return dict of name: (factory, accessor) for caches to benchmark."
+    return collections.OrderedDict([
+        ('OxCacheBase', (_IdentityCache, lambda cache: cache.get)),
+        ('OxMemoizer', (lambda: OxMemoizer(_square), lambda memo: memo)),
+        ('TimedMemoizer', (lambda: TimedMemoizer(_square),
+                           lambda memo: memo)),
+        ('LRUReplacementMemoizer', (
+            lambda: LRUReplacementMemoizer(_square, max_size=1024),
+            lambda memo: memo)),
+    ])
+
+
+@benchmark('get')
+def bench_get(quick=False):
+    "Hit and miss latency for the main cache and memoizer classes."
+    number = 2000 if quick else 50000
+    result = {}
+    for name, (factory, accessor) in _cache_factories().items():
+        cache = factory()
+        func = accessor(cache)
+        hot_keys = list(range(100))
+        for key in hot_keys:
+            func(key)
+        hits = [hot_keys[i % len(hot_keys)] for i in range(number)]
+        result[name + '.hit'] = Measurement(
+            time_per_call(func, hits), 'sec/op', 'lower')
+        cache = factory()
+        func = accessor(cache)
+        misses = iter(itertools.count(1000))
+        result[name + '.miss'] = Measurement(time_per_call(
+            lambda dummy: func(next(misses)), range(number // 4)),
+                                             'sec/op', 'lower')
+    return result
+
+
+@benchmark('make_key')
+def bench_make_key(quick=False):
+    "Cost of OxCacheBase.make_key as a function of the number of opts."
+    number = 2000 if quick else 50000
+    cache = _IdentityCache()
+    result = {}
+    for num_opts in [0, 1, 4, 16]:
+        opts = {'opt_%02i' % i: i for i in range(num_opts)}
+        result['opts_%i' % num_opts] = Measurement(time_per_call(
+            lambda key: cache.make_key(key, **opts), range(number)),
+                                                   'sec/op', 'lower')
+    return result
+
+
+@benchmark('clean')
+def bench_clean(quick=False):
+    "Time for clean() on caches of various sizes with half expired."
+    result = {}
+    for size in ([10000] if quick else [10000, 1000000]):
+        cache = _TimedIdentityCache(expiry_seconds=3600)
+        old_ttl = cache.create_ttl(None) - 7200
+        for key in range(size):
+            cache.store(key, key, ttl_info=(old_ttl if key % 2 else None))
+        start = time.perf_counter()
+        removed = cache.clean()
+        elapsed = time.perf_counter() - start
+        assert len(removed) == size // 2
+        result['size_%i' % size] = Measurement(elapsed, 'sec', 'lower')
+    return result
+
+
+def _add(x, y):
+    "Simple two argument function to memoize in benchmarks."
+    return x + y
+
+
+@benchmark('memory')
+def bench_memory(quick=False):
+    "Bytes per entry (keys, records and storage) for memoizers."
+    size = 10000 if quick else 100000
+    result = {}
+    for name, factory in [('OxMemoizer', OxMemoizer),
+                          ('TimedMemoizer', TimedMemoizer)]:
+        memo = factory(_add)
+        args = list(range(size))  # create ints before we start tracing
+        tracemalloc.start()
+        for arg in args:
+            memo(arg, 1)
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        result[name + '.per_entry'] = Measurement(
+            used / float(size), 'bytes', 'lower')
+    return result
+
+
+def _thread_throughput(memo, num_threads, ops_per_thread):
+    "Return hits per second over num_threads each doing ops_per_thread."
+    keys = list(range(100))
+    for key in keys:
+        memo(key)
+
+    def worker():
+        "Do hits in a thread."
+        for i in range(ops_per_thread):
+            memo(keys[i % 100])
+
+    threads = [threading.Thread(target=worker) for dummy in range(
+        num_threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return num_threads * ops_per_thread / (time.perf_counter() - start)
+
+
+@benchmark('threads')
+def bench_threads(quick=False):
+    "Multi-threaded hit throughput with exclusive and read-write locks."
+    ops = 2000 if quick else 20000
+    result = {}
+    for num_threads in [1, 4, 8]:
+        result['exclusive.%i' % num_threads] = Measurement(
+            _thread_throughput(OxMemoizer(_square), num_threads, ops),
+            'ops/sec', 'higher')
+        result['read_write.%i' % num_threads] = Measurement(
+            _thread_throughput(OxMemoizer(_square, lock=ReadWriteLock()),
+                               num_threads, ops), 'ops/sec', 'higher')
+    return result
+
+
+def zipf_trace(num_keys, length, alpha=1.0, seed=1):
+    """Return list of keys drawn from a Zipf distribution.
+
+    :param num_keys:   Number of distinct keys (0 to num_keys-1).
+
+    :param length:     Length of trace to generate.
+
+    :param alpha=1.0:  Skew parameter; key k has weight 1/(k+1)**alpha.
+
+    :param seed=1:     Random seed so traces are reproducible.
+
+>>> from ox_cache.benchmarks import zipf_trace
+>>> trace = zipf_trace(100, 1000)
+>>> len(trace), trace == zipf_trace(100, 1000)
+(1000, True)
+>>> trace.count(0) > trace.count(99)
+True
+    """
+    rand = random.Random(seed)
+    cum_weights = list(itertools.accumulate(
+        1.0 / (k + 1) ** alpha for k in range(num_keys)))
+    total = cum_weights[-1]
+    return [bisect.bisect_left(cum_weights, rand.random() * total)
+            for dummy in range(length)]
+
+
+def scan_trace(num_keys, length, hot_keys=100, seed=1):
+    """Return trace mixing a hot working set with long sequential scans.
+
+    :param num_keys:     Number of distinct keys scanned over.
+
+    :param length:       Length of trace to generate.
+
+    :param hot_keys=100: Size of hot set accessed between scan steps.
+
+    :param seed=1:       Random seed so traces are reproducible.
+    """
+    rand = random.Random(seed)
+    scan = itertools.cycle(range(hot_keys, hot_keys + num_keys))
+    return [next(scan) if rand.random() < 0.5 else rand.randrange(hot_keys)
+            for dummy in range(length)]
+
+
+def hit_ratio(cache_class, trace, max_size):
+    """Replay trace through a cache of cache_class and return hit ratio.
+
+    :param cache_class:  Sub-class of OxCacheBase taking max_size in init.
+
+    :param trace:        Sequence of keys to get.
+
+    :param max_size:     Size of cache.
+    """
+    misses = [0]
+
+    class Counter(cache_class):
+        "Cache which counts calls to make_value."
+
+        def make_value(self, key, **opts):
+            misses[0] += 1
+            return key
+
+    cache = Counter(max_size=max_size)
+    for key in trace:
+        cache.get(key)
+    return 1.0 - misses[0] / float(len(trace))
+
+
+def replacement_policies():
+    "Return dict of name: cache class for replacement policies to compare."
+    return collections.OrderedDict([
+        ('lru', type('LRUCache', (LRUReplacementMixin, OxCacheBase), {})),
+        ('sampled_lru', type('SampledLRUCache', (
+            SampledLRUMixin, OxCacheBase), {})),
+        ('random', type('RandomCache', (
+            RandomReplacementMixin, OxCacheBase), {})),
+        ('gdsf', type('CostAwareCache', (
+            CostAwareReplacementMixin, OxCacheBase), {})),
+    ])
+
+
+@benchmark('hit_ratio')
+def bench_hit_ratio(quick=False):
+    "Hit ratio for replacement policies on synthetic Zipf and scan traces."
+    length = 5000 if quick else 100000
+    traces = {'zipf': zipf_trace(10000, length),
+              'scan': scan_trace(10000, length)}
+    result = {}
+    for policy, cache_class in replacement_policies().items():
+        for trace_name, trace in sorted(traces.items()):
+            result['%s.%s' % (policy, trace_name)] = Measurement(
+                hit_ratio(cache_class, trace, 1000), 'ratio', 'higher')
+    return result
+
+
+def key_costs(num_keys, sigma=2.0, seed=1):
+    """Return list of simulated seconds to compute each key.
+
+    :param num_keys:    Number of keys.
+
+    :param sigma=2.0:   Spread of the log-normal distribution (so a few
+                        keys are orders of magnitude slower than most).
+
+    :param seed=1:      Random seed so costs are reproducible.
+    """
+    rand = random.Random(seed)
+    return [rand.lognormvariate(-6.0, sigma) for dummy in range(num_keys)]
+
+
+def recompute_cost(cache_class, trace, costs, max_size):
+    """Replay trace and return total simulated seconds spent recomputing.
+
+    :param cache_class:  Sub-class of OxCacheBase taking max_size in init.
+
+    :param trace:        Sequence of integer keys to get.
+
+    :param costs:        Sequence where costs[key] is the time to compute
+                         key (as from key_costs).
+
+    :param max_size:     Size of cache.
+
+    Cost-aware policies are told the simulated cost via measured_cost
+    so the replay does not need to actually sleep.
+    """
+    total = [0.0]
+
+    class Charged(cache_class):
+        "Cache which adds up the cost of each call to make_value."
+
+        def make_value(self, key, **opts):
+            total[0] += costs[key]
+            return key
+
+        @staticmethod
+        def measured_cost(full_key, elapsed):
+            "Use simulated cost instead of elapsed time."
+            dummy = elapsed
+            return costs[full_key.base_key]
+
+    cache = Charged(max_size=max_size)
+    for key in trace:
+        cache.get(key)
+    return total[0]
+
+
+@benchmark('recompute_cost')
+def bench_recompute_cost(quick=False):
+    """Seconds of make_value time for policies on a Zipf trace.
+
+    Each key has a log-normal cost so this shows how much recompute time
+    a cost-aware policy saves compared to LRU (reported as `saved.*`).
+    """
+    length = 5000 if quick else 100000
+    trace, costs = zipf_trace(10000, length), key_costs(10000)
+    result = {}
+    for policy, cache_class in replacement_policies().items():
+        result[policy] = Measurement(recompute_cost(
+            cache_class, trace, costs, 1000), 'sec', 'lower')
+    for policy in result.copy():
+        if policy != 'lru':
+            result['saved.' + policy] = Measurement(
+                result['lru'].value - result[policy].value, 'sec', 'higher')
+    return result
+
+
+@benchmark('trace_replay')
+def bench_trace_replay(quick=False):
+    """Events per second replayed by trace.simulate on a Zipf trace.
+
+    Reports the lean replay used for 'lru' and the full replay through
+    a cache `get` per event (used for other policies).
+    """
+    length = 20000 if quick else 1000000
+    handle, path = tempfile.mkstemp(suffix='.trace')
+    os.close(handle)
+    try:
+        with trace.TraceWriter(path) as writer:
+            for key in zipf_trace(100000, length):
+                writer.record(trace.OP_GET, key, timestamp=0.0)
+        result = {}
+        for name, policy in [('lean.lru', 'lru'),
+                             ('full.lru', LRUReplacementMixin)]:
+            start = time.perf_counter()
+            trace.simulate(path, policy, 10000)
+            result[name] = Measurement(
+                length / (time.perf_counter() - start), 'ops/sec', 'higher')
+    finally:
+        os.remove(path)
+    return result
+
+
+def run_benchmarks(names=None, quick=False):
+    """Run benchmarks and return results as a JSON-able dict.
+
+    :param names=None:   Optional list of benchmark names to run. If None,
+                         run everything in BENCHMARKS.
+
+    :param quick=False:  Whether to use smaller sizes for a fast run.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  Dict with 'meta' describing the environment and 'results'
+              mapping 'benchmark.sub_name' to a dict with the fields of
+              Measurement.
+    """
+    from ox_cache import VERSION
+    names = list(BENCHMARKS) if names is None else names
+    results = {}
+    for name in names:
+        for sub_name, measurement in BENCHMARKS[name](quick=quick).items():
+            results['%s.%s' % (name, sub_name)] = measurement._asdict()
+    meta = {'ox_cache_version': VERSION, 'quick': quick,
+            'python': sys.version.split()[0],
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat()}
+    return {'meta': meta, 'results': results}
+
+
+def compare_results(old, new, threshold=0.1):
+    """Compare two results from run_benchmarks and find regressions.
+
+    :param old:    Results (as from run_benchmarks) for the baseline.
+
+    :param new:    Results (as from run_benchmarks) to check.
+
+    :param threshold=0.1:  Relative change counted as a regression.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  List of (name, old_value, new_value, relative_change) for
+              benchmarks in both inputs which got worse by more than
+              threshold. The relative_change is positive when worse.
+              Benchmarks in old but not in new are included with
+              new_value and relative_change set to None.
+    """
+    regressions = []
+    for name, old_info in sorted(old['results'].items()):
+        new_info = new['results'].get(name)
+        if new_info is None:
+            regressions.append((name, old_info['value'], None, None))
+            continue
+        if not old_info['value']:
+            continue
+        change = (new_info['value'] - old_info['value']) / old_info['value']
+        if old_info['better'] == 'higher':
+            change = -change
+        if change > threshold:
+            regressions.append((name, old_info['value'], new_info['value'],
+                                round(change, 6)))
+    return regressions
+
+
+def main(argv=None):
+    "Command line interface; see module docs."
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help='Run benchmarks.')
+    run_parser.add_argument('--output', help='Path to write JSON results.')
+    run_parser.add_argument('--quick', action='store_true',
+                            help='Use smaller sizes for a fast run.')
+    run_parser.add_argument('names', nargs='*', help=(
+        'Benchmarks to run from %s (default: all).' % ', '.join(BENCHMARKS)))
+    cmp_parser = subparsers.add_parser('compare', help='Compare two runs.')
+    cmp_parser.add_argument('old', help='Path to baseline JSON results.')
+    cmp_parser.add_argument('new', help='Path to new JSON results.')
+    cmp_parser.add_argument('--threshold', type=float, default=0.1,
+                            help='Relative change to flag (default 0.1).')
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        results = run_benchmarks(args.names or None, quick=args.quick)
+        for name, info in sorted(results['results'].items()):
+            print('%-45s %14.6g %s' % (name, info['value'], info['unit']))
+        if args.output:
+            with open(args.output, 'w') as my_fd:
+                json.dump(results, my_fd, indent=2, sort_keys=True)
+        return 0
+    if args.command == 'compare':
+        with open(args.old) as my_fd:
+            old = json.load(my_fd)
+        with open(args.new) as my_fd:
+            new = json.load(my_fd)
+        regressions = compare_results(old, new, args.threshold)
+        for name, old_value, new_value, change in regressions:
+            if new_value is None:
+                print('MISSING    %-40s %12.6g' % (name, old_value))
+                continue
+            print('REGRESSION %-40s %12.6g -> %12.6g (%+.1f%%)' % (
+                name, old_value, new_value, 100 * change))
+        if not regressions:
+            print('No regressions above %.1f%%' % (100 * args.threshold))
+        return 1 if regressions else 0
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,584 @@
+"""Partition a cache across several local server processes.
+
+If the key space is too big for one process, you can run a CacheServer
+for an OxCacheBase in each of several processes (listening on a unix
+socket or a TCP port on the loopback interface) and use a
+ShardedCacheClient which routes each key to one server by consistent
+hashing of a canonical encoding of the key:
+
+  - CacheServer:        Serve get/store/delete/exists/get_many (and ttl,
+                        expired, len, clean and reset) for a cache.
+  - ShardedCacheClient: OxCacheBase sub-class sending those requests to
+                        the server owning each key (or to every server).
+  - HashRing:           Consistent hashing with virtual nodes so adding
+                        or removing a server only moves about 1/n of
+                        the keys.
+
+Requests and responses are frames with a 5 byte header (payload length
+and an op code or status) followed by a pickled payload. Each client
+keeps a pool of persistent connections per server and `get_many` sends
+one request to every server involved before reading any response so the
+servers work in parallel.
+
+>>> import os, tempfile
+>>> from ox_cache import OxCacheBase
+>>> from ox_cache.cluster import CacheServer, ShardedCacheClient
+>>> class Squares(OxCacheBase):
+...     'Cache run by each server.'
+...     def make_value(self, key, **opts):
+...         return key * key
+...
+>>> directory = tempfile.mkdtemp()
+>>> servers = [CacheServer(Squares(), os.path.join(directory, str(i)))
+...            for i in range(3)]
+>>> for server in servers:
+...     server.start()
+...
+>>> client = ShardedCacheClient([server.address for server in servers])
+>>> client.get(7), client.get_many(range(5))
+(49, [0, 1, 4, 9, 16])
+>>> client.store('name', 'value', namespace='test')
+>>> client.get('name', namespace='test'), client.exists('name')
+('value', False)
+>>> client.delete('name', namespace='test')
+>>> client.get('name', namespace='test', allow_refresh=False, default='?')
+'?'
+>>> sorted(len(server.cache) for server in servers)  # keys are spread out
+[1, 2, 3]
+>>> len(client), client.expired(7), client.ttl(7) > 0
+(6, False, True)
+>>> client.close()
+>>> for server in servers:
+...     server.close()
+...
+
+Payloads are pickled so only connect clients and servers which trust
+each other. A CacheServer created without an address listens on a unix
+socket in a new private directory and both CacheServer and
+ShardedCacheClient refuse TCP addresses other than loopback ones.
+"""
+
+import bisect
+import collections
+import doctest
+import hashlib
+import ipaddress
+import os
+import pickle
+import shutil
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+
+from ox_cache.core import OxCacheBase
+
+
+FRAME = struct.Struct('>IB')  # payload length, op code or status
+(OP_GET, OP_STORE, OP_DELETE, OP_GET_MANY, OP_EXISTS, OP_TTL, OP_EXPIRED,
+ OP_LEN, OP_CLEAN, OP_RESET) = range(1, 11)
+STATUS_OK, STATUS_MISS, STATUS_ERROR = range(3)
+_MISSING = object()
+
+
+def send_frame(sock, code, payload):
+    "Send a frame with the given code and pickled payload over sock."
+    data = pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(FRAME.pack(len(data), code) + data)
+
+
+def _recv_exactly(sock, size):
+    "Read exactly size bytes from sock (or raise EOFError)."
+    data = bytearray(size)
+    view = memoryview(data)
+    while view:
+        count = sock.recv_into(view)
+        if not count:
+            raise EOFError('Connection closed')
+        view = view[count:]
+    return data
+
+
+def recv_frame(sock):
+    "Read a frame from sock and return (code, payload)."
+    size, code = FRAME.unpack(_recv_exactly(sock, FRAME.size))
+    return code, pickle.loads(_recv_exactly(sock, size))
+
+
+def _portable_error(problem):
+    "Return problem if a client can unpickle it or else a RuntimeError."
+    try:
+        pickle.loads(pickle.dumps(problem, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:  # pylint: disable=broad-except
+        return RuntimeError(repr(problem))
+    return problem
+
+
+def check_loopback(address):
+    """Raise ValueError unless address is a unix socket or loopback TCP.
+
+    :param address:   Path for a unix socket or (host, port) for TCP.
+
+    Payloads are pickled so we never talk TCP to other hosts.
+    """
+    if isinstance(address, (str, bytes)):
+        return
+    host = address[0]
+    try:
+        loopback = ipaddress.ip_address(
+            socket.gethostbyname(host) if host else '0.0.0.0').is_loopback
+    except (OSError, ValueError):
+        loopback = False
+    if not loopback:
+        raise ValueError('Refusing TCP address %r which is not loopback'
+                         ' (use a unix socket instead)' % (address,))
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    "Handle requests on one connection until the client closes it."
+
+    def handle(self):
+        cache = self.server.cache
+        while True:
+            try:
+                operation, payload = recv_frame(self.request)
+            except (EOFError, ConnectionError):
+                return
+            try:
+                status, result = self.server.dispatch(
+                    cache, operation, payload)
+            except Exception as problem:  # pylint: disable=broad-except
+                status, result = STATUS_ERROR, _portable_error(problem)
+            try:
+                send_frame(self.request, status, result)
+            except ConnectionError:
+                return
+            except Exception as problem:  # pylint: disable=broad-except
+                send_frame(self.request, STATUS_ERROR, RuntimeError(
+                    'Cannot send result: %r' % (problem,)))
+
+
+class _UnixServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    "Threaded unix socket server."
+
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    "Threaded TCP server."
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class CacheServer:
+    """Serve requests from ShardedCacheClient instances for a cache.
+
+    :param cache:     Instance of OxCacheBase to serve.
+
+    :param address=None:  Path for a unix socket or (host, port) for TCP
+                          on a loopback interface (use port 0 to pick a
+                          free port). If None, we use a unix socket in a
+                          new private directory (removed by `close`).
+                          Either way `self.address` has the real address
+                          once created.
+
+    Call `start` to serve from a background thread (or `serve_forever`
+    to serve from the current thread) and `close` to stop.
+    """
+
+    def __init__(self, cache, address=None):
+        self.cache = cache
+        self._directory = None
+        if address is None:
+            self._directory = tempfile.mkdtemp(prefix='ox_cache_server')
+            address = os.path.join(self._directory, 'cache.sock')
+        check_loopback(address)
+        if isinstance(address, (str, bytes)):
+            self.server = _UnixServer(address, _RequestHandler)
+        else:
+            self.server = _TCPServer(tuple(address), _RequestHandler)
+        self.server.cache = cache
+        self.server.dispatch = self.dispatch
+        self.address = self.server.server_address
+        self._thread = None
+
+    @staticmethod
+    def dispatch(cache, operation, payload):
+        """Run operation for payload on cache.
+
+        :return:  Pair (status, result) to send back.
+        """
+        if operation == OP_GET:
+            key, allow_refresh, opts = payload
+            result = cache.get(key, allow_refresh=allow_refresh,
+                               default=_MISSING, **opts)
+            if result is _MISSING:
+                return STATUS_MISS, None
+            return STATUS_OK, result
+        if operation == OP_GET_MANY:
+            keys, allow_refresh, opts = payload
+            results = [cache.get(key, allow_refresh=allow_refresh,
+                                 default=_MISSING, **opts) for key in keys]
+            return STATUS_OK, [(STATUS_MISS, None) if value is _MISSING
+                               else (STATUS_OK, value) for value in results]
+        if operation == OP_STORE:
+            key, value, opts = payload
+            cache.store(key, value, **opts)
+            return STATUS_OK, None
+        if operation == OP_DELETE:
+            key, opts = payload
+            if cache.exists(key, **opts):
+                cache.delete(key, **opts)
+            return STATUS_OK, None
+        if operation == OP_EXISTS:
+            key, opts = payload
+            return STATUS_OK, cache.exists(key, **opts)
+        if operation == OP_TTL:
+            key, opts = payload
+            record = cache.get_record(cache.make_key(key, **opts))
+            return STATUS_OK, (0 if record is None else
+                               cache.ttl_for_record(record))
+        if operation == OP_EXPIRED:
+            key, opts = payload
+            return STATUS_OK, cache.expired(key, **opts)
+        if operation == OP_LEN:
+            return STATUS_OK, len(cache)
+        if operation == OP_CLEAN:
+            return STATUS_OK, cache.clean()
+        if operation == OP_RESET:
+            cache.reset()
+            return STATUS_OK, None
+        raise ValueError('Unknown operation %r' % (operation,))
+
+    def start(self):
+        "Serve requests from a daemon thread."
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True,
+            name='ox_cache-server-%s' % (self.address,))
+        self._thread.start()
+
+    def serve_forever(self):
+        "Serve requests from the current thread until close is called."
+        self.server.serve_forever()
+
+    def close(self):
+        "Stop serving and release the socket."
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+        if isinstance(self.address, str):
+            try:
+                os.unlink(self.address)
+            except FileNotFoundError:
+                pass
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+
+
+def stable_hash(data):
+    "Return 64-bit hash of bytes which is the same in every process."
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(),
+                          'big')
+
+
+def canonical_bytes(value):
+    """Return bytes encoding value which are the same in every process.
+
+    :param value:   None, bool, int, float, str, bytes or a tuple, list,
+                    set or frozenset of those (nested as you like).
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  Bytes to hash for value. Unlike repr or pickle, sets are
+              encoded in sorted order (string hashes differ between
+              processes) and other types raise TypeError instead of
+              possibly encoding something like a memory address.
+
+>>> from ox_cache.cluster import canonical_bytes
+>>> canonical_bytes(('a', 1, None))
+b't9:s1:ai1:1N'
+>>> canonical_bytes({'b', 'a'}) == canonical_bytes(frozenset('ab'))
+True
+>>> canonical_bytes(object())
+Traceback (most recent call last):
+...
+TypeError: Cannot canonically encode object (override server_for)
+    """
+    if value is None:
+        return b'N'
+    if isinstance(value, bool):
+        return b'T' if value else b'F'
+    if isinstance(value, int):
+        tag, data = b'i', b'%d' % value
+    elif isinstance(value, float):
+        tag, data = b'f', float.__repr__(value).encode()
+    elif isinstance(value, str):
+        tag, data = b's', value.encode('utf-8', 'surrogatepass')
+    elif isinstance(value, bytes):
+        tag, data = b'b', value
+    elif isinstance(value, (tuple, list)):
+        tag, data = b't', b''.join(map(canonical_bytes, value))
+    elif isinstance(value, (set, frozenset)):
+        tag, data = b'u', b''.join(sorted(map(canonical_bytes, value)))
+    else:
+        raise TypeError('Cannot canonically encode %s (override server_for)'
+                        % type(value).__name__)
+    return tag + b'%d:' % len(data) + data
+
+
+class HashRing:
+    """Consistent hash ring with virtual nodes.
+
+    :param nodes:        Sequence of hashable node names.
+
+    :param vnodes=160:   Points on the ring per node (more gives a more
+                         even spread).
+
+>>> from ox_cache.cluster import HashRing
+>>> ring = HashRing(['a', 'b', 'c'])
+>>> owners = {key: ring.node_for(str(key).encode()) for key in range(3000)}
+>>> sorted(collections.Counter(owners.values()).values())[0] > 800
+True
+>>> smaller = HashRing(['a', 'b'])  # only keys on 'c' should move
+>>> all(smaller.node_for(str(key).encode()) == node
+...     for key, node in owners.items() if node != 'c')
+True
+    """
+
+    def __init__(self, nodes, vnodes=160):
+        points = sorted(
+            (stable_hash(('%r-%i' % (node, i)).encode()), node)
+            for node in nodes for i in range(vnodes))
+        self._points = [point for point, dummy in points]
+        self._nodes = [node for dummy, node in points]
+
+    def node_for(self, data):
+        "Return node owning bytes data."
+        index = bisect.bisect(self._points, stable_hash(data))
+        return self._nodes[index % len(self._nodes)]
+
+
+class _ConnectionPool:
+    "Pool of persistent connections to one server."
+
+    def __init__(self, address, size, timeout):
+        self.address = address
+        self.size = size
+        self.timeout = timeout
+        self._idle = collections.deque()
+
+    def acquire(self):
+        "Return an idle connection or a new one."
+        try:
+            return self._idle.pop()
+        except IndexError:
+            family = (socket.AF_UNIX if isinstance(self.address, str)
+                      else socket.AF_INET)
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.address)
+            return sock
+
+    def release(self, sock, broken=False):
+        "Return sock to the pool (or close it if broken or pool is full)."
+        if broken or len(self._idle) >= self.size:
+            sock.close()
+        else:
+            self._idle.append(sock)
+
+    def close(self):
+        "Close all idle connections."
+        while self._idle:
+            self._idle.pop().close()
+
+
+class ShardedCacheClient(OxCacheBase):
+    """OxCacheBase which keeps its data in CacheServer processes.
+
+    Each key goes to the server chosen by a HashRing over the addresses.
+    Use get, store, delete, exists, ttl, expired and get_many as for a
+    local cache; things like expiration, refresh and replacement happen
+    in the server caches. `len`, `clean` and `reset` go to every server.
+    Methods which would need the records themselves (like `items` or
+    `get_record`) raise TypeError since the client has no local data.
+    """
+
+    def __init__(self, addresses, *args, vnodes=160, pool_size=4,
+                 timeout=30.0, **kwargs):
+        """Initializer for ShardedCacheClient.
+
+        :param addresses:     Addresses of CacheServer instances (unix
+                              socket paths or (host, port) pairs).
+
+        :param vnodes=160:    Virtual nodes per server on the hash ring.
+
+        :param pool_size=4:   Idle connections to keep per server.
+
+        :param timeout=30.0:  Socket timeout in seconds.
+
+        Otherwise *args, **kwargs are passed along to super().__init__.
+        """
+        self.addresses = [address if isinstance(address, str)
+                          else tuple(address) for address in addresses]
+        for address in self.addresses:
+            check_loopback(address)
+        self.ring = HashRing(range(len(self.addresses)), vnodes=vnodes)
+        self._pools = [_ConnectionPool(address, pool_size, timeout)
+                       for address in self.addresses]
+        super().__init__(*args, **kwargs)
+
+    def server_for(self, key, **opts):
+        """Return index of server owning key/opts.
+
+        We hash canonical_bytes of the namespace, base key and options so
+        they must be built from the types canonical_bytes supports.
+        Override this to route other keys.
+        """
+        full_key = self.make_key(key, **opts)
+        return self.ring.node_for(canonical_bytes(
+            (full_key.namespace, full_key.base_key, full_key.opts)))
+
+    def _request(self, server, operation, payload):
+        "Send one request to server and return the result."
+        pool = self._pools[server]
+        sock = pool.acquire()
+        try:
+            send_frame(sock, operation, payload)
+            status, result = recv_frame(sock)
+        except BaseException:
+            pool.release(sock, broken=True)
+            raise
+        pool.release(sock)
+        if status == STATUS_ERROR:
+            raise result
+        return status, result
+
+    def get(self, key, allow_refresh=True, lock=None, default=None, **opts):
+        "Get value for key from the server owning it (lock is ignored)."
+        dummy = lock
+        status, result = self._request(self.server_for(key, **opts), OP_GET,
+                                       (key, allow_refresh, opts))
+        return default if status == STATUS_MISS else result
+
+    def exists(self, key, lock=None, **opts):
+        "Return whether the server owning key has it (lock is ignored)."
+        dummy = lock
+        return self._request(self.server_for(key, **opts), OP_EXISTS,
+                             (key, opts))[1]
+
+    def ttl(self, key, lock=None, **opts):
+        "Return ttl on server owning key or 0 if missing (lock is ignored)."
+        dummy = lock
+        return self._request(self.server_for(key, **opts), OP_TTL,
+                             (key, opts))[1]
+
+    def expired(self, key, lock=None, **opts):
+        "Return whether key is expired on its server (lock is ignored)."
+        dummy = lock
+        return self._request(self.server_for(key, **opts), OP_EXPIRED,
+                             (key, opts))[1]
+
+    def _request_all(self, operation):
+        "Send operation to every server and return list of results."
+        return [self._request(server, operation, None)[1]
+                for server in range(len(self._pools))]
+
+    def __len__(self):
+        return sum(self._request_all(OP_LEN))
+
+    def clean(self, lock=None, batch=None):
+        "Clean every server and return the (full key, record) pairs removed."
+        dummy = lock, batch
+        return [pair for removed in self._request_all(OP_CLEAN)
+                for pair in removed]
+
+    def reset(self, lock=None):
+        "Reset every server (lock is ignored)."
+        dummy = lock
+        self._request_all(OP_RESET)
+
+    def _no_local_data(self, *args, **kwargs):
+        "Raise TypeError since the client keeps no records."
+        dummy = args, kwargs
+        raise TypeError('%s keeps its records on the servers' % (
+            self.__class__.__name__))
+
+    get_record = items = iter_batches = iter_items = __iter__ = (
+        _no_local_data)
+
+    def store(self, key, value, ttl_info=None, lock=None, **opts):
+        """Store value on the server owning key.
+
+        The server creates its own ttl_info so ttl_info and lock are
+        ignored.
+        """
+        dummy = ttl_info, lock
+        self._request(self.server_for(key, **opts), OP_STORE,
+                      (key, value, opts))
+
+    def delete(self, key, lock=None, **opts):
+        "Delete key from the server owning it (lock is ignored)."
+        dummy = lock
+        self._request(self.server_for(key, **opts), OP_DELETE, (key, opts))
+
+    def get_many(self, keys, allow_refresh=True, default=None, **opts):
+        """Get values for many keys with one request per server.
+
+        :param keys:    Sequence of keys.
+
+        :param allow_refresh=True:  As for get.
+
+        :param default=None:   Value for keys which are missing.
+
+        :param **opts:  Options applied to every key.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  List of values in the same order as keys.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  Requests are sent to every server before reading any
+                  response so the servers work on them in parallel.
+        """
+        keys = list(keys)
+        by_server = collections.defaultdict(list)
+        for position, key in enumerate(keys):
+            by_server[self.server_for(key, **opts)].append(position)
+        sent, results = [], [default] * len(keys)
+        try:
+            for server, positions in by_server.items():
+                sock = self._pools[server].acquire()
+                sent.append((server, positions, sock))
+                send_frame(sock, OP_GET_MANY, (
+                    [keys[position] for position in positions],
+                    allow_refresh, opts))
+            while sent:
+                server, positions, sock = sent[0]
+                status, values = recv_frame(sock)
+                sent.pop(0)
+                self._pools[server].release(sock)
+                if status == STATUS_ERROR:
+                    raise values
+                for position, (found, value) in zip(positions, values):
+                    if found == STATUS_OK:
+                        results[position] = value
+        except BaseException:
+            for server, dummy, sock in sent:  # state of stream unknown
+                self._pools[server].release(sock, broken=True)
+            raise
+        return results
+
+    def close(self):
+        "Close pooled connections."
+        for pool in self._pools:
+            pool.close()
+
+
+if __name__ == '__main__':
+    doctest.testmod()
+    print('Finished tests')
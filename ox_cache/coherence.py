@@ -0,0 +1,399 @@
+"""Keep caches on many processes or hosts coherent via invalidations.
+
+If the same cache (e.g., a TimedMemoizer) runs in many places, a value
+stored or deleted in one place stays stale everywhere else until it
+expires there. This module provides:
+
+  - CoherentCacheMixin:  Mixin which publishes invalidations for `store`,
+                         `delete` and `reset` and applies invalidations
+                         published by peers.
+  - InProcessBus:        Transport connecting caches in one process
+                         (mainly for tests and for caches per thread).
+  - UnixDatagramTransport:  Transport connecting processes on one host
+                         through unix domain datagram sockets in a
+                         shared directory.
+
+Invalidations are batched: keys are collected in a set (so repeated
+writes to a key coalesce into one message and a pending reset replaces
+everything before it) and published at most every `flush_interval`
+seconds or once `max_batch` keys are pending. Peers delete the keys from
+their own data (so they refresh on the next get) rather than receiving
+new values, which keeps messages small. Values created by `refresh`
+(e.g., on a miss) are not published since peers compute the same thing.
+
+>>> from ox_cache import OxCacheBase
+>>> from ox_cache.coherence import CoherentCacheMixin, InProcessBus
+>>> class Shared(CoherentCacheMixin, OxCacheBase):
+...     'Cache kept coherent with its peers.'
+...     def make_value(self, key, **opts):
+...         return 'computed %s' % key
+...
+>>> bus = InProcessBus()
+>>> first = Shared(bus=bus, flush_interval=0)
+>>> second = Shared(bus=bus, flush_interval=0)
+>>> first.get('a'), second.get('a')
+('computed a', 'computed a')
+>>> first.store('a', 'changed')    # second drops its stale copy
+>>> second.exists('a'), second.get('a', allow_refresh=False)
+(False, None)
+>>> second.get('b'), first.get('b')
+('computed b', 'computed b')
+>>> second.reset()
+>>> len(first)
+0
+
+Messages are pickled so only connect caches which trust each other.
+UnixDatagramTransport enforces this by only using a directory which is
+owned by the user running the cache and not accessible to anyone else.
+"""
+
+import collections
+import doctest
+import logging
+import os
+import pickle
+import socket
+import stat
+import threading
+import time
+import uuid
+import weakref
+
+from ox_cache.locks import NO_LOCK
+
+
+Invalidation = collections.namedtuple('Invalidation', [
+    'origin', 'reset', 'keys'])
+Invalidation.__doc__ = '''Message published by CoherentCacheMixin.
+
+  - origin:  Id of the cache which published the message (so it can
+             ignore its own messages).
+  - reset:   True if the origin was reset (peers reset too).
+  - keys:    Tuple of full keys to drop.
+'''
+
+
+class InProcessBus:
+    """Transport delivering invalidations between caches in one process.
+
+    Subscribers are held through weak references so a cache which is no
+    longer used does not stay alive just because it is on the bus.
+    Messages are delivered synchronously from `publish`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        "Call callback(data) for every published message."
+        try:
+            ref = weakref.WeakMethod(callback)
+        except TypeError:  # not a bound method
+            ref = (lambda: callback)
+        with self._lock:
+            self._subscribers.append(ref)
+
+    def publish(self, data):
+        "Deliver data (bytes) to every subscriber."
+        with self._lock:
+            self._subscribers = [ref for ref in self._subscribers
+                                 if ref() is not None]
+            callbacks = [ref() for ref in self._subscribers]
+        for callback in callbacks:
+            if callback is not None:
+                callback(data)
+
+
+class UnixDatagramTransport:
+    """Transport for processes on one host using unix datagram sockets.
+
+    :param directory:  Directory shared by all peers. Each transport binds
+                       a socket named `<name>.sock` in it and publishes by
+                       sending to every other socket there. It is created
+                       with mode 0700 if missing. Since peers unpickle
+                       what they receive, we raise ValueError if it is
+                       not a directory owned by us which only we can use.
+
+    :param name=None:  Name for our socket (default: a random uuid).
+
+    A background thread receives messages for `subscribe`. Call `close`
+    to stop it and remove our socket. Messages are sent without blocking:
+    if the queue of a peer is full, we log a warning and that peer misses
+    the message (so it serves its copy until that expires).
+
+>>> import tempfile, threading
+>>> from ox_cache.coherence import UnixDatagramTransport
+>>> directory = tempfile.mkdtemp()
+>>> sender = UnixDatagramTransport(directory)
+>>> receiver = UnixDatagramTransport(directory)
+>>> got = threading.Event()
+>>> receiver.subscribe(lambda data: got.set() if data == b'hi' else None)
+>>> sender.publish(b'hi')
+>>> got.wait(5)
+True
+>>> sender.close(); receiver.close()
+    """
+
+    max_datagram = 65536
+
+    def __init__(self, directory, name=None):
+        self.check_directory(directory)
+        self.directory = directory
+        self.path = os.path.join(directory, '%s.sock' % (
+            name or uuid.uuid4().hex))
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        self._thread = None
+        self._closed = False
+
+    @staticmethod
+    def check_directory(directory):
+        "Create directory (mode 0700) or make sure only we can use it."
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        info = os.stat(directory)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or (
+                info.st_mode & 0o077):
+            raise ValueError(
+                'Directory %s must be owned by us with mode 0700 since'
+                ' messages sent through it are unpickled' % directory)
+
+    def peers(self):
+        "Return paths of sockets for other transports in our directory."
+        return [os.path.join(self.directory, name) for name in sorted(
+            os.listdir(self.directory)) if name.endswith('.sock') and (
+                os.path.join(self.directory, name) != self.path)]
+
+    def publish(self, data):
+        "Send data (bytes) to every peer without blocking on any of them."
+        for path in self.peers():
+            try:
+                self._sock.sendto(data, socket.MSG_DONTWAIT, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                logging.debug('Skipping peer %s which is gone', path)
+            except BlockingIOError:
+                logging.warning('Dropping message for peer %s whose queue'
+                                ' is full', path)
+            except OSError as problem:  # e.g., EMSGSIZE
+                logging.warning('Could not send %i bytes to peer %s: %s',
+                                len(data), path, problem)
+
+    def subscribe(self, callback):
+        "Start thread which calls callback(data) for each message received."
+        if self._thread is not None:
+            raise ValueError('%s only supports one subscriber' % (
+                self.__class__.__name__))
+        self._thread = threading.Thread(
+            target=self._receive, args=(callback,), daemon=True,
+            name='ox_cache-coherence-%s' % os.path.basename(self.path))
+        self._thread.start()
+
+    def _receive(self, callback):
+        "Receive messages until closed."
+        self._sock.settimeout(0.2)
+        while not self._closed:
+            try:
+                data = self._sock.recv(self.max_datagram)
+            except socket.timeout:
+                continue
+            except OSError:  # closed under us
+                break
+            try:
+                callback(data)
+            except Exception as problem:  # pylint: disable=broad-except
+                logging.exception('Error handling invalidation: %s',
+                                  problem)
+
+    def close(self):
+        "Stop receiving and remove our socket."
+        self._closed = True
+        if self._thread is not None:
+            self._thread.join()
+        self._sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _flush_loop(cache_ref, wakeup):
+    """Publish pending invalidations of a cache until it goes away.
+
+    :param cache_ref:   Weak reference to a CoherentCacheMixin instance
+                        (so this thread does not keep it alive).
+
+    :param wakeup:      Event set when invalidations become pending.
+    """
+    while True:
+        woken = wakeup.wait(1.0)
+        cache = cache_ref()
+        if cache is None or cache.bus is None:
+            return
+        if woken:
+            time.sleep(cache.flush_interval)  # collect a batch
+            wakeup.clear()  # before flushing so later keys set it again
+            cache.flush_invalidations()
+        del cache
+
+
+class CoherentCacheMixin:
+    """Mixin to publish and apply invalidations through a transport.
+
+See the module docs for an overview and example. A transport is any
+object with `publish(data)` and `subscribe(callback)` methods (and
+optionally `close`) such as InProcessBus or UnixDatagramTransport. If
+the transport has a `max_datagram` attribute, we split batches so each
+pickled message fits in that many bytes.
+
+Batches are published by one flusher thread per cache which is started
+on the first invalidation and sleeps until there is something to send.
+    """
+
+    def __init__(self, *args, bus=None, flush_interval=0.05,
+                 max_batch=256, **kwargs):
+        """Initializer for CoherentCacheMixin.
+
+        :param bus=None:  Transport to publish to and subscribe on. If
+                          None, the cache works as if this mixin was
+                          not there.
+
+        :param flush_interval=0.05:  Seconds to collect invalidations
+                                     before publishing. If 0, publish
+                                     right away from the thread making
+                                     the change.
+
+        :param max_batch=256:  Publish once this many keys are pending
+                               (and never put more in one message).
+
+        Otherwise *args, **kwargs are passed along to super().__init__.
+        """
+        self.bus = bus
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.origin = uuid.uuid4().hex
+        self._pending_keys = set()
+        self._pending_reset = False
+        self._pending_lock = threading.Lock()
+        self._flush_wakeup = threading.Event()
+        self._flusher = None
+        self._quiet = threading.local()  # set while refreshing
+        super().__init__(*args, **kwargs)
+        if bus is not None:
+            bus.subscribe(self._on_invalidation)
+
+    def _publish_later(self, full_key=None, reset=False):
+        "Add invalidation to pending batch and arrange to publish it."
+        if self.bus is None:
+            return
+        with self._pending_lock:
+            if reset:
+                self._pending_reset = True
+                self._pending_keys.clear()
+            elif not self._pending_reset:
+                self._pending_keys.add(full_key)
+            now = (not self.flush_interval or
+                   len(self._pending_keys) >= self.max_batch)
+            if not now and self._flusher is None:
+                self._flusher = threading.Thread(
+                    target=_flush_loop, daemon=True,
+                    args=(weakref.ref(self), self._flush_wakeup),
+                    name='ox_cache-coherence-flush-%s' % self.origin)
+                self._flusher.start()
+        if now:
+            self.flush_invalidations()
+        else:
+            self._flush_wakeup.set()
+
+    def flush_invalidations(self):
+        "Publish pending invalidations now."
+        with self._pending_lock:
+            keys, reset = list(self._pending_keys), self._pending_reset
+            self._pending_keys.clear()
+            self._pending_reset = False
+        if reset:
+            self._publish(Invalidation(self.origin, True, ()))
+        for start in range(0, len(keys), self.max_batch):
+            self._publish(Invalidation(self.origin, False, tuple(
+                keys[start:start + self.max_batch])))
+
+    def _publish(self, message):
+        "Publish message splitting its keys if it is too big for the bus."
+        data = pickle.dumps(message)
+        limit = getattr(self.bus, 'max_datagram', None)
+        if limit is None or len(data) <= limit:
+            self.bus.publish(data)
+        elif len(message.keys) > 1:
+            middle = len(message.keys) // 2
+            self._publish(message._replace(keys=message.keys[:middle]))
+            self._publish(message._replace(keys=message.keys[middle:]))
+        else:  # peers must not keep a stale value so reset them instead
+            logging.warning('Invalidation for %s is %i bytes (more than'
+                            ' %i) so resetting peers instead',
+                            message.keys[0], len(data), limit)
+            self.bus.publish(pickle.dumps(message._replace(
+                reset=True, keys=())))
+
+    def _on_invalidation(self, data):
+        "Apply invalidation message from a peer."
+        message = pickle.loads(data)
+        if message.origin == self.origin:
+            return
+        with self.lock:
+            if message.reset:
+                super().reset(lock=NO_LOCK)
+            for full_key in message.keys:
+                if full_key in self._data:
+                    self._delete_full_key(full_key, lock=NO_LOCK)
+
+    def _quietly(self, method, *args, **kwargs):
+        "Call method without publishing the stores it makes."
+        outer = getattr(self._quiet, 'active', False)
+        self._quiet.active = True
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self._quiet.active = outer
+
+    def refresh(self, key, lock=None, **opts):
+        "Refresh without publishing the stores it makes."
+        return self._quietly(super().refresh, key, lock=lock, **opts)
+
+    def refresh_outside_lock(self, key, lock=None, **opts):
+        "Refresh outside the lock without publishing the stores it makes."
+        return self._quietly(super().refresh_outside_lock, key, lock=lock,
+                             **opts)
+
+    def store(self, key, value, ttl_info=None, lock=None, **opts):
+        "Store and publish invalidation for key (unless refreshing)."
+        result = super().store(key, value, ttl_info, lock=lock, **opts)
+        if not getattr(self._quiet, 'active', False):
+            self._publish_later(self.make_key(key, **opts))
+        return result
+
+    def delete(self, key, lock=None, **opts):
+        "Delete and publish invalidation for key (even if not here)."
+        try:
+            return super().delete(key, lock=lock, **opts)
+        finally:
+            self._publish_later(self.make_key(key, **opts))
+
+    def reset(self, lock=None):
+        "Reset and publish reset to peers."
+        result = super().reset(lock=lock)
+        self._publish_later(reset=True)
+        return result
+
+    def close_coherence(self):
+        "Publish anything pending and close the transport (if it can)."
+        if self.bus is not None:
+            self.flush_invalidations()
+            close = getattr(self.bus, 'close', None)
+            if close is not None:
+                close()
+            self.bus = None
+            self._flush_wakeup.set()  # so the flusher (if any) exits
+
+
+if __name__ == '__main__':
+    doctest.testmod()
+    print('Finished tests')
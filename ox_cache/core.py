@@ -2,19 +2,21 @@
 """
 
 
+import copy
 import doctest
 import logging
-import datetime
-import collections
+import operator
+import time
+from sys import intern
 
-from ox_cache.locks import FakeLock, TimeoutLock
+from ox_cache.locks import NO_LOCK, TimeoutLock
+from ox_cache.storage import IndexedStorage, LogCursor
 
 
-class OxCacheFullKey(collections.namedtuple('OxCacheFullKey', [
-        'namespace', 'base_key', 'opts'])):
+class OxCacheFullKey(tuple):
     '''Repersentation for the full key in a cache.
 
-The OxCacheFullKey class is a namedtuple to represent a cache key with
+The OxCacheFullKey class is a tuple to represent a cache key with
 the following components:
 
   - namespace:  The namespace the key lives in.
@@ -30,8 +32,68 @@ may be straightforward, you might wonder why we need the opts. Roughly
 speaking, these make our implemetnation much more flexible for sub-classes.
 For example, they allow a relatively simple implementation of function
 memoization as with the OxMemoizer or TimedMemoizer classes.
+
+Since caches may hold millions of keys, the key is stored as a single
+flat tuple of the form (namespace, base_key, name1, value1, name2, ...)
+instead of nesting a tuple for each pair in opts, and string namespaces
+are interned so every key in a namespace shares one string. The
+`namespace`, `base_key` and `opts` attributes work as they would for
+a namedtuple and the key still unpacks into those three fields (even
+though indexing and len see the flat tuple):
+
+>>> from ox_cache import OxCacheFullKey
+>>> key = OxCacheFullKey('default', 'f', (('x', 1), ('y', 2)))
+>>> key
+OxCacheFullKey(namespace='default', base_key='f', opts=(('x', 1), ('y', 2)))
+>>> key.base_key, key.opts, key.odict()['y']
+('f', (('x', 1), ('y', 2)), 2)
+>>> key == OxCacheFullKey('default', 'f', [('x', 1), ('y', 2)])
+True
+>>> namespace, base_key, opts = key
+>>> namespace, base_key, opts
+('default', 'f', (('x', 1), ('y', 2)))
     '''
 
+    __slots__ = ()
+    _fields = ('namespace', 'base_key', 'opts')
+
+    def __new__(cls, namespace, base_key, opts=()):
+        if namespace.__class__ is str:
+            namespace = intern(namespace)
+        flat = [namespace, base_key]
+        for name, value in opts:
+            flat.append(name)
+            flat.append(value)
+        return cls.from_flat(flat)
+
+    @staticmethod
+    def from_flat(flat):
+        """Make a key from an already flattened sequence.
+
+        :param flat:  Sequence (namespace, base_key, name1, value1, ...)
+                      where the names are sorted. Unlike the regular
+                      constructor, this does not intern the namespace.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  An OxCacheFullKey or, if any element of flat is a
+                  container whose hash python does not cache (e.g., a
+                  tuple), an OxCacheHashedKey which computes the hash
+                  once and keeps it.
+        """
+        if _UNCACHED_HASH_TYPES.isdisjoint(map(type, flat)):
+            return tuple.__new__(OxCacheFullKey, flat)
+        flat = tuple(flat)
+        return tuple.__new__(OxCacheHashedKey, flat + (hash(flat),))
+
+    namespace = property(operator.itemgetter(0), doc='Namespace for key.')
+    base_key = property(operator.itemgetter(1), doc='Base key for key.')
+
+    @property
+    def opts(self):
+        "Tuple of (name, value) pairs for the **opts in the key."
+        return tuple(zip(self[2::2], self[3::2]))
+
     def odict(self):
         """Return a dict representing the **opts for the key.
 
@@ -43,12 +105,72 @@ memoization as with the OxMemoizer or TimedMemoizer classes.
         to most OxCacheBase methods and they will recognize how to parse
         the pieces of the key.
         """
-        return dict(self.opts, namespace=self.namespace)
+        return dict(zip(self[2::2], self[3::2]), namespace=self[0])
+
+    def _asdict(self):
+        "Return dict of fields similar to namedtuple._asdict."
+        return {'namespace': self[0], 'base_key': self[1],
+                'opts': self.opts}
+
+    def _replace(self, **fields):
+        "Return new key with given fields replaced like namedtuple._replace."
+        info = self._asdict()
+        info.update(fields)
+        return self.__class__(**info)
+
+    def __iter__(self):
+        "Iterate over (namespace, base_key, opts) like the old namedtuple."
+        yield self[0]
+        yield self[1]
+        yield self.opts
+
+    def __getnewargs__(self):
+        return (self[0], self[1], self.opts)
+
+    def __repr__(self):
+        return 'OxCacheFullKey(namespace=%r, base_key=%r, opts=%r)' % (
+            self[0], self[1], self.opts)
+
+
+_UNCACHED_HASH_TYPES = frozenset([tuple, frozenset])
+_new_tuple = tuple.__new__
+
+
+class OxCacheHashedKey(OxCacheFullKey):
+    """Version of OxCacheFullKey which caches its hash.
+
+Strings and bytes cache their own hash but tuples recompute theirs on every
+dict lookup. Keys containing large tuples (e.g., from memoizing a function
+taking a long tuple argument) would pay that cost on every lookup so
+OxCacheFullKey.from_flat creates an OxCacheHashedKey for them instead. It
+stores the hash as a hidden last element of the tuple and returns that
+from __hash__. You normally never create one directly:
+
+>>> from ox_cache import OxCacheBase
+>>> key = OxCacheBase().make_key('f', x=tuple(range(1000)))
+>>> type(key).__name__, len(key.opts), key.odict()['x'][-1]
+('OxCacheHashedKey', 1, 999)
+>>> key == OxCacheBase().make_key('f', x=tuple(range(1000)))
+True
+    """
+
+    __slots__ = ()
+
+    def __hash__(self):
+        return self[-1]
 
+    @property
+    def opts(self):
+        "Tuple of (name, value) pairs for the **opts in the key."
+        return tuple(zip(self[2:-1:2], self[3:-1:2]))
+
+    def odict(self):
+        "Return a dict representing the **opts for the key."
+        return dict(zip(self[2:-1:2], self[3:-1:2]), namespace=self[0])
 
-OxCacheItem = collections.namedtuple('OxCacheItem', [
-    'payload', 'ttl_info'])
-OxCacheItem.__doc__ = '''Cache entry item.
+
+class OxCacheItem:
+    """Cache entry item.
 
 The OxCacheItem represents an item in the cache. It has the following
 fields:
@@ -56,7 +178,148 @@ fields:
   - payload:      The raw data for the cached item.
   - ttl_info:     Information used to determine the time to live for this
                   cache item. See the OxCacheBase.expired doc for details.
-'''
+
+The item uses __slots__ to keep per-entry memory low. It can still be
+unpacked like the namedtuple it used to be:
+
+>>> from ox_cache import OxCacheItem
+>>> payload, ttl_info = OxCacheItem('data', 1.5)
+>>> payload, ttl_info
+('data', 1.5)
+    """
+
+    __slots__ = ('payload', 'ttl_info')
+    _fields = __slots__
+
+    def __init__(self, payload, ttl_info):
+        self.payload = payload
+        self.ttl_info = ttl_info
+
+    def __iter__(self):
+        yield self.payload
+        yield self.ttl_info
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return (self.payload == other.payload and
+                self.ttl_info == other.ttl_info)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(payload=%r, ttl_info=%r)' % (
+            self.__class__.__name__, self.payload, self.ttl_info)
+
+    def _replace(self, **fields):
+        "Return new item with given fields replaced like namedtuple._replace."
+        return self.__class__(fields.get('payload', self.payload),
+                              fields.get('ttl_info', self.ttl_info))
+
+
+_COMPOSED_ITEMS = {}  # (base item class, slot names): composed item class
+
+
+def _rebuild_item(base, slots, payload, ttl_info, values):
+    "Recreate item of a composed item class when unpickling it."
+    item = compose_item_class(base, slots)(payload, ttl_info)
+    for name, value in zip(sorted(slots), values):
+        setattr(item, name, value)
+    return item
+
+
+def compose_item_class(base, slots):
+    """Return sub-class of item class base which has extra slots.
+
+    :param base:    OxCacheItem (or sub-class) to extend. If base was
+                    itself made by compose_item_class, we extend the class
+                    it was made from so slots from many mixins combine.
+
+    :param slots:   Dict of slot name: default value for new items.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  Item class with the slots of base and those in slots. The
+              same class is returned for the same base and slots.
+
+    This is what OxCacheBase uses to combine the `item_slots` declared by
+    mixins so that many mixins can keep bookkeeping on records:
+
+>>> from ox_cache.core import OxCacheItem, compose_item_class
+>>> kind = compose_item_class(OxCacheItem, {'hits': 0, 'stamp': None})
+>>> item = kind('data', 1.5)
+>>> item.payload, item.hits, item.stamp
+('data', 0, None)
+>>> compose_item_class(kind, {'hits': 0}) is kind
+True
+>>> compose_item_class(kind, {'more': 1}).__slots__
+('hits', 'more', 'stamp')
+>>> import pickle
+>>> item.hits = 3
+>>> copy = pickle.loads(pickle.dumps(item))
+>>> copy.__class__ is kind, copy.payload, copy.hits
+(True, 'data', 3)
+    """
+    defaults = dict(getattr(base, '_item_defaults', ()))
+    base = base.__dict__.get('_composed_from', base)
+    defaults.update((name, value) for name, value in slots.items()
+                    if not hasattr(base, name))
+    names = tuple(sorted(defaults))
+    if not names:
+        return base
+    result = _COMPOSED_ITEMS.get((base, names))
+    if result is not None:
+        return result
+    initial = tuple(defaults[name] for name in names)
+
+    def __init__(self, payload, ttl_info):
+        base.__init__(self, payload, ttl_info)
+        for name, value in zip(names, initial):
+            setattr(self, name, value)
+
+    def __reduce__(self):
+        return (_rebuild_item, (base, defaults, self.payload, self.ttl_info,
+                                [getattr(self, name) for name in names]))
+
+    result = type(base.__name__, (base,), {
+        '__slots__': names, '__init__': __init__, '__reduce__': __reduce__,
+        '__module__': base.__module__, '_composed_from': base,
+        '_item_defaults': tuple(defaults.items())})
+    return _COMPOSED_ITEMS.setdefault((base, names), result)
+
+
+def fresh_exception(problem):
+    """Return copy of a cached exception which can be raised again.
+
+    :param problem:   Exception kept around (e.g., in a cache) to raise
+                      for many callers.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  Shallow copy of problem with no traceback. Raising the same
+              exception object again appends to its traceback each time
+              (and from many threads at once), so we raise copies. If
+              problem cannot be copied (e.g., its __init__ does not take
+              its args), we return a RuntimeError caused by problem.
+
+>>> import traceback
+>>> from ox_cache.core import fresh_exception
+>>> cached, depths = ValueError('bad'), []
+>>> for attempt in range(3):
+...     try:
+...         raise fresh_exception(cached)
+...     except ValueError as problem:
+...         depths.append(len(traceback.extract_tb(problem.__traceback__)))
+...
+>>> depths, cached.__traceback__
+([1, 1, 1], None)
+    """
+    try:
+        result = copy.copy(problem)
+    except Exception:  # pylint: disable=broad-except
+        result = RuntimeError('cached error: %r' % (problem,))
+        result.__cause__ = problem
+    return result.with_traceback(None)
 
 
 class OxCacheBase:
@@ -119,16 +382,52 @@ of the mixins provided. See `help(ox_cache)` for `print(ox_cache.__doc__)`
 for a more detailed discussion.
     """
 
+    iter_batch_size = 1024
+    item_class = OxCacheItem  # mixins can use a sub-class with more slots
+    item_slots = {}  # mixins can add slots (name: default) to item_class
+
+    def __init_subclass__(cls, **kwargs):
+        "Compose item_class with the item_slots of every class in our MRO."
+        super().__init_subclass__(**kwargs)
+        slots = {}
+        for klass in reversed(cls.__mro__):
+            slots.update(klass.__dict__.get('item_slots', {}))
+        if slots:
+            cls.item_class = compose_item_class(cls.item_class, slots)
+
     def __init__(self, lock=None):
         """Initializer.
 
         :param lock=None:  Context manager for locking. If this is None,
                            we use TimeoutLock(). If you want a different
                            timeout provide TimeoutLock(your_timeout).
+                           If your sub-class calls locking methods
+                           like `store` from inside `make_value`, you
+                           can provide TimeoutLock(reentrant=True) instead
+                           of passing `lock=NO_LOCK` to the nested calls.
+
+                           If you provide a ReadWriteLock, the cache runs
+                           in read-write mode: `get_record`, `exists`,
+                           `ttl`, `expired` and `get` calls which hit the
+                           cache only take the shared side (available as
+                           self.read_lock) while `store`, `delete`,
+                           `reset`, `clean` and refreshes on a miss take
+                           the exclusive side. Mixins which implement
+                           `_pre_get` must then make sure that hook is
+                           safe to run under the shared side.
         """
         self.lock = lock if lock is not None else TimeoutLock()
         self._data = self.make_storage()
 
+    @property
+    def read_lock(self):
+        """Shared side of self.lock (or self.lock if it has no shared side).
+
+        This is looked up from self.lock on each use so it stays paired
+        with self.lock even if you assign a new lock to a cache.
+        """
+        return getattr(self.lock, 'shared', self.lock)
+
     def __contains__(self, key):
         return self.exists(key)
 
@@ -157,14 +456,110 @@ for a more detailed discussion.
         """
         return self._data.items()
 
+    def iter_batches(self, batch=None, lock=None):
+        """Generator to walk the cache in batches of (full_key, record).
+
+        :param batch=None:  Maximum number of pairs per batch. If None,
+                            use self.iter_batch_size.
+
+        :param lock=None:   Optional lock to use. If None, use
+                            self.read_lock.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  Generator yielding lists of (full_key, record) pairs.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  Walk the cache without copying all of it and without
+                  holding the lock the whole time. Each batch is read
+                  while holding the lock and the lock is released
+                  before the batch is yielded so callers can take the
+                  lock themselves (e.g., to delete what we yielded).
+
+                  We walk the key_log of our IndexedStorage by position
+                  using the cursor from `pin` (which the storage moves
+                  if it compacts the log while we walk). The walk is
+                  bounded by the end of the log when we start so keys
+                  added during the walk are not yielded while keys
+                  present for the whole walk are always yielded. A key
+                  deleted and re-added before the walk may occupy two
+                  slots and be yielded twice. If the cache is reset we
+                  stop.
+
+                  If make_storage returns something other than an
+                  IndexedStorage, we fall back to copying its keys.
+        """
+        if batch is None:
+            batch = self.iter_batch_size
+        if lock is None:
+            lock = self.read_lock
+        with lock:
+            data = self._data
+            pinned = isinstance(data, IndexedStorage)
+            if pinned:
+                cursor = data.pin()
+            else:
+                keys = list(data)
+                cursor = LogCursor(0, len(keys))
+        try:
+            more = True
+            while more:
+                with lock:
+                    if self._data is not data:  # cache was reset
+                        return
+                    if pinned:
+                        keys = data.key_log
+                    start = cursor.position
+                    end = cursor.position = min(start + batch, cursor.stop)
+                    more = end < cursor.stop
+                    chunk = []
+                    for full_key in keys[start:end]:
+                        record = data.get(full_key)
+                        if record is not None:
+                            chunk.append((full_key, record))
+                if chunk:
+                    yield chunk
+        finally:
+            if pinned:
+                data.unpin(cursor)
+
+    def iter_items(self, batch=None, lock=None):
+        """Generator to iterate over (full_key, record) pairs lazily.
+
+        :param batch=None, lock=None:  As for iter_batches.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  Like `self.items()` but safe to use while other
+                  threads modify the cache and without holding the
+                  lock for the whole iteration. See iter_batches.
+
+>>> from ox_cache import OxCacheBase
+>>> cache = OxCacheBase()
+>>> for i in range(10):
+...     cache.store(i, i*i)
+...
+>>> walk = cache.iter_items(batch=4)
+>>> [next(walk)[0].base_key for dummy in range(3)]
+[0, 1, 2]
+>>> cache.delete(3)  # changes the cache between batches
+>>> cache.store(10, 100)  # added after walk started so not yielded
+>>> [(k.base_key, r.payload) for k, r in walk]  # 3 was in first batch
+[(3, 9), (4, 16), (5, 25), (6, 36), (7, 49), (8, 64), (9, 81)]
+        """
+        for chunk in self.iter_batches(batch=batch, lock=lock):
+            yield from chunk
+
     def make_storage(self):
         """Make dict-like storage to store data in.
 
         Sub-classes can override to return some other dict-like
-        structure (e.g., to store to disk or something).
+        structure (e.g., to store to disk or something). See the
+        IndexedStorage docs for what the default storage provides.
         """
         dummy = self
-        return {}
+        return IndexedStorage()
 
     def make_key(self, base_key, namespace='default', __not_keys=(),
                  **opts):
@@ -209,15 +604,22 @@ for a more detailed discussion.
 
         """
         dummy = self
-        if isinstance(base_key, OxCacheFullKey) and not opts:
-            full_key = base_key
-        else:
-            if __not_keys:
-                opts = {k: v for k, v in opts.items() if k not in __not_keys}
-            full_key = OxCacheFullKey(namespace, base_key, tuple(
-                (k, opts[k]) for k in sorted(opts)))
-
-        return full_key
+        if not opts:
+            if isinstance(base_key, OxCacheFullKey):
+                return base_key
+            flat = (intern(namespace) if namespace.__class__ is str
+                    else namespace, base_key)
+            if base_key.__class__ not in _UNCACHED_HASH_TYPES:
+                return _new_tuple(OxCacheFullKey, flat)
+            return OxCacheFullKey.from_flat(flat)
+        if __not_keys:
+            opts = {k: v for k, v in opts.items() if k not in __not_keys}
+        flat = [intern(namespace) if namespace.__class__ is str
+                else namespace, base_key]
+        for name in sorted(opts):
+            flat.append(name)
+            flat.append(opts[name])
+        return OxCacheFullKey.from_flat(flat)
 
     def make_value(self, key, **opts):
         """Make the data value corresponding to the given key/opts.
@@ -243,7 +645,13 @@ for a more detailed discussion.
     def _pre_get(self, key, allow_refresh, **opts):
         """Hook called right after `self.get` enters its lock.
 
-        :param key, allow_refresh, **opts:  As received by `self.get` method.
+        :param key:     The full key (i.e., OxCacheFullKey) computed once
+                        by `self.get` from what it received. Since the
+                        full key already contains the **opts, `get` passes
+                        no **opts to this hook and `self.make_key(key)`
+                        just returns `key`.
+
+        :param allow_refresh:  As received by `self.get` method.
 
         ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
 
@@ -258,11 +666,13 @@ for a more detailed discussion.
     def _pre_store(self, key, value, ttl_info, **opts):
         """Hook called right after `store` enters lock and computes ttl_info.
 
-        :param key, value:  As provided to store method.
+        :param key:         The full key computed once by `store`. As with
+                            `_pre_get`, the **opts are part of the full
+                            key so no **opts are passed to this hook.
 
-        :param ttl_info:    The `ttl_info` computed by `store`.
+        :param value:       As provided to store method.
 
-        :param **opts:      As provided to store method.
+        :param ttl_info:    The `ttl_info` computed by `store`.
 
         ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
 
@@ -277,11 +687,12 @@ for a more detailed discussion.
     def _post_store(self, key, value, ttl_info, **opts):
         """Hook called right before `store` exits lock.
 
-        :param key, value:  As provided to store method.
+        :param key:         The full key computed once by `store` (see
+                            `_pre_store`).
 
-        :param ttl_info:    The `ttl_info` computed by `store`.
+        :param value:       As provided to store method.
 
-        :param **opts:      As provided to store method.
+        :param ttl_info:    The `ttl_info` computed by `store`.
 
         ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
 
@@ -346,10 +757,37 @@ for a more detailed discussion.
                       self.__class__.__name__)
         if lock is None:
             lock = self.lock
+        full_key = self.make_key(key, **opts)
         with lock:
             my_value = self.make_value(key, **opts)
             ttl_info = self.create_ttl(key, **opts)
-            self.store(key, my_value, ttl_info, lock=FakeLock(), **opts)
+            self.store(full_key, my_value, ttl_info, lock=NO_LOCK)
+
+    def refresh_outside_lock(self, key, lock=None, **opts):
+        """Refresh key calling make_value without holding the lock.
+
+        :param key, lock=None, **opts:  As for refresh.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  Like `refresh` but readers keep getting the current
+                  value while `make_value` runs and we only take the lock
+                  to call create_ttl and self.store. This is meant for
+                  background refreshes (see RefreshAheadMixin); a refresh
+                  on a miss should use `refresh` so that concurrent
+                  misses for the key wait instead of all making values.
+
+                  Mixins which override `refresh` to do something around
+                  `make_value` should override this as well (or fall
+                  back to `refresh` if they need the lock throughout).
+        """
+        if lock is None:
+            lock = self.lock
+        full_key = self.make_key(key, **opts)
+        my_value = self.make_value(key, **opts)
+        with lock:
+            ttl_info = self.create_ttl(key, **opts)
+            self.store(full_key, my_value, ttl_info, lock=NO_LOCK)
 
     def ttl(self, key, lock=None, **opts):
         """Return time-to-live for given key/**opts.
@@ -411,7 +849,7 @@ for a more detailed discussion.
                    where we implement this as basically
 
            return max(0, self.expiry_seconds - (
-               datetime.datetime.utcnow() - record.ttl_info).total_seconds())
+               time.time() - record.ttl_info))
 
                    to compute expiration as whether self.expiry_seconds have
                    passed since the record was created.
@@ -439,13 +877,13 @@ for a more detailed discussion.
         ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
 
         PURPOSE:  Create time to live related information By default,
-                  this method simply returns datetime.datetime.utcnow()
-                  to represent when the item was added to the cache.
-                  Sub-classes can use the returned value as they see fit
-                  or override this method.
+                  this method simply returns time.time() (a float in
+                  seconds since the epoch) to represent when the item was
+                  added to the cache. Sub-classes can use the returned
+                  value as they see fit or override this method.
         """
         dummy = self, key, opts
-        return datetime.datetime.utcnow()
+        return time.time()
 
     def expired(self, key, lock=None, **opts):
         """Determine if the given key/**opts is expired.
@@ -508,11 +946,14 @@ for a more detailed discussion.
             self._data = self.make_storage()
             self._post_reset()
 
-    def clean(self, lock=None):
+    def clean(self, lock=None, batch=None):
         """Go through everything in the cache and remove expired elements.
 
         :param lock=None:   Optional lock to use. If None, use self.lock.
 
+        :param batch=None:  Number of records to look at per lock
+                            acquisition. If None, use self.iter_batch_size.
+
         ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
 
         :return:  Returns a list of pairs similar to `self.items` for
@@ -524,17 +965,29 @@ for a more detailed discussion.
                   remove it. You can either use this to prune the cache
                   as necessary or use mixins like the LRUReplacementMixin
                   to keep the cache size managable.
+
+                  We walk the cache with iter_batches so that we only
+                  hold the lock for one batch at a time and never copy
+                  the whole cache. After each batch we take the lock
+                  again to delete records which are still current and
+                  still expired.
         """
         removed = []
+        read_lock = self.read_lock if lock is None else lock
         if lock is None:
             lock = self.lock
-        with lock:
-            for full_key, ox_rec in list(self.items()):
-                ttl = self.ttl_for_record(ox_rec)
-                if ttl <= 0:
-                    self._delete_full_key(full_key, FakeLock())
-                    removed.append((full_key, ox_rec))
-            return removed
+        for chunk in self.iter_batches(batch=batch, lock=read_lock):
+            expired = [(full_key, ox_rec) for full_key, ox_rec in chunk
+                       if self.ttl_for_record(ox_rec) <= 0]
+            if not expired:
+                continue
+            with lock:
+                for full_key, ox_rec in expired:
+                    if self._data.get(full_key) is ox_rec and (
+                            self.ttl_for_record(ox_rec) <= 0):
+                        self._delete_full_key(full_key, NO_LOCK)
+                        removed.append((full_key, ox_rec))
+        return removed
 
     def store(self, key, value, ttl_info=None, lock=None, **opts):
         """Store a value for the given key.
@@ -560,15 +1013,15 @@ for a more detailed discussion.
                   or `**opts`.
 
         """
+        full_key = self.make_key(key, **opts)
         if lock is None:
             lock = self.lock
         with lock:
             if ttl_info is None:
                 ttl_info = self.create_ttl(key, **opts)
-            self._pre_store(key, value, ttl_info, **opts)
-            full_key = self.make_key(key, **opts)
-            self._data[full_key] = OxCacheItem(value, ttl_info)
-            self._post_store(key, value, ttl_info, **opts)
+            self._pre_store(full_key, value, ttl_info)
+            self._data[full_key] = self.item_class(value, ttl_info)
+            self._post_store(full_key, value, ttl_info)
 
     def delete(self, key, lock=None, **opts):
         """Store a value for the given key.
@@ -645,9 +1098,12 @@ for a more detailed discussion.
         PURPOSE:   This is a helper method to be called to get the
                    OxCacheItem for a record (e.g., to determine time-to-live).
                    Users should call `get` not this.
+
+                   If lock is None, this uses self.read_lock which is the
+                   shared side of the lock for a cache in read-write mode.
         """
         if lock is None:
-            lock = self.lock
+            lock = self.read_lock
         with lock:
             record = self._data.get(full_key, None)
             return record
@@ -683,27 +1139,40 @@ for a more detailed discussion.
                   `self[full_key]` but cannot provide other paramters in
                   that form.
 
+                  If the cache is in read-write mode (see __init__) and
+                  lock is None, we first look for a non-expired record
+                  under self.read_lock and only take the exclusive
+                  self.lock if we need to refresh.
+
         """
+        full_key = self.make_key(key, **opts)
+        need_pre_get = True
         if lock is None:
+            read_lock = self.read_lock
+            if read_lock is not self.lock:
+                with read_lock:
+                    self._pre_get(full_key, allow_refresh=allow_refresh)
+                    record = self._data.get(full_key, None)
+                    if record is not None and not self.is_record_expired(
+                            record):
+                        return record.payload
+                if not allow_refresh:
+                    return default
+                need_pre_get = False  # already called under shared side
             lock = self.lock
         with lock:
-            self._pre_get(key, allow_refresh=allow_refresh, **opts)
-            base_key = key
-            key = self.make_key(base_key, **opts)
-            record = self._data.get(key, None)
-            if record is None:     # Do not know anything about requested key
-                if allow_refresh:  # If allowed, do a refresh
-                    self.refresh(base_key, lock=FakeLock(), **opts)
-                    return self.get(base_key, allow_refresh=False,
-                                    lock=FakeLock(), **opts)
-                return default
-            # record was found but may be expired so must check that
-            if self.is_record_expired(record):
-                if allow_refresh:
-                    self.refresh(base_key, lock=FakeLock(), **opts)
-                    return self.get(base_key, allow_refresh=False,
-                                    lock=FakeLock(), **opts)
-                return default
+            if need_pre_get:
+                self._pre_get(full_key, allow_refresh=allow_refresh)
+            record = self._data.get(full_key, None)
+            # If we do not know about the key or the record is expired,
+            # refresh if allowed and then look at the new record.
+            if record is None or self.is_record_expired(record):
+                if not allow_refresh:
+                    return default
+                self.refresh(key, lock=NO_LOCK, **opts)
+                record = self._data.get(full_key, None)
+                if record is None or self.is_record_expired(record):
+                    return default
 
             # Found a non-expired record so return payload
             return record.payload
@@ -1,4 +1,8 @@
 """Module to collect alterantive locks which may be useful.
+
+The locks here sit on the hot path of every cache operation so they
+deliberately do no logging when acquired or released. If you want to
+trace lock activity, wrap a lock in a TracingLock explicitly.
 """
 
 from logging import getLogger  # Use LOGGER and no other logging things in here
@@ -35,23 +39,47 @@ got problem: Unable to get lock after timeout of 2
 ...
 Can reuse lock after it is released
 
+If you pass `reentrant=True`, the lock is based on threading.RLock so the
+thread holding it can enter it again. This is convenient if your own
+sub-class calls something like `self.store` from within `make_value`
+and you do not want to pass `lock=NO_LOCK` around:
+
+>>> rlock = locks.TimeoutLock(timeout=2, reentrant=True)
+>>> with rlock:
+...     with rlock:
+...         print('nested entry is fine for a reentrant lock')
+...
+nested entry is fine for a reentrant lock
+
     """
 
-    def __init__(self, timeout=300, lock=threading.Lock):
+    def __init__(self, timeout=300, lock=None, reentrant=False):
+        """Initializer.
+
+        :param timeout=300:  Seconds to wait to acquire before giving up.
+
+        :param lock=None:    Callable to create the underlying lock. If
+                             None, we use threading.RLock if `reentrant`
+                             is True and threading.Lock otherwise.
+
+        :param reentrant=False:  Whether to use a reentrant lock.
+        """
+        if lock is None:
+            lock = threading.RLock if reentrant else threading.Lock
         self.timeout = timeout
+        self.reentrant = reentrant
         self.lock = lock()
+        self._acquire = self.lock.acquire
+        self._release = self.lock.release
 
     def __enter__(self):
-        LOGGER.debug('Entering TimeoutLock for ox_cache')
-        got_lock = self.lock.acquire(timeout=self.timeout)
-        if got_lock:
+        if self._acquire(timeout=self.timeout):
             return self.lock
         raise Exception('Unable to get lock after timeout of %s' % (
             self.timeout))
 
     def __exit__(self, *exc):
-        self.lock.release()
-        LOGGER.debug('Released TimeoutLock for ox_cache')
+        self._release()
 
 
 class FakeLock:
@@ -62,21 +90,188 @@ class FakeLock:
     operation call another. For example, you may have `refresh` call `store`
     in which case you want `store` not to try to aquire the lock which
     `refresh` has already aquired. This FakeLock class accomplishes that.
+
+    Entering or exiting a FakeLock does nothing so a single instance can
+    be shared freely. Use the module level NO_LOCK instance instead of
+    creating a new FakeLock for each nested call.
     """
 
+    __slots__ = ('lock_name',)
+
     def __init__(self, lock_name='unnamed'):
         self.lock_name = lock_name
 
     def __enter__(self):
-        LOGGER.debug('Faking lock entry for lock named "%s"', self.lock_name)
         return self
 
     def __exit__(self, *exc):
-        LOGGER.debug('Faking lock exit for lock named "%s", exc=%s',
-                     self.lock_name, exc)
         return False
 
 
+NO_LOCK = FakeLock('no_lock')
+
+
+class TracingLock:
+    """Wrapper around a lock which logs every acquire and release.
+
+Tracing is not done by the regular locks since it costs something on
+every cache operation. Wrap the lock for a cache in a TracingLock when
+you need to debug locking behaviour:
+
+>>> from ox_cache import OxCacheBase, locks
+>>> lock = locks.TracingLock(locks.TimeoutLock(), name='demo')
+>>> cache = OxCacheBase(lock=lock)
+>>> cache.store('x', 1)
+>>> cache.get('x')
+1
+    """
+
+    def __init__(self, lock, name='unnamed', logger=None):
+        """Initializer.
+
+        :param lock:         Context manager lock to wrap.
+
+        :param name='unnamed':   Name to show in log messages.
+
+        :param logger=None:  Logger to use. If None, use LOGGER.
+        """
+        self.lock = lock
+        self.name = name
+        self.logger = logger if logger is not None else LOGGER
+
+    def __enter__(self):
+        self.logger.debug('Entering lock "%s"', self.name)
+        result = self.lock.__enter__()
+        self.logger.debug('Acquired lock "%s"', self.name)
+        return result
+
+    def __exit__(self, *exc):
+        result = self.lock.__exit__(*exc)
+        self.logger.debug('Released lock "%s", exc=%s', self.name, exc)
+        return result
+
+
+class ReadWriteLock:
+    """Lock with a shared (reader) side and an exclusive (writer) side.
+
+Using the ReadWriteLock itself as a context manager acquires the exclusive
+side so it can be used anywhere a TimeoutLock is used. The `shared`
+attribute is a context manager for the shared side which any number of
+threads can hold at once as long as no thread holds the exclusive side.
+Writers are preferred: once a thread is waiting for the exclusive side,
+new readers wait until it is done so writers do not starve.
+
+Neither side is reentrant. In particular a thread holding the shared side
+must release it before asking for the exclusive side.
+
+>>> from ox_cache import locks
+>>> lock = locks.ReadWriteLock(timeout=2)
+>>> with lock.shared:
+...     with lock.shared:
+...         print('many readers can share the lock')
+...
+many readers can share the lock
+>>> try:
+...     with lock.shared:
+...         with lock:
+...             print('this should cause a timeout')
+... except Exception as problem:
+...     print('got problem: %s' % str(problem))
+...
+got problem: Unable to get exclusive lock after timeout of 2
+>>> with lock:
+...     print('Can get exclusive lock once readers are gone')
+...
+Can get exclusive lock once readers are gone
+
+Passing a ReadWriteLock as the `lock` to OxCacheBase puts the cache
+in read-write mode where lookups which hit the cache only take the
+shared side. See OxCacheBase.__init__ for details.
+    """
+
+    def __init__(self, timeout=300):
+        """Initializer.
+
+        :param timeout=300:  Seconds to wait to acquire before giving up.
+        """
+        self.timeout = timeout
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+        self.shared = SharedLockSide(self)
+
+    def _can_read(self):
+        return not (self._writer or self._writers_waiting)
+
+    def _can_write(self):
+        return not (self._writer or self._readers)
+
+    def acquire_shared(self):
+        "Acquire the shared side or raise an Exception on timeout."
+        with self._cond:
+            if self._writer or self._writers_waiting:
+                if not self._cond.wait_for(self._can_read, self.timeout):
+                    raise Exception(
+                        'Unable to get shared lock after timeout of %s' % (
+                            self.timeout))
+            self._readers += 1
+
+    def release_shared(self):
+        "Release the shared side."
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_exclusive(self):
+        "Acquire the exclusive side or raise an Exception on timeout."
+        with self._cond:
+            self._writers_waiting += 1
+            try:
+                got_lock = self._cond.wait_for(self._can_write, self.timeout)
+            finally:
+                self._writers_waiting -= 1
+            if not got_lock:
+                self._cond.notify_all()  # wake readers we were blocking
+                raise Exception(
+                    'Unable to get exclusive lock after timeout of %s' % (
+                        self.timeout))
+            self._writer = True
+
+    def release_exclusive(self):
+        "Release the exclusive side."
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    def __enter__(self):
+        self.acquire_exclusive()
+        return self
+
+    def __exit__(self, *exc):
+        self.release_exclusive()
+
+
+class SharedLockSide:
+    """Context manager for the shared side of a ReadWriteLock.
+
+    You generally do not create this yourself; use `rw_lock.shared`.
+    """
+
+    __slots__ = ('rw_lock',)
+
+    def __init__(self, rw_lock):
+        self.rw_lock = rw_lock
+
+    def __enter__(self):
+        self.rw_lock.acquire_shared()
+        return self
+
+    def __exit__(self, *exc):
+        self.rw_lock.release_shared()
+
+
 if __name__ == '__main__':
     doctest.testmod()
     print('Finished Tests')
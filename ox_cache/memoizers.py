@@ -4,10 +4,14 @@
 import doctest
 import inspect
 import functools
+import threading
+import weakref
 
 
 from ox_cache import OxCacheBase, OxCacheFullKey
-from ox_cache.mixins import TimedExpiryMixin, LRUReplacementMixin
+from ox_cache.mixins import (
+    TimedExpiryMixin, LRUReplacementMixin, LazySequenceMixin)
+from ox_cache.normalizers import normalize, BufferFingerprint
 
 
 class OxMemoizer(OxCacheBase):
@@ -68,6 +72,24 @@ memoized: Add two inputs
 ---
 Memoized by OxMemoizer...
 
+    Arguments are passed through `self.normalize_arg` (by default
+    ox_cache.normalizers.normalize) before going into the key. That lets
+    you memoize functions taking unhashable buffers such as bytearrays
+    or numpy arrays since they are replaced by a fingerprint of their
+    contents in the key while the function still gets the original:
+
+>>> @OxMemoizer
+... def total(data, scale=1):
+...     'Sum the data'
+...     print('called total')
+...     return sum(data) * scale
+...
+>>> total(bytearray([1, 2, 3])), total(bytearray([1, 2, 3]))
+called total
+(6, 6)
+>>> total(bytearray([1, 2, 4]), scale=2)  # new contents so new key
+called total
+14
     """
 
     def __init__(self, func, *args, **kwargs):
@@ -89,9 +111,28 @@ Memoized by OxMemoizer...
         """
         self.func = func
         self.argspec = inspect.getfullargspec(func)
+        self._call_opts = threading.local()  # original args for make_value
         super().__init__(*args, **kwargs)
         self._fix_wrapper()
 
+    @classmethod
+    def method(cls, func=None, **kwargs):
+        """Decorator to memoize a method with a separate cache per instance.
+
+        :param func=None:   Method to memoize. If None, return a decorator
+                            so you can do `@TimedMemoizer.method(...)`.
+
+        :param **kwargs:    Passed to cls when making the cache for each
+                            instance (e.g., expiry_seconds or max_size).
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  A MemoizedMethod descriptor (see its docs).
+        """
+        if func is None:
+            return lambda func: MemoizedMethod(func, cls, **kwargs)
+        return MemoizedMethod(func, cls, **kwargs)
+
     def _fix_wrapper(self):
         """Helper function to wrap various things to work as a decorator.
 
@@ -108,11 +149,13 @@ In order to work as a function decorator, we need to do the following:
         orig_mod = getattr(self, '__module__')
         functools.update_wrapper(self, self.func)
         self.__doc__ = '\n'.join([
-            'memoized: ' + self.func.__doc__, '', '---\n',
+            'memoized: ' + (self.func.__doc__ or ''), '', '---\n',
             'Memoized by %s:' % self.__class__.__name__, orig_doc])
         self.__module__ = orig_mod
-        for name in ['ttl', 'expired', 'delete', 'exists']:
-            orig_func = getattr(self, name)
+        for name in ['ttl', 'expired', 'delete', 'exists', 'invalidate']:
+            orig_func = getattr(self, name, None)
+            if orig_func is None:  # method provided only by some mixins
+                continue
             raw_name = 'raw_%s' % name
             setattr(self, raw_name, orig_func)
             decorated = self._make_dec(orig_func, name, raw_name)
@@ -159,7 +202,16 @@ In order to work as a function decorator, we need to do the following:
         "Make the value for a key by calling underling self.func."
 
         if (not opts) and isinstance(key, OxCacheFullKey):
+            pending = getattr(self._call_opts, 'pending', None)
+            if pending is not None and pending[0] == key:
+                return self.func(**pending[1])
             opts = dict(key.opts)
+            if any(isinstance(value, BufferFingerprint)
+                   for value in opts.values()):
+                raise ValueError(
+                    'Cannot call %s for key %s outside of a call since key'
+                    ' only holds normalized arguments' % (
+                        self.func.__name__, key))
             try:  # remove namespace from the opts if it is there
                 opts.pop('namespace')
             except KeyError:
@@ -167,6 +219,29 @@ In order to work as a function decorator, we need to do the following:
 
         return self.func(**opts)
 
+    @staticmethod
+    def normalize_arg(value):
+        """Return hashable version of function argument for use in a key.
+
+        :param value:   Argument to the memoized function.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  Value to put in the key. By default, this is the result
+                  of ox_cache.normalizers.normalize which fingerprints
+                  buffers and arrays and leaves other values unchanged.
+                  Override or register a normalizer for your own types.
+        """
+        return normalize(value)
+
+    def _input_to_opts(self, *args, **kwargs):
+        "Return dict of function inputs by name."
+        opts = dict(kwargs)
+        for num, value in enumerate(args):
+            name = self.argspec.args[num]
+            opts[name] = value
+        return opts
+
     def input_to_full_key(self, *args, **kwargs):
         """Take function inputs and conver to full key.
 
@@ -186,26 +261,152 @@ In order to work as a function decorator, we need to do the following:
                   normalize function inputs to a stable full key. That
                   full key can then be used to reference the function
                   output even if the function is called in different (but
-                  equivalent ways).
+                  equivalent ways). Each argument is also passed through
+                  self.normalize_arg so unhashable buffers can be used.
         """
-        key = self.func.__name__
         if (not kwargs) and (len(args) == 1) and isinstance(
                 args[0], OxCacheFullKey):  # being called with a full key
-            full_key = args[0]             # already so just return it
-        else:
-            opts = dict(kwargs)
-            for num, value in enumerate(args):
-                name = self.argspec.args[num]
-                opts[name] = value
-            full_key = self.make_key(key, **opts)
-
-        return full_key
+            return args[0]                 # already so just return it
+        opts = self._input_to_opts(*args, **kwargs)
+        return self.make_key(self.func.__name__, **{
+            name: self.normalize_arg(value) for name, value in opts.items()})
 
     def __call__(self, *args, **kwargs):
         """In decorator form, this represents a call to the function.
         """
         full_key = self.input_to_full_key(*args, **kwargs)
-        return self.get(full_key)
+        if full_key is (args[0] if args else None):
+            return self.get(full_key)
+        outer = getattr(self._call_opts, 'pending', None)
+        self._call_opts.pending = (
+            full_key, self._input_to_opts(*args, **kwargs))
+        try:
+            return self.get(full_key)
+        finally:
+            self._call_opts.pending = outer
+
+
+class MemoizedMethod:
+    """Descriptor memoizing a method with a separate cache per instance.
+
+Decorating a method with OxMemoizer puts `self` into every key, keeps
+every instance alive as long as the cache and makes all instances share
+one lock. Instead use the `method` class method of OxMemoizer (or any
+sub-class) to get a MemoizedMethod. On first access from an instance,
+it creates a memoizer for that instance which calls the method through
+a weak reference (so `self` is not in the key and the cache does not
+keep the instance alive). Each instance has its own memoizer and lock
+and its entries go away with the instance.
+
+>>> import gc
+>>> from ox_cache import OxMemoizer, LRUReplacementMemoizer
+>>> class Account:
+...     'Example class with memoized methods.'
+...     def __init__(self, rate):
+...         self.rate = rate
+...     @OxMemoizer.method
+...     def interest(self, amount, years=1):
+...         print('computing interest on %s' % amount)
+...         return amount * self.rate * years
+...     @LRUReplacementMemoizer.method(max_size=2)
+...     def fee(self, amount):
+...         'Fee for a transfer.'
+...         return amount * 0.01
+...
+>>> low, high = Account(0.01), Account(0.1)
+>>> low.interest(100), low.interest(amount=100), high.interest(100)
+computing interest on 100
+computing interest on 100
+(1.0, 1.0, 10.0)
+>>> len(low.interest), low.interest.exists(100), low.fee.max_size
+(1, True, 2)
+>>> low.interest.lock is high.interest.lock
+False
+>>> import weakref
+>>> memoizer = weakref.ref(low.interest)
+>>> del low; dummy = gc.collect()  # memoizer goes with instance
+>>> memoizer() is None
+True
+
+Classes with `__slots__` work too as long as instances support weak
+references (include `__weakref__` in the slots); their memoizers are
+kept in a side table until the instance is collected.
+    """
+
+    def __init__(self, func, memoizer_class=OxMemoizer, **kwargs):
+        """Initializer.
+
+        :param func:     Method to memoize.
+
+        :param memoizer_class=OxMemoizer:  Class of memoizer to create
+                                           for each instance.
+
+        :param **kwargs:  Passed to memoizer_class for each instance.
+        """
+        self.func = func
+        self.memoizer_class = memoizer_class
+        self.kwargs = kwargs
+        self.attr = '_ox_memoized_%s' % func.__name__
+        signature = inspect.signature(func)
+        self.signature = signature.replace(  # drop self
+            parameters=list(signature.parameters.values())[1:])
+        self._side = {}  # id(instance): memoizer for instances w/o __dict__
+        self._lock = threading.Lock()
+        functools.update_wrapper(self, func)
+
+    def __set_name__(self, owner, name):
+        self.attr = '_ox_memoized_%s' % name
+
+    def _make_memoizer(self, instance):
+        "Make memoizer for instance calling func with a weak reference."
+        ref, func = weakref.ref(instance), self.func
+
+        def call(*args, **kwargs):
+            "Call the method on the instance (if still alive)."
+            obj = ref()
+            if obj is None:
+                raise ReferenceError('Instance for %s is gone' % (
+                    func.__qualname__))
+            return func(obj, *args, **kwargs)
+        functools.update_wrapper(call, func)
+        call.__signature__ = self.signature
+        del call.__wrapped__  # so inspect.signature does not show self
+        memoizer = self.memoizer_class(call, **self.kwargs)
+        memoizer.instance_ref = ref
+        return memoizer
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        state = getattr(instance, '__dict__', None)
+        if state is not None:
+            memoizer = state.get(self.attr)
+            if memoizer is not None and memoizer.instance_ref() is instance:
+                return memoizer
+        else:
+            memoizer = self._side.get(id(instance))
+            if memoizer is not None and memoizer.instance_ref() is instance:
+                return memoizer
+        with self._lock:  # so concurrent first calls share one memoizer
+            if state is not None:
+                memoizer = state.get(self.attr)
+            else:
+                memoizer = self._side.get(id(instance))
+            if memoizer is None or memoizer.instance_ref() is not instance:
+                try:
+                    memoizer = self._make_memoizer(instance)
+                except TypeError as problem:
+                    raise TypeError(
+                        'Cannot memoize %s for %r (add __weakref__ to '
+                        '__slots__?): %s' % (
+                            self.func.__qualname__, instance, problem))
+                if state is not None:  # copied instances get a new one
+                    state[self.attr] = memoizer
+                else:
+                    self._side[id(instance)] = memoizer
+                    weakref.finalize(instance, self._side.pop,
+                                     id(instance), None)
+        return memoizer
 
 
 class TimedMemoizer(TimedExpiryMixin, OxMemoizer):
@@ -325,6 +526,36 @@ Delete (x=2, y=1)=3 since expired
     """
 
 
+class LazySequenceMemoizer(LazySequenceMixin, OxMemoizer):
+    """Memoizer for functions returning generators or other iterators.
+
+Memoizing a generator function with OxMemoizer caches the generator
+object so only the first caller gets any data. The LazySequenceMemoizer
+combines the LazySequenceMixin with the OxMemoizer so the iterator is
+cached as a LazySequence: the first consumer drives the generator a
+chunk at a time and later or concurrent consumers replay what was
+already produced and continue from there.
+
+>>> from ox_cache import LazySequenceMemoizer
+>>> @LazySequenceMemoizer
+... def squares(count):
+...     'Generate squares.'
+...     print('start squares(%i)' % count)
+...     for i in range(count):
+...         yield i * i
+...
+>>> list(squares(4))
+start squares(4)
+[0, 1, 4, 9]
+>>> list(squares(4)), sum(squares(count=4))
+([0, 1, 4, 9], 14)
+
+You can set `lazy_chunk_size` and `lazy_memory_chunks` on the memoizer
+(see LazySequenceMixin) to control how much is read at a time and how
+much is kept in memory.
+    """
+
+
 if __name__ == '__main__':
     doctest.testmod()
     print('Finished tests')
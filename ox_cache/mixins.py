@@ -1,11 +1,24 @@
 """Mixin classes to change caching behaviour
 """
 
+import sys
+import bisect
+import heapq
 import logging
+import random
+import time
 import datetime
 import collections
+import collections.abc
+import concurrent.futures
+import itertools
+import threading
+import warnings
+import weakref
 
-from ox_cache.locks import FakeLock
+from ox_cache.core import fresh_exception
+from ox_cache.locks import NO_LOCK
+from ox_cache.sequences import LazySequence
 
 
 class RefreshDictMixin:
@@ -38,8 +51,38 @@ Refresh trigged for key=2
 >>> cache.get(50) # This call will trigger a refresh since not in original dict
 Refresh trigged for key=50
 '505'
+
+For very large refreshes, override `make_dict_chunks` instead to yield
+the data a chunk at a time. Each chunk is stored with a single ttl_info
+while holding the lock only for that chunk so peak memory is bounded by
+the chunk size rather than the size of the whole refresh. Set the
+`prefetch_chunks` attribute to True to produce the next chunk on a
+background thread while the current one is stored:
+
+>>> import itertools
+>>> class StreamCache(RefreshDictMixin, OxCacheBase):
+...     'Example cache which streams rows in chunks.'
+...     prefetch_chunks = True
+...     def make_dict_chunks(self, key, **opts):
+...         rows = ((i, 'row %i' % i) for i in range(10))  # e.g., from file
+...         while True:
+...             chunk = list(itertools.islice(rows, 4))
+...             if not chunk:
+...                 break
+...             print('parsed %i rows' % len(chunk))
+...             yield chunk
+...
+>>> cache = StreamCache()
+>>> cache.refresh(3)
+parsed 4 rows
+parsed 4 rows
+parsed 2 rows
+>>> len(cache), cache.get(9)
+(10, 'row 9')
 """
 
+    prefetch_chunks = False
+
     def make_dict(self, key, **opts):
         """Make a dictionary of keys and values to store in the cache.
 
@@ -66,8 +109,30 @@ Refresh trigged for key=50
         """
         raise NotImplementedError
 
+    def make_dict_chunks(self, key, **opts):
+        """Generate chunks of (key, value) pairs to refresh the cache with.
+
+        :param key, **opts:  As for make_dict.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  Iterable of chunks where each chunk is either a dict or
+                  an iterable of (key, value) pairs. Together the chunks
+                  **MUST** contain `key`.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  By default this returns the result of make_dict as a
+                  single chunk. Override this instead of make_dict for
+                  large refreshes (e.g., parsing a big file a few
+                  thousand rows at a time) so that only a chunk at a
+                  time needs to be in memory instead of a complete dict
+                  alongside the existing cache.
+        """
+        yield self.make_dict(key, **opts)
+
     def refresh(self, key, lock=None, **opts):
-        """Refresh the cache by calling a make_dict method.
+        """Refresh the cache by calling make_dict_chunks (or make_dict).
 
         :param key:     key for object which triggered the refresh request.
 
@@ -80,23 +145,106 @@ Refresh trigged for key=50
 
         ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
 
-        PURPOSE:  This will call `self.make_dict(key, **opts)` to get the
-                  refresh data while providing other conveniences such as
-                  locking for thread safety, calling self.create_ttl to setup
-                  time-to-live properly, calling self.store, etc.
+        PURPOSE:  This will call `self.make_dict_chunks(key, **opts)` to
+                  get the refresh data while providing other conveniences
+                  such as locking for thread safety, calling
+                  self.create_ttl to setup time-to-live properly (once
+                  per chunk), calling self.store, etc.
+
+                  We only hold the lock while storing each chunk so
+                  readers can get in between chunks. A refresh triggered
+                  by a miss in `get` already holds the lock for the
+                  whole refresh though, so call `refresh` directly (e.g.,
+                  on a schedule) to get that benefit. If
+                  self.prefetch_chunks is True, the next chunk is
+                  produced on another thread while we store the current
+                  one.
 
         """
         logging.debug('Calling %s in %s', 'refresh', self.__class__.__name__)
         if lock is None:
             lock = self.lock
-        with lock:
-            my_dict = self.make_dict(key, **opts)
-            assert key in my_dict, (
-                'Base key "%s" not in result of make_dict!' % str(key))
-            for base_key, value in my_dict.items():
-                ttl_info = self.create_ttl(base_key, **opts)
-                self.store(base_key, value, ttl_info,
-                           lock=FakeLock(), **opts)
+        chunks = self.make_dict_chunks(key, **opts)
+        if self.prefetch_chunks:
+            chunks = prefetch(chunks)
+        found_key = False
+        for chunk in chunks:
+            if isinstance(chunk, dict):
+                chunk = chunk.items()
+            with lock:
+                ttl_info = self.create_ttl(key, **opts)
+                for base_key, value in chunk:
+                    found_key = found_key or base_key == key
+                    self.store(base_key, value, ttl_info,
+                               lock=NO_LOCK, **opts)
+        assert found_key, (
+            'Base key "%s" not in result of make_dict!' % str(key))
+
+
+def prefetch(iterable, depth=1):
+    """Iterate over iterable using a background thread to work ahead.
+
+    :param iterable:   Iterable to consume in a background thread.
+
+    :param depth=1:    How many items the thread may produce before we
+                       consume them (so at most depth+2 items are alive).
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  Generator yielding the items of iterable. Exceptions in the
+              background thread are re-raised here.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    PURPOSE:  Overlap producing the next item (e.g., parsing the next
+              chunk of a file) with processing the current one.
+
+>>> from ox_cache.mixins import prefetch
+>>> list(prefetch(iter(range(5))))
+[0, 1, 2, 3, 4]
+>>> def broken():
+...     yield 1
+...     raise ValueError('bad chunk')
+...
+>>> list(prefetch(broken()))
+Traceback (most recent call last):
+...
+ValueError: bad chunk
+    """
+    queue, stop, done = collections.deque(), threading.Event(), object()
+    ready = threading.Semaphore(0)    # items available in queue
+    space = threading.Semaphore(depth)  # room left in queue
+
+    def produce():
+        "Put items of iterable in queue until done or stopped."
+        try:
+            for item in iterable:
+                while not space.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                queue.append((item, None))
+                ready.release()
+            queue.append((done, None))
+        except Exception as problem:  # pylint: disable=broad-except
+            queue.append((done, problem))
+        ready.release()
+
+    thread = threading.Thread(target=produce, daemon=True,
+                              name='ox_cache_prefetch')
+    thread.start()
+    try:
+        while True:
+            ready.acquire()
+            item, problem = queue.popleft()
+            if item is done:
+                if problem is not None:
+                    raise problem
+                return
+            space.release()
+            yield item
+    finally:
+        stop.set()
+        thread.join()
 
 
 class TimedExpiryMixin:
@@ -155,12 +303,867 @@ Calling refresh for key="test"
         PURPOSE:  Compute the time-to-live as how many seconds remain before
                   the record is past `self.expiry_seconds` old. This assumes
                   that `record.ttl_info` was generated by the default
-                  `OxCacheBase.create_ttl` method.
+                  `OxCacheBase.create_ttl` method (i.e., is a float from
+                  time.time()). A datetime from datetime.utcnow() as used
+                  by versions before 2.0 is still accepted but is
+                  deprecated and issues a DeprecationWarning.
+
+        """
+        try:
+            age = time.time() - record.ttl_info
+        except TypeError:  # older style datetime ttl_info
+            warnings.warn(
+                'datetime ttl_info is deprecated; create_ttl should return'
+                ' a float from time.time()', DeprecationWarning,
+                stacklevel=2)
+            age = (datetime.datetime.utcnow() -
+                   record.ttl_info).total_seconds()
+        return max(0, self.expiry_seconds - age)
+
+
+class AdaptiveTTL:
+    """ttl_info used by AdaptiveTTLMixin.
+
+    The fields are:
+
+      - created:  Value of time.time() when the record was stored.
+      - ttl:      Seconds the record lives for.
+      - digest:   Result of value_digest for the payload (or None).
+    """
+
+    __slots__ = ('created', 'ttl', 'digest')
+
+    def __init__(self, created, ttl, digest=None):
+        self.created = created
+        self.ttl = ttl
+        self.digest = digest
+
+    def __repr__(self):
+        return '%s(created=%r, ttl=%r, digest=%r)' % (
+            self.__class__.__name__, self.created, self.ttl, self.digest)
+
+
+class AdaptiveTTLMixin:
+    """Mixin to adapt the time to live of each key to how often it changes.
+
+With TimedExpiryMixin every key lives for the same `expiry_seconds` so
+keys which rarely change get refreshed far too often while volatile keys
+are served stale. With the AdaptiveTTLMixin, each refresh compares the
+new value from `make_value` with the old payload. If it is unchanged, the
+time to live for that key is multiplied by `ttl_growth`; otherwise it is
+multiplied by `ttl_shrink`. Either way it stays between `min_ttl` and
+`max_ttl`. The current time to live is kept in the AdaptiveTTL object
+used as ttl_info for the record.
+
+Values are compared with == unless you override `value_digest` to return
+something (e.g., a hash of a serialized value) in which case we compare
+the digests instead (useful for big payloads or ones changed in place).
+Values which cannot be compared with == (e.g., numpy arrays) count as
+changed.
+
+The mixin chains to `super().refresh` (and `refresh_outside_lock`) and
+adapts the time to live in `_pre_store` for stores made while refreshing
+so it combines with other mixins overriding `refresh`.
+
+>>> from ox_cache import OxCacheBase, AdaptiveTTLMixin
+>>> class Quotes(AdaptiveTTLMixin, OxCacheBase):
+...     'Cache of prices where some change and some do not.'
+...     ticks = 0
+...     def make_value(self, key, **opts):
+...         return self.ticks if key == 'volatile' else 'stable'
+...
+>>> cache = Quotes(initial_ttl=10, min_ttl=2, max_ttl=60)
+>>> for tick in range(4):
+...     cache.ticks = tick
+...     for key in ['volatile', 'stable']:
+...         cache.refresh(key)
+...
+>>> [cache.get_record(cache.make_key(key)).ttl_info.ttl
+...  for key in ['volatile', 'stable']]
+[2, 60]
+>>> 58 < cache.ttl('stable') <= 60
+True
+
+A plain `store` keeps the time to live learned so far for the key:
+
+>>> cache.store('stable', 'replaced')
+>>> cache.get_record(cache.make_key('stable')).ttl_info.ttl
+60
+    """
+
+    def __init__(self, *args, initial_ttl=60.0, min_ttl=1.0,
+                 max_ttl=86400.0, ttl_growth=2.0, ttl_shrink=0.5,
+                 **kwargs):
+        """Initializer for AdaptiveTTLMixin.
+
+        :param initial_ttl=60.0:  Time to live in seconds for new keys.
+
+        :param min_ttl=1.0:       Smallest time to live for any key.
+
+        :param max_ttl=86400.0:   Largest time to live for any key.
+
+        :param ttl_growth=2.0:    Factor to multiply the time to live by
+                                  when a refresh finds an unchanged value.
+
+        :param ttl_shrink=0.5:    Factor to multiply the time to live by
+                                  when a refresh finds a changed value.
+
+        Otherwise *args, **kwargs are passed along to super().__init__.
+        """
+        self.initial_ttl = initial_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.ttl_growth = ttl_growth
+        self.ttl_shrink = ttl_shrink
+        self._adapting = threading.local()  # set while refreshing
+        super().__init__(*args, **kwargs)
+
+    def value_digest(self, value):
+        """Return digest to compare values or None to compare with ==.
+
+        :param value:   Value from make_value.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  By default None so values are compared with ==.
+                  Sub-classes can return something hashable and small
+                  (e.g., hashlib digest of a serialized value) instead.
+        """
+        dummy = self, value
+        return None
+
+    def _adaptive_record(self, full_key):
+        "Return current record of full_key if it has an AdaptiveTTL."
+        record = self._data.get(full_key)
+        if record is None or record.ttl_info.__class__ is not AdaptiveTTL:
+            return None
+        return record
+
+    def create_ttl(self, key, **opts):
+        "Create AdaptiveTTL keeping the time to live learned for the key."
+        record = self._adaptive_record(self.make_key(key, **opts))
+        return AdaptiveTTL(time.time(), self.initial_ttl if record is None
+                           else record.ttl_info.ttl)
+
+    def next_ttl(self, record, value, digest):
+        """Compute time to live for new value given old record.
+
+        :param record:   Old record (with AdaptiveTTL ttl_info) or None.
+
+        :param value:    New value from make_value.
+
+        :param digest:   Result of self.value_digest(value).
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  Time to live in seconds for the new value.
+        """
+        if record is None:
+            return self.initial_ttl
+        old = record.ttl_info
+        if digest is None:
+            try:
+                changed = bool(record.payload != value)
+            except (ValueError, TypeError):  # e.g., numpy arrays
+                changed = True
+        else:
+            changed = old.digest != digest
+        factor = self.ttl_shrink if changed else self.ttl_growth
+        return min(self.max_ttl, max(self.min_ttl, old.ttl * factor))
+
+    def _adaptively(self, method, *args, **kwargs):
+        "Call method adapting the time to live of the stores it makes."
+        outer = getattr(self._adapting, 'active', False)
+        self._adapting.active = True
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self._adapting.active = outer
+
+    def refresh(self, key, lock=None, **opts):
+        """Refresh key adapting its time to live to whether it changed.
+
+        See OxCacheBase.refresh for arguments.
+        """
+        return self._adaptively(super().refresh, key, lock=lock, **opts)
+
+    def refresh_outside_lock(self, key, lock=None, **opts):
+        "Like refresh but see OxCacheBase.refresh_outside_lock."
+        return self._adaptively(super().refresh_outside_lock, key,
+                                lock=lock, **opts)
+
+    def _pre_store(self, key, value, ttl_info, **opts):
+        "Adapt time to live of new AdaptiveTTL when refreshing."
+        if ttl_info.__class__ is AdaptiveTTL and getattr(
+                self._adapting, 'active', False):
+            full_key = self.make_key(key, **opts) if opts else key
+            ttl_info.digest = self.value_digest(value)
+            ttl_info.ttl = self.next_ttl(self._adaptive_record(full_key),
+                                         value, ttl_info.digest)
+        super()._pre_store(key, value, ttl_info, **opts)
+
+    def ttl_for_record(self, record):
+        "Use AdaptiveTTL if we have it and otherwise use super()."
+        info = record.ttl_info
+        if info.__class__ is AdaptiveTTL:
+            return max(0, info.ttl - (time.time() - info.created))
+        return super().ttl_for_record(record)
+
+
+class RefreshAheadMixin:
+    """Mixin to refresh popular keys in the background before they expire.
+
+Use this along with TimedExpiryMixin (list RefreshAheadMixin first in
+your bases). We count gets per key since it was last stored (including
+a get which caused the store) in an `ahead_hits` slot on the record (see
+`item_slots` in OxCacheBase) so counts go away with their records. When
+a get finds a key with at least `refresh_ahead_hits` such gets whose time
+to live has dropped below `refresh_ahead_fraction * self.expiry_seconds`,
+we refresh it on a background thread pool of `refresh_ahead_workers`
+threads through `refresh_outside_lock` so popular keys never expire while
+readers keep getting the current value. Keys that are not hit that
+often are left to expire normally. At most one refresh per key is in
+flight at a time, at most `refresh_ahead_pending` refreshes wait for the
+pool and, if `refresh_ahead_rate` is not None, we start at most that
+many refreshes per second (with bursts of up to one second's worth) so
+the backend is not overwhelmed.
+
+>>> import time
+>>> from ox_cache import OxCacheBase, TimedExpiryMixin, RefreshAheadMixin
+>>> class AheadCache(RefreshAheadMixin, TimedExpiryMixin, OxCacheBase):
+...     'Cache which refreshes popular keys ahead of expiry.'
+...     def make_value(self, key, **opts):
+...         print('make %s' % key)
+...         return key
+...
+>>> cache = AheadCache(expiry_seconds=1, refresh_ahead_fraction=0.5,
+...                    refresh_ahead_hits=3)
+>>> cache.get('hot'), cache.get('cold')
+make hot
+make cold
+('hot', 'cold')
+>>> time.sleep(0.6)  # now inside the refresh ahead window
+>>> cache.get('hot'), cache.get('hot'), cache.get('cold')
+make hot
+('hot', 'hot', 'cold')
+>>> cache.shutdown_refresh_ahead()  # wait for background refreshes
+>>> cache.ttl('hot') > 0.7, cache.ttl('cold') < 0.5
+(True, True)
+    """
+
+    def __init__(self, *args, refresh_ahead_fraction=0.2,
+                 refresh_ahead_hits=3, refresh_ahead_workers=2,
+                 refresh_ahead_pending=64, refresh_ahead_rate=None,
+                 **kwargs):
+        """Initializer for RefreshAheadMixin.
+
+        :param refresh_ahead_fraction=0.2:  Refresh popular keys once their
+                                            ttl is below this fraction of
+                                            self.expiry_seconds.
+
+        :param refresh_ahead_hits=3:  Gets since the last store for a key
+                                      to count as popular.
+
+        :param refresh_ahead_workers=2:  Threads in the refresh pool.
+
+        :param refresh_ahead_pending=64:  Maximum refreshes in flight or
+                                          waiting for the pool.
+
+        :param refresh_ahead_rate=None:  Maximum refreshes started per
+                                         second (None means no limit).
+
+        Otherwise *args, **kwargs are passed along to super().__init__.
+        """
+        self.refresh_ahead_fraction = refresh_ahead_fraction
+        self.refresh_ahead_hits = refresh_ahead_hits
+        self.refresh_ahead_workers = refresh_ahead_workers
+        self.refresh_ahead_pending = refresh_ahead_pending
+        self.refresh_ahead_rate = refresh_ahead_rate
+        self._in_flight = set()  # full keys being refreshed ahead
+        self._ahead_lock = threading.Lock()
+        self._executor = None
+        self._rate_tokens = max(1.0, refresh_ahead_rate or 0)  # allow a
+        self._rate_time = time.monotonic()  # burst of one second's worth
+        super().__init__(*args, **kwargs)
+
+    item_slots = {'ahead_hits': 0}
+
+    def get(self, key, allow_refresh=True, lock=None, default=None, **opts):
+        """Get value for key and schedule a refresh ahead if appropriate.
+
+        See OxCacheBase.get for arguments. We count the get on the record
+        without a lock since a single dict lookup is atomic and a count
+        lost to a concurrent get only delays a refresh ahead.
+        """
+        result = super().get(key, allow_refresh=allow_refresh, lock=lock,
+                             default=default, **opts)
+        if allow_refresh:
+            full_key = self.make_key(key, **opts)
+            record = self._data.get(full_key)
+            if record is not None:
+                record.ahead_hits += 1
+                if record.ahead_hits >= self.refresh_ahead_hits and (
+                        full_key not in self._in_flight) and (
+                            self.ttl_for_record(record) <
+                            self.refresh_ahead_fraction *
+                            self.expiry_seconds):
+                    self._schedule_refresh_ahead(full_key, key, opts)
+        return result
+
+    def _take_rate_token(self):
+        "Return True if rate limit allows a refresh now (hold _ahead_lock)."
+        if self.refresh_ahead_rate is None:
+            return True
+        now = time.monotonic()
+        self._rate_tokens = min(
+            self._rate_tokens + (now - self._rate_time) *
+            self.refresh_ahead_rate, max(1.0, self.refresh_ahead_rate))
+        self._rate_time = now
+        if self._rate_tokens < 1:
+            return False
+        self._rate_tokens -= 1
+        return True
+
+    def _schedule_refresh_ahead(self, full_key, key, opts):
+        "Submit a background refresh for key unless limits say not to."
+        with self._ahead_lock:
+            if full_key in self._in_flight or len(self._in_flight) >= (
+                    self.refresh_ahead_pending) or not (
+                        self._take_rate_token()):
+                return
+            self._in_flight.add(full_key)
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    self.refresh_ahead_workers,
+                    thread_name_prefix='ox_cache_refresh_ahead')
+            self._executor.submit(
+                self._refresh_ahead, full_key, key, opts)
+
+    def _refresh_ahead(self, full_key, key, opts):
+        "Refresh key in a background thread via refresh_outside_lock."
+        try:
+            self.refresh_outside_lock(key, **opts)
+        except Exception as problem:  # pylint: disable=broad-except
+            logging.warning('Refresh ahead of %s failed: %s',
+                            full_key, problem)
+        finally:
+            with self._ahead_lock:
+                self._in_flight.discard(full_key)
+
+    def shutdown_refresh_ahead(self, wait=True):
+        """Shut down the background pool (a new one starts when needed).
+
+        :param wait=True:  Whether to wait for pending refreshes to finish.
+        """
+        with self._ahead_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+class _NotFound:
+    "Type of the NOT_FOUND sentinel."
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'NOT_FOUND'
+
+    def __reduce__(self):
+        return 'NOT_FOUND'
+
+
+NOT_FOUND = _NotFound()  # make_value can return this to mean no such key
+
+
+class NegativeResult:
+    """Payload stored by NegativeCachingMixin for a failure or missing key.
 
+    The fields are:
+
+      - exception:  Exception raised by make_value (None for NOT_FOUND).
+      - failures:   Number of failures in a row for the key.
+      - expires:    Value of time.time() when the entry expires.
+    """
+
+    __slots__ = ('exception', 'failures', 'expires')
+
+    def __init__(self, exception, failures, expires):
+        self.exception = exception
+        self.failures = failures
+        self.expires = expires
+
+    def __repr__(self):
+        return '%s(exception=%r, failures=%r, expires=%r)' % (
+            self.__class__.__name__, self.exception, self.failures,
+            self.expires)
+
+
+class NegativeCachingMixin:
+    """Mixin to cache exceptions and not-found results for a short time.
+
+Normally if `make_value` raises nothing is stored so every `get` for
+that key calls `make_value` again which can hammer a failing backend.
+With the NegativeCachingMixin, an exception of a type in `cache_errors`
+is stored as a NegativeResult for `error_ttl` seconds, doubling for each
+further failure in a row (up to `max_error_ttl`). While it is cached,
+`get` raises a copy of the stored exception (see core.fresh_exception)
+without calling `make_value`. By default only OSError (which includes
+ConnectionError and TimeoutError) is cached; set `cache_errors` to the
+exception types worth caching for your backend.
+Since `get` refreshes while holding the lock, threads waiting on the
+same key all see the cached error instead of each retrying.
+
+If `make_value` returns NOT_FOUND (or anything for which `is_not_found`
+is True), we cache that for `not_found_ttl` seconds and `get` returns
+its `default` argument.
+
+>>> from ox_cache import OxCacheBase, NegativeCachingMixin, NOT_FOUND
+>>> class Backend(NegativeCachingMixin, OxCacheBase):
+...     'Cache for a flaky backend.'
+...     calls = 0
+...     def make_value(self, key, **opts):
+...         self.calls += 1
+...         if key == 'missing':
+...             return NOT_FOUND
+...         raise ConnectionError('backend down')
+...
+>>> cache = Backend(error_ttl=5, max_error_ttl=12, not_found_ttl=30)
+>>> for attempt in range(3):
+...     try:
+...         cache.get('key')
+...     except ConnectionError as problem:
+...         print(problem)
+...
+backend down
+backend down
+backend down
+>>> cache.calls  # only the first get called make_value
+1
+>>> cache.get('missing', default='?'), cache.get('missing'), cache.calls
+('?', None, 2)
+>>> round(cache.ttl('missing'))
+30
+
+Each further failure in a row doubles the time we cache the error:
+
+>>> for attempt in range(3):
+...     cache.refresh('key')
+...
+>>> record = cache.get_record(cache.make_key('key'))
+>>> record.payload.failures, round(cache.ttl_for_record(record))
+(4, 12)
+    """
+
+    cache_errors = (OSError,)
+
+    def __init__(self, *args, error_ttl=1.0, max_error_ttl=60.0,
+                 not_found_ttl=None, **kwargs):
+        """Initializer for NegativeCachingMixin.
+
+        :param error_ttl=1.0:  Seconds to cache the first failure for a key.
+
+        :param max_error_ttl=60.0:  Maximum seconds to cache a failure.
+
+        :param not_found_ttl=None:  Seconds to cache NOT_FOUND results. If
+                                    None, use error_ttl.
+
+        Otherwise *args, **kwargs are passed along to super().__init__.
+        """
+        self.error_ttl = error_ttl
+        self.max_error_ttl = max_error_ttl
+        self.not_found_ttl = (
+            error_ttl if not_found_ttl is None else not_found_ttl)
+        super().__init__(*args, **kwargs)
+
+    def is_not_found(self, value):
+        "Return True if value from make_value means the key does not exist."
+        dummy = self
+        return value is NOT_FOUND
+
+    def ttl_for_record(self, record):
+        "Use expiry of NegativeResult payloads and super() otherwise."
+        payload = record.payload
+        if payload.__class__ is NegativeResult:
+            return max(0, payload.expires - time.time())
+        return super().ttl_for_record(record)
+
+    def store(self, key, value, ttl_info=None, lock=None, **opts):
+        "Store value converting not found results into a NegativeResult."
+        if value.__class__ is not NegativeResult and self.is_not_found(value):
+            value = NegativeResult(None, 0, time.time() + self.not_found_ttl)
+        return super().store(key, value, ttl_info, lock=lock, **opts)
+
+    def refresh(self, key, lock=None, **opts):
+        """Refresh key but cache an exception from make_value with backoff.
+
+        See OxCacheBase.refresh for arguments. If the refresh raises an
+        exception in self.cache_errors, we store it as a NegativeResult
+        instead of raising so the next `get` raises it from the cache.
+        """
+        if lock is None:
+            lock = self.lock
+        with lock:
+            try:
+                return super().refresh(key, lock=NO_LOCK, **opts)
+            except self.cache_errors as problem:
+                full_key = self.make_key(key, **opts)
+                old = self._data.get(full_key)
+                failures = 1
+                if old is not None and (
+                        old.payload.__class__ is NegativeResult) and (
+                            old.payload.exception is not None):
+                    failures = old.payload.failures + 1
+                backoff = min(self.error_ttl * 2 ** (failures - 1),
+                              self.max_error_ttl)
+                logging.info('Caching %r for %s for %.3g seconds',
+                             problem, full_key, backoff)
+                self.store(full_key, NegativeResult(
+                    problem.with_traceback(None), failures,
+                    time.time() + backoff),
+                           lock=NO_LOCK)
+        return None
+
+    def get(self, key, allow_refresh=True, lock=None, default=None, **opts):
+        """Get value for key raising cached errors.
+
+        See OxCacheBase.get for arguments. If the cache holds an unexpired
+        exception for key, we raise it. If it holds a not found result,
+        we return default.
+        """
+        result = super().get(key, allow_refresh=allow_refresh, lock=lock,
+                             default=default, **opts)
+        if result.__class__ is NegativeResult:
+            if result.exception is None:
+                return default
+            raise fresh_exception(result.exception)
+        return result
+
+
+class ThreadLocalL0Mixin:
+    """Mixin adding a tiny per-thread cache of hits in front of the cache.
+
+Even an uncontended lock costs something on every `get`. With the
+ThreadLocalL0Mixin (list it first in your bases), each thread keeps a
+small direct-mapped array of `l0_size` recent results and serves
+repeated hits from it without taking any lock.
+
+Entries are invalidated by an epoch counter: every `store`, delete
+(including evictions) and `reset` bumps `self.generation` once it has
+changed the data and an L0 entry is only used if the generation is the
+same as when it was filled. We
+also remember when the record expires (from `ttl_for_record`) so expired
+entries are not served. No coordination between threads is needed.
+
+>>> import threading
+>>> from ox_cache import OxCacheBase, ThreadLocalL0Mixin
+>>> class CountingLock:
+...     'Lock which counts how often it is taken.'
+...     def __init__(self):
+...         self.lock, self.count = threading.RLock(), 0
+...     def __enter__(self):
+...         self.count += 1
+...         return self.lock.__enter__()
+...     def __exit__(self, *exc):
+...         return self.lock.__exit__(*exc)
+...
+>>> class HotCache(ThreadLocalL0Mixin, OxCacheBase):
+...     'Cache with a per-thread L0.'
+...     def make_value(self, key, **opts):
+...         return key * 2
+...
+>>> cache = HotCache(lock=CountingLock(), l0_size=8)
+>>> cache.get(3), cache.lock.count
+(6, 1)
+>>> [cache.get(3) for dummy in range(5)], cache.lock.count
+([6, 6, 6, 6, 6], 1)
+>>> cache.store(3, 'new')  # bumps generation so L0 entry is not used
+>>> cache.get(3), cache.lock.count
+('new', 3)
+
+Since L0 hits never reach the underlying cache, hooks like `_pre_get`
+do not see them. With a replacement policy such as LRUReplacementMixin,
+keys hit mostly from L0 look less recently used than they are. Any
+store or delete invalidates every L0 entry, so the L0 helps most when
+reads far outnumber writes.
+    """
+
+    def __init__(self, *args, l0_size=64, **kwargs):
+        """Initializer for ThreadLocalL0Mixin.
+
+        :param l0_size=64:  Number of slots in the L0 of each thread.
+
+        Otherwise *args, **kwargs are passed along to super().__init__.
+        """
+        self.l0_size = l0_size
+        self.generation = 0
+        self._l0 = threading.local()
+        super().__init__(*args, **kwargs)
+
+    def _l0_slots(self):
+        "Return list of L0 slots for the current thread."
+        try:
+            return self._l0.slots
+        except AttributeError:
+            slots = self._l0.slots = [None] * self.l0_size
+            return slots
+
+    def get(self, key, allow_refresh=True, lock=None, default=None, **opts):
+        """Get value for key from the L0 of this thread or from super().
+
+        See OxCacheBase.get for arguments. We only use the L0 if lock is
+        None (i.e., the caller is not already holding a lock).
+        """
+        if lock is not None:
+            return super().get(key, allow_refresh=allow_refresh, lock=lock,
+                               default=default, **opts)
+        full_key = self.make_key(key, **opts)
+        slots = self._l0_slots()
+        index = hash(full_key) % self.l0_size
+        entry = slots[index]
+        if entry is not None and entry[0] == self.generation and (
+                entry[1] == full_key) and time.time() < entry[3]:
+            return entry[2]
+        result = super().get(key, allow_refresh=allow_refresh,
+                             default=default, **opts)
+        # Every change to self._data bumps generation after it is done so
+        # if generation is the same before and after we look at the
+        # record, result was current while generation had that value.
+        generation = self.generation
+        record = self._data.get(full_key)
+        if record is not None and record.payload is result and (
+                generation == self.generation):
+            slots[index] = (generation, full_key, result, time.time() +
+                            self.ttl_for_record(record))
+        return result
+
+    def invalidate_l0(self):
+        "Make every L0 entry in every thread stale."
+        self.generation += 1
+
+    def _post_store(self, key, value, ttl_info, **opts):
+        "Bump generation so L0 entries are refilled."
+        self.generation += 1
+        super()._post_store(key, value, ttl_info, **opts)
+
+    def _delete_full_key(self, full_key, lock=None):
+        "Delete and then bump generation so L0 entries are refilled."
+        if lock is None:
+            lock = self.lock
+        with lock:
+            super()._delete_full_key(full_key, lock=NO_LOCK)
+            self.generation += 1
+
+    def _post_reset(self):
+        "Bump generation so L0 entries are refilled."
+        self.generation += 1
+        super()._post_reset()
+
+
+class Generation:
+    """Generation counter for a namespace used by GenerationalMixin.
+
+    The fields are:
+
+      - value:  Bumped to invalidate everything in the namespace.
+      - epoch:  Cache generation when value was last brought up to date.
+      - count:  Number of records in the cache stamped with us.
+    """
+
+    __slots__ = ('value', 'epoch', 'count')
+
+    def __init__(self, value=0, epoch=0, count=0):
+        self.value = value
+        self.epoch = epoch
+        self.count = count
+
+    def __repr__(self):
+        return '%s(value=%r, epoch=%r)' % (
+            self.__class__.__name__, self.value, self.epoch)
+
+
+class GenerationalMixin:
+    """Mixin to invalidate a whole cache or namespace in O(1).
+
+The `reset` method replaces all the data and NamespaceIndexMixin.reset
+deletes each key in a namespace. With large (or, in the future, external)
+storage that work can be too slow to do while holding the lock. With the
+GenerationalMixin, every record is stamped with the generation of its
+namespace when stored. Calling `bump_generation(namespace)` (or
+`bump_generation()` for the whole cache) just increments a counter so
+all older records count as expired: `get` refreshes them, while `clean`
+or a replacement policy reclaims them later.
+
+>>> from ox_cache import OxCacheBase, GenerationalMixin
+>>> class Versioned(GenerationalMixin, OxCacheBase):
+...     'Cache where namespaces can be invalidated in O(1).'
+...     version = 1
+...     def make_value(self, key, **opts):
+...         return '%s v%i' % (key, self.version)
+...
+>>> cache = Versioned()
+>>> cache.get('a', namespace='users'), cache.get('b', namespace='posts')
+('a v1', 'b v1')
+>>> cache.version = 2
+>>> cache.bump_generation('users')
+>>> cache.expired('a', namespace='users'), len(cache)  # still stored
+(True, 2)
+>>> cache.get('a', namespace='users'), cache.get('b', namespace='posts')
+('a v2', 'b v1')
+>>> cache.bump_generation()  # everything
+>>> cache.expired('b', namespace='posts'), cache.exists('b', namespace='posts')
+(True, True)
+>>> len(cache.clean())  # reclaim stale records
+2
+>>> len(cache)
+0
+
+Records get `generation` and `stamp` slots through `item_slots` (so this
+mixin combines with others like SampledLRUMixin). Each Generation counts
+the records stamped with it and is dropped once its namespace is empty
+so invalidating many short lived namespaces does not leak memory.
+    """
+
+    item_slots = {'generation': None, 'stamp': 0}
+
+    def __init__(self, *args, **kwargs):
+        self.cache_generation = 0
+        self._generations = {}  # namespace: Generation
+        super().__init__(*args, **kwargs)
+
+    def _generation_for(self, namespace):
+        "Return up to date Generation for namespace (requires lock)."
+        generation = self._generations.get(namespace)
+        if generation is None:
+            generation = self._generations[namespace] = Generation(
+                0, self.cache_generation)
+        elif generation.epoch != self.cache_generation:
+            generation.value += 1  # so records from older epochs are stale
+            generation.epoch = self.cache_generation
+        return generation
+
+    def bump_generation(self, namespace=None, lock=None):
+        """Invalidate everything in namespace (or whole cache) in O(1).
+
+        :param namespace=None:  Namespace to invalidate. If None,
+                                invalidate every namespace.
+
+        :param lock=None:   Optional lock to use. If None, use self.lock.
         """
-        now = datetime.datetime.utcnow()
-        return max(0, self.expiry_seconds -
-                   (now - record.ttl_info).total_seconds())
+        if lock is None:
+            lock = self.lock
+        with lock:
+            if namespace is None:
+                self.cache_generation += 1
+            elif namespace in self._generations:  # else nothing to bump
+                self._generation_for(namespace).value += 1
+            invalidate_l0 = getattr(self, 'invalidate_l0', None)
+            if invalidate_l0 is not None:  # see ThreadLocalL0Mixin
+                invalidate_l0()
+
+    def _release_generation(self, full_key):
+        "Stop counting record for full_key (if any) in its Generation."
+        record = self._data.get(full_key)
+        generation = None if record is None else record.generation
+        if generation is not None:
+            record.generation = None
+            generation.count -= 1
+            namespace = full_key.namespace
+            if not generation.count and (
+                    self._generations.get(namespace) is generation):
+                del self._generations[namespace]
+
+    def _pre_store(self, key, value, ttl_info, **opts):
+        "Release the generation of a record we are about to replace."
+        super()._pre_store(key, value, ttl_info, **opts)  # may evict it
+        self._release_generation(
+            self.make_key(key, **opts) if opts else key)
+
+    def _post_store(self, key, value, ttl_info, **opts):
+        "Stamp the new record with the generation of its namespace."
+        full_key = self.make_key(key, **opts) if opts else key
+        record = self._data[full_key]
+        record.generation = self._generation_for(full_key.namespace)
+        record.generation.count += 1
+        record.stamp = record.generation.value
+        super()._post_store(key, value, ttl_info, **opts)
+
+    def _pre_delete_full_key(self, full_key):
+        "Release the generation of the record being deleted."
+        self._release_generation(full_key)
+        super()._pre_delete_full_key(full_key)
+
+    def _post_reset(self):
+        "Forget generations of namespaces since the data is gone."
+        self._generations = {}
+        super()._post_reset()
+
+    def ttl_for_record(self, record):
+        "Return 0 for records from an old generation and super() otherwise."
+        generation = record.generation
+        if generation is not None and (
+                generation.value != record.stamp or
+                generation.epoch != self.cache_generation):
+            return 0
+        return super().ttl_for_record(record)
+
+
+class LazySequenceMixin:
+    """Mixin to cache iterators from make_value as LazySequence instances.
+
+If `make_value` returns an iterator (e.g., a generator), caching it as is
+would mean only the first `get` sees any data. With this mixin, we wrap
+such iterators in an ox_cache.sequences.LazySequence so every `get`
+gets something it can iterate over from the start, while the underlying
+iterator is only advanced as far as the most demanding consumer needs
+(`lazy_chunk_size` items at a time). Set `lazy_memory_chunks` to bound
+memory by spilling older chunks to a temporary file. Once the iterator
+of a cached LazySequence raises, its record counts as expired so the
+next `get` calls `make_value` again (consumers already iterating still
+see the error).
+
+Since the mixin wraps `make_value`, define your `make_value` in a class
+which comes after the mixin in the bases:
+
+>>> from ox_cache import OxCacheBase, LazySequenceMixin
+>>> class Query(OxCacheBase):
+...     'Cache of streamed query results.'
+...     def make_value(self, key, **opts):
+...         for row in range(key):
+...             print('fetch %i' % row)
+...             yield row
+...
+>>> class Rows(LazySequenceMixin, Query):
+...     'Cache of query results shared by consumers.'
+...     lazy_chunk_size = 2
+...
+>>> cache = Rows()
+>>> next(iter(cache.get(3)))
+fetch 0
+fetch 1
+0
+>>> list(cache.get(3)), list(cache.get(3))
+fetch 2
+([0, 1, 2], [0, 1, 2])
+    """
+
+    lazy_chunk_size = 256
+    lazy_memory_chunks = None
+
+    def make_value(self, key, **opts):
+        "Wrap iterators returned by super().make_value in a LazySequence."
+        value = super().make_value(key, **opts)
+        if isinstance(value, collections.abc.Iterator):
+            return LazySequence(value, chunk_size=self.lazy_chunk_size,
+                                memory_chunks=self.lazy_memory_chunks)
+        return value
+
+    def ttl_for_record(self, record):
+        "Return 0 for a LazySequence whose iterator raised else super()."
+        payload = record.payload
+        if payload.__class__ is LazySequence and payload.error is not None:
+            return 0
+        return super().ttl_for_record(record)
 
 
 class LRUReplacementMixin:
@@ -198,19 +1201,169 @@ Calling refresh for key="a"
 >>> cache.reset()   # We can reset the cache completely if
 >>> len(cache)      # we want to just start over.
 0
-    """
 
-    def __init__(self, *args, max_size=128, **kwargs):
-        self.max_size = max_size
-        super().__init__(*args, **kwargs)
+Keeping exact LRU order means every hit reorders the tracker. If you
+pass `recency_buffer=N` (or if the cache is in read-write mode, i.e.,
+created with a ReadWriteLock, where hits only hold the shared side of
+the lock), hits instead just append the key to a lossy buffer of size N
+(a collections.deque is safe to append to from many threads). The buffer
+is drained into the tracker in one batch under the exclusive lock when
+the next store happens or when you call `maintenance()`. If the buffer
+overflows, the oldest hits are dropped so eviction order is approximately
+LRU.
+
+When buffering, a `get` which finds a non-expired record does not take
+any lock at all: it looks the record up in self._data (a single dict
+lookup is atomic), appends the key to the buffer and returns. Only
+misses, expired records and calls passing an explicit lock go through
+the locked path. Because such hits return before the locked path, the
+`_pre_get` hooks of classes after LRUReplacementMixin in the MRO do not
+see them.
+
+>>> from ox_cache.locks import ReadWriteLock
+>>> cache = LRUCache(max_size=2, lock=ReadWriteLock())
+>>> data = [cache.get(x) for x in ['a', 'b']]
+Calling refresh for key="a"
+Calling refresh for key="b"
+>>> cache.get('a')  # Hit takes no lock, recency update is buffered.
+'key="a" is fun!'
+>>> cache.get('c')  # Buffer drained before eviction so 'b' is kicked out.
+Calling refresh for key="c"
+'key="c" is fun!'
+>>> cache.exists('a'), cache.exists('b')
+(True, False)
+>>> cache = LRUCache(max_size=2, recency_buffer=64)
+>>> data = [cache.get(x) for x in ['a', 'b', 'a']]
+Calling refresh for key="a"
+Calling refresh for key="b"
+>>> len(cache._recency_buffer) > 0  # hit on 'a' waiting to be applied
+True
+>>> cache.maintenance()         # explicitly drain the buffer
+>>> len(cache._recency_buffer)
+0
+>>> cache.get('c')
+Calling refresh for key="c"
+'key="c" is fun!'
+>>> cache.exists('a'), cache.exists('b')
+(True, False)
+    """
+
+    recency_buffer_size = 4096
+
+    def __init__(self, *args, max_size=128, recency_buffer=0,
+                 namespace_max_size=None, namespace_max_bytes=None,
+                 sizeof=sys.getsizeof, **kwargs):
+        """Initializer for LRUReplacementMixin.
+
+        :param max_size=128:  Maximum number of elements in the cache.
+
+        :param recency_buffer=0:  If positive, buffer up to this many hits
+                                  instead of reordering the tracker on
+                                  every hit (see class docs). If 0, we
+                                  only buffer in read-write mode and use
+                                  self.recency_buffer_size for the size.
+
+        :param namespace_max_size=None:  Optional quota on the number of
+                                         elements per namespace. Either
+                                         an int applying to every
+                                         namespace or a dict mapping
+                                         namespace to quota.
+
+        :param namespace_max_bytes=None: Optional quota on the total
+                                         `sizeof(value)` per namespace
+                                         (int or dict as for
+                                         namespace_max_size).
+
+        :param sizeof=sys.getsizeof:  Function giving size of a value in
+                                      bytes for namespace_max_bytes.
+
+        Otherwise *args, **kwargs are passed along to super().__init__.
+
+        When a namespace is at its quota, storing into it evicts the
+        least recently used element of that namespace so one busy
+        namespace cannot push the data for other namespaces out.
+        """
+        self.max_size = max_size
+        self.namespace_max_size = namespace_max_size
+        self.namespace_max_bytes = namespace_max_bytes
+        self.sizeof = sizeof
+        super().__init__(*args, **kwargs)
         self._tracker = collections.OrderedDict()
+        self._ns_trackers = {}  # namespace: OrderedDict of key: size
+        self._ns_bytes = collections.Counter()
+        self._ns_pending_size = None  # from _pre_store for _post_store
+        self._recency_buffer = collections.deque(
+            maxlen=recency_buffer or self.recency_buffer_size)
+        self._buffer_hits = bool(recency_buffer) or (
+            self.read_lock is not self.lock)
+
+    @staticmethod
+    def _ns_quota(quotas, namespace):
+        "Return quota for namespace from int/dict/None quotas."
+        if quotas is None or isinstance(quotas, int):
+            return quotas
+        return quotas.get(namespace)
+
+    def get(self, key, allow_refresh=True, lock=None, default=None, **opts):
+        """Get value for key without any lock on buffered hits.
+
+        See OxCacheBase.get for arguments. If we buffer hits and lock is
+        None, a non-expired record is returned after buffering the hit
+        without taking a lock; everything else goes to super().get.
+        """
+        if self._buffer_hits and lock is None:
+            full_key = self.make_key(key, **opts)
+            record = self._data.get(full_key)
+            if record is not None and not self.is_record_expired(record):
+                self._recency_buffer.append(full_key)
+                return record.payload
+        return super().get(key, allow_refresh=allow_refresh, lock=lock,
+                           default=default, **opts)
 
     def _pre_get(self, key, allow_refresh, **opts):
         "Track get request to implement LRU semantics."
-        dummy = allow_refresh
-        full_key = self.make_key(key, **opts)
-        if full_key in self._tracker:
-            self._tracker.move_to_end(full_key)  # pylint: disable=no-member
+        full_key = self.make_key(key, **opts) if opts else key
+        if self._buffer_hits or self.read_lock is not self.lock:
+            self._recency_buffer.append(full_key)  # may be shared side
+        else:
+            self._touch(full_key)
+        super()._pre_get(key, allow_refresh, **opts)
+
+    def _touch(self, full_key):
+        "Mark full_key as most recently used (requires exclusive lock)."
+        tracker = self._tracker
+        if full_key in tracker:
+            tracker.move_to_end(full_key)  # pylint: disable=no-member
+            if self._ns_trackers:
+                ns_tracker = self._ns_trackers.get(full_key.namespace)
+                if ns_tracker is not None and full_key in ns_tracker:
+                    ns_tracker.move_to_end(full_key)
+
+    def maintenance(self, lock=None):
+        """Apply any buffered hits to the LRU tracker.
+
+        :param lock=None:   Optional lock to use. If None, use self.lock.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  Buffered hits are applied automatically on the next
+                  store. You can call this periodically (e.g., from a
+                  background thread) if you have long stretches with
+                  only hits and want the buffer kept short.
+        """
+        if lock is None:
+            lock = self.lock
+        with lock:
+            self._drain_recency_buffer()
+
+    def _drain_recency_buffer(self):
+        """Apply buffered hits to the tracker in one batch.
+
+        Must be called while holding the exclusive lock.
+        """
+        buffer, touch = self._recency_buffer, self._touch
+        while buffer:
+            touch(buffer.popleft())
 
     def _pre_delete_full_key(self, full_key):
         "Track delete request to implement LRU semantics."
@@ -218,20 +1371,1050 @@ Calling refresh for key="a"
             del self._tracker[full_key]
         except KeyError:
             pass
+        if self._ns_trackers:
+            ns_tracker = self._ns_trackers.get(full_key.namespace)
+            if ns_tracker is not None and full_key in ns_tracker:
+                self._ns_bytes[full_key.namespace] -= ns_tracker.pop(
+                    full_key)
+        super()._pre_delete_full_key(full_key)
 
     def _post_reset(self):
         "Reset the tracker after the cache had self.reset() called."
         self._tracker = collections.OrderedDict()
+        self._ns_trackers = {}
+        self._ns_bytes = collections.Counter()
+        self._recency_buffer.clear()
+        super()._post_reset()
 
     def _pre_store(self, key, value, ttl_info, **opts):
-        dummy = value, ttl_info
-        full_key_to_delete = self.make_key(key, **opts)
+        full_key = self.make_key(key, **opts) if opts else key
+        if self._recency_buffer:
+            self._drain_recency_buffer()
+        self._ns_pending_size = None
+        if self.namespace_max_size is not None or (
+                self.namespace_max_bytes is not None):
+            self._ns_pending_size = self._enforce_namespace_quota(
+                full_key, value)
         while len(self._data) >= self.max_size:
             full_key_to_delete, dummy = self._tracker.popitem(last=False)
             logging.debug('%s will remove key %s',
                           self.__class__.__name__, full_key_to_delete)
-            self._delete_full_key(full_key_to_delete, lock=FakeLock())
+            self._delete_full_key(full_key_to_delete, lock=NO_LOCK)
+        super()._pre_store(key, value, ttl_info, **opts)
+
+    def _enforce_namespace_quota(self, full_key, value):
+        """Evict from namespace of full_key to make room for value.
+
+        :return:  Size of value to track for the namespace of full_key
+                  in _post_store (or None if that namespace has no quota).
+        """
+        namespace = full_key.namespace
+        max_size = self._ns_quota(self.namespace_max_size, namespace)
+        max_bytes = self._ns_quota(self.namespace_max_bytes, namespace)
+        if max_size is None and max_bytes is None:
+            return None
+        ns_tracker = self._ns_trackers.setdefault(
+            namespace, collections.OrderedDict())
+        if full_key in ns_tracker:  # replacing so forget old size
+            self._ns_bytes[namespace] -= ns_tracker.pop(full_key)
+        size = self.sizeof(value) if max_bytes is not None else 0
+        while ns_tracker and (
+                (max_size is not None and len(ns_tracker) >= max_size) or (
+                    max_bytes is not None and
+                    self._ns_bytes[namespace] + size > max_bytes)):
+            full_key_to_delete = next(iter(ns_tracker))
+            logging.debug('%s will remove key %s for namespace quota',
+                          self.__class__.__name__, full_key_to_delete)
+            self._delete_full_key(full_key_to_delete, lock=NO_LOCK)
+        return size
 
     def _post_store(self, key, value, ttl_info, **opts):
-        dummy = value, ttl_info
-        self._tracker[self.make_key(key, **opts)] = key
+        full_key = self.make_key(key, **opts) if opts else key
+        self._tracker[full_key] = None
+        size, self._ns_pending_size = self._ns_pending_size, None
+        if size is not None:  # track in namespace only once stored since
+            namespace = full_key.namespace  # global eviction may remove it
+            self._ns_trackers[namespace][full_key] = size
+            self._ns_bytes[namespace] += size
+        super()._post_store(key, value, ttl_info, **opts)
+
+
+class SampledLRUMixin:
+    """Mixin to provide approximate LRU by sampling (like Redis does).
+
+The LRUReplacementMixin keeps an OrderedDict with an extra node per entry
+and reorders it on every hit. For very large caches the SampledLRUMixin
+is cheaper: each item just gets an `access` slot holding the value of a
+counter at its last store or hit. When the cache is full, we sample
+`sample_size` random keys from the storage (O(1) each with the default
+IndexedStorage) and evict the one accessed least recently. Larger
+samples get closer to exact LRU at the cost of slower evictions (see the
+`hit_ratio` benchmark in ox_cache.benchmarks for a comparison).
+
+>>> import random
+>>> from ox_cache import OxCacheBase, SampledLRUMixin
+>>> class SampledCache(SampledLRUMixin, OxCacheBase):
+...     'Cache with approximate LRU eviction.'
+...     def make_value(self, key, **opts):
+...         return key
+...
+>>> cache = SampledCache(max_size=10, sample_size=5, rng=random.Random(1))
+>>> for key in range(100):
+...     data = cache.get(key), cache.get(0)  # keep 0 hot
+...
+>>> len(cache), cache.exists(0)
+(10, True)
+
+Hits only write the `access` slot of the record so they are safe under
+the shared side of a ReadWriteLock. The slot is declared through
+`item_slots` so other mixins can add their own slots to the same records
+(e.g., GenerationalMixin). With a plain dict from `make_storage`,
+sampling copies the keys into a list so it is O(n) per eviction.
+    """
+
+    item_slots = {'access': 0}
+
+    def __init__(self, *args, max_size=128, sample_size=5, rng=None,
+                 **kwargs):
+        """Initializer for SampledLRUMixin.
+
+        :param max_size=128:  Maximum number of elements in the cache.
+
+        :param sample_size=5: How many keys to sample per eviction.
+
+        :param rng=None:      Optional random.Random instance to sample
+                              with (e.g., for reproducible tests).
+
+        Otherwise *args, **kwargs are passed along to super().__init__.
+        """
+        self.max_size = max_size
+        self.sample_size = sample_size
+        self._rng = rng if rng is not None else random.Random()
+        self._clock = itertools.count(1)  # next() is atomic in CPython
+        super().__init__(*args, **kwargs)
+
+    def _pre_get(self, key, allow_refresh, **opts):
+        "Stamp the record (if any) with the current access clock."
+        full_key = self.make_key(key, **opts) if opts else key
+        record = self._data.get(full_key)
+        if record is not None:
+            record.access = next(self._clock)
+        super()._pre_get(key, allow_refresh, **opts)
+
+    def _pre_store(self, key, value, ttl_info, **opts):
+        "Evict sampled least recently used keys to make room."
+        full_key = self.make_key(key, **opts) if opts else key
+        data = self._data
+        if full_key not in data:
+            while len(data) >= self.max_size:
+                full_key_to_delete = self._sample_victim()
+                logging.debug('%s will remove key %s',
+                              self.__class__.__name__, full_key_to_delete)
+                self._delete_full_key(full_key_to_delete, lock=NO_LOCK)
+        super()._pre_store(key, value, ttl_info, **opts)
+
+    def _sample_victim(self):
+        "Return least recently accessed key among sample_size random keys."
+        data, rng = self._data, self._rng
+        random_key = getattr(data, 'random_key', None)
+        if random_key is None:  # make_storage gave plain dict
+            keys = list(data)
+            random_key = (lambda rng: rng.choice(keys))
+        best_key, best_access = None, None
+        for dummy in range(self.sample_size):
+            candidate = random_key(rng)
+            access = data[candidate].access
+            if best_access is None or access < best_access:
+                best_key, best_access = candidate, access
+        return best_key
+
+    def _post_store(self, key, value, ttl_info, **opts):
+        "Stamp the newly stored record."
+        full_key = self.make_key(key, **opts) if opts else key
+        self._data[full_key].access = next(self._clock)
+        super()._post_store(key, value, ttl_info, **opts)
+
+
+class RandomReplacementMixin:
+    """Mixin to evict a random element when the cache is full.
+
+Random replacement is mainly useful as a baseline for comparing other
+policies (see ox_cache.benchmarks and ox_cache.trace) since randomly
+kicking out an item usually gives a worse hit ratio than LRU. The
+default IndexedStorage lets us pick the random key in O(1).
+
+>>> from ox_cache import OxCacheBase, RandomReplacementMixin
+>>> class RandomCache(RandomReplacementMixin, OxCacheBase):
+...     'Cache which evicts random elements.'
+...     def make_value(self, key, **opts):
+...         return key
+...
+>>> cache = RandomCache(max_size=3)
+>>> data = [cache.get(i) for i in range(10)]
+>>> len(cache)
+3
+    """
+
+    def __init__(self, *args, max_size=128, **kwargs):
+        self.max_size = max_size
+        super().__init__(*args, **kwargs)
+
+    def _pre_store(self, key, value, ttl_info=None, **opts):
+        while len(self._data) >= self.max_size:
+            try:
+                full_key_to_delete = self._data.random_key()
+            except AttributeError:  # make_storage gave plain dict
+                full_key_to_delete = random.choice(list(self._data))
+            logging.debug('%s will remove key %s',
+                          self.__class__.__name__, full_key_to_delete)
+            self._delete_full_key(full_key_to_delete, lock=NO_LOCK)
+        super()._pre_store(key, value, ttl_info, **opts)
+
+
+class CostAwareReplacementMixin:
+    """Mixin to evict entries which are cheapest to recompute per byte.
+
+LRU treats an entry whose `make_value` took 30 seconds the same as one
+which took a millisecond. The CostAwareReplacementMixin implements
+GreedyDual-Size-Frequency (GDSF): each entry gets the priority
+
+    inflation + frequency * cost / size
+
+where cost is how long `make_value` took for it (measured by `refresh`),
+size is `sizeof(value)`, frequency counts hits since it was stored and
+inflation is the priority of the last evicted entry (so entries which
+are not hit slowly age out). When the cache is full (more than
+`max_size` entries or, if given, more than `max_bytes` in total) we
+evict the entry with the lowest priority. Priorities live in a heap with
+lazy deletion so operations take O(log n) amortized time. A hit only
+bumps the frequency of the entry (noting the inflation at that time);
+its heap entry is brought up to date when it comes up for eviction.
+
+>>> import time
+>>> from ox_cache import OxCacheBase, CostAwareReplacementMixin
+>>> class Reports(CostAwareReplacementMixin, OxCacheBase):
+...     'Cache where some reports are slow to compute.'
+...     def make_value(self, key, **opts):
+...         if key.startswith('slow'):
+...             time.sleep(0.02)
+...         return key
+...
+>>> cache = Reports(max_size=3)
+>>> for key in ['slow', 'fast1', 'fast2', 'fast3', 'fast4', 'fast1']:
+...     data = cache.get(key)
+...
+>>> cache.exists('slow'), len(cache)  # LRU would have evicted 'slow'
+(True, 3)
+
+Override `measured_cost` to use something other than the time spent
+(e.g., a cost estimate or a monetary cost for a paid API). Since hits
+only write fields of the entry's own bookkeeping list, they are safe
+under the shared side of a ReadWriteLock.
+    """
+
+    def __init__(self, *args, max_size=128, max_bytes=None,
+                 sizeof=sys.getsizeof, **kwargs):
+        """Initializer for CostAwareReplacementMixin.
+
+        :param max_size=128:    Maximum number of elements in the cache.
+
+        :param max_bytes=None:  Optional limit on total sizeof(value).
+
+        :param sizeof=sys.getsizeof:  Function giving size of a value.
+
+        Otherwise *args, **kwargs are passed along to super().__init__.
+        """
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        super().__init__(*args, **kwargs)
+        self.inflation = 0.0
+        self.total_bytes = 0
+        # full_key: [priority, frequency, cost, size, seq, hit_inflation]
+        # where hit_inflation is the inflation at the last hit (or None if
+        # the entry was pushed onto the heap since).
+        self._gdsf = {}
+        self._heap = []  # (priority, seq, full_key) possibly stale
+        self._seq = itertools.count()
+        self._pending_size = None  # from _pre_store for _post_store
+
+    def measured_cost(self, full_key, elapsed):
+        """Return cost of recomputing value for full_key.
+
+        :param full_key:   Key being stored.
+
+        :param elapsed:    Seconds since refresh started (or None if the
+                           value was stored directly instead of through
+                           refresh).
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  Cost to use in the priority. By default, elapsed (or
+                  the previous cost for full_key if elapsed is None).
+        """
+        if elapsed is None:
+            meta = self._gdsf.get(full_key)
+            return meta[2] if meta is not None else 0.0
+        return elapsed
+
+    def _record_cost(self, full_key, elapsed):
+        "Set cost of full_key from elapsed refresh time (requires lock)."
+        meta = self._gdsf.get(full_key)
+        if meta is not None:
+            meta[2] = self.measured_cost(full_key, elapsed)
+            self._push(full_key, meta)
+
+    def refresh(self, key, lock=None, **opts):
+        "Time the refresh so we know the cost to recompute the value."
+        if lock is None:
+            lock = self.lock
+        with lock:
+            started = time.perf_counter()
+            super().refresh(key, lock=NO_LOCK, **opts)
+            self._record_cost(self.make_key(key, **opts),
+                              time.perf_counter() - started)
+
+    def refresh_outside_lock(self, key, lock=None, **opts):
+        "Time the refresh so we know the cost to recompute the value."
+        if lock is None:
+            lock = self.lock
+        started = time.perf_counter()
+        super().refresh_outside_lock(key, lock=lock, **opts)
+        with lock:
+            self._record_cost(self.make_key(key, **opts),
+                              time.perf_counter() - started)
+
+    def _push(self, full_key, meta, inflation=None):
+        "Set priority in meta from its fields and push it onto the heap."
+        if inflation is None:
+            inflation = self.inflation
+        meta[0] = inflation + meta[1] * meta[2] / meta[3]
+        meta[4], meta[5] = next(self._seq), None
+        heap = self._heap
+        if len(heap) > 2 * len(self._gdsf) + 64:  # drop stale entries
+            heap[:] = [item for item in heap if self._is_current(item)]
+            heapq.heapify(heap)
+        heapq.heappush(heap, (meta[0], meta[4], full_key))
+
+    def _is_current(self, item):
+        "Return True if heap item is the latest one for its key."
+        meta = self._gdsf.get(item[2])
+        return meta is not None and meta[4] == item[1]
+
+    def _pre_get(self, key, allow_refresh, **opts):
+        "Count hit to raise the priority of the entry (see _pop_victim)."
+        full_key = self.make_key(key, **opts) if opts else key
+        meta = self._gdsf.get(full_key)
+        if meta is not None:
+            meta[1] += 1
+            meta[5] = self.inflation
+        super()._pre_get(key, allow_refresh, **opts)
+
+    def _pop_victim(self):
+        "Pop and return key with lowest current priority from the heap."
+        heap = self._heap
+        while True:  # the heap always has a current item for every key
+            item = heapq.heappop(heap)
+            if self._is_current(item):
+                meta = self._gdsf[item[2]]
+                if meta[5] is not None:  # hit since pushed so re-push
+                    self._push(item[2], meta, meta[5])
+                    continue
+                self.inflation = item[0]
+                return item[2]
+
+    def _pre_store(self, key, value, ttl_info, **opts):
+        "Evict lowest priority entries to make room for value."
+        full_key = self.make_key(key, **opts) if opts else key
+        size = max(1, self.sizeof(value))
+        gdsf, data = self._gdsf, self._data
+        while gdsf:
+            old = gdsf.get(full_key)
+            extra = size - (old[3] if old is not None else 0)
+            if not ((old is None and len(data) >= self.max_size) or (
+                    self.max_bytes is not None and
+                    self.total_bytes + extra > self.max_bytes)):
+                break
+            full_key_to_delete = self._pop_victim()
+            logging.debug('%s will remove key %s',
+                          self.__class__.__name__, full_key_to_delete)
+            self._delete_full_key(full_key_to_delete, lock=NO_LOCK)
+        self._pending_size = size
+        super()._pre_store(key, value, ttl_info, **opts)
+
+    def _post_store(self, key, value, ttl_info, **opts):
+        "Track cost, size and priority of newly stored value."
+        full_key = self.make_key(key, **opts) if opts else key
+        size, self._pending_size = self._pending_size, None
+        if size is None:
+            size = max(1, self.sizeof(value))
+        cost = self.measured_cost(full_key, None)  # refresh sets it later
+        meta = self._gdsf.get(full_key)
+        if meta is None:
+            meta = self._gdsf[full_key] = [0.0, 1, cost, size, None, None]
+        else:
+            self.total_bytes -= meta[3]
+            meta[2], meta[3] = cost, size
+        self.total_bytes += size
+        self._push(full_key, meta)
+        super()._post_store(key, value, ttl_info, **opts)
+
+    def _pre_delete_full_key(self, full_key):
+        "Forget entry (its heap entries become stale)."
+        meta = self._gdsf.pop(full_key, None)
+        if meta is not None:
+            self.total_bytes -= meta[3]
+        super()._pre_delete_full_key(full_key)
+
+    def _post_reset(self):
+        "Clear all tracking state after reset."
+        self._gdsf.clear()
+        self._heap = []
+        self.inflation = 0.0
+        self.total_bytes = 0
+        super()._post_reset()
+
+
+class NamespaceIndexMixin:
+    """Mixin to keep an index from namespace to keys in that namespace.
+
+By default operations like `reset` and `clean` work on the whole cache.
+Including the NamespaceIndexMixin maintains a secondary index from each
+namespace to its keys so you can reset, clean or count a single
+namespace in time proportional to the size of that namespace:
+
+>>> from ox_cache import OxCacheBase, NamespaceIndexMixin
+>>> class NSCache(NamespaceIndexMixin, OxCacheBase):
+...     'Cache with a namespace index.'
+...     def make_value(self, key, **opts):
+...         return 'value for %s' % key
+...
+>>> cache = NSCache()
+>>> data = [cache.get(i, namespace=ns) for i in range(3)
+...         for ns in ['users', 'orders']]
+>>> cache.store('x', 1, namespace='admin')
+>>> sorted(cache.namespaces()), cache.namespace_len('users'), len(cache)
+(['admin', 'orders', 'users'], 3, 7)
+>>> cache.reset(namespace='users')  # only clear one namespace
+>>> cache.namespace_len('users'), cache.namespace_len('orders'), len(cache)
+(0, 3, 4)
+>>> cache.delete('x', namespace='admin')
+>>> sorted(cache.namespaces())
+['orders']
+>>> cache.clean(namespace='orders')  # nothing expired so nothing removed
+[]
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._namespace_index = {}  # namespace: set of full keys
+
+    def namespaces(self):
+        "Return list of namespaces with at least one key in the cache."
+        return list(self._namespace_index)
+
+    def namespace_len(self, namespace):
+        "Return number of keys in the cache for the given namespace."
+        return len(self._namespace_index.get(namespace, ()))
+
+    def namespace_keys(self, namespace, lock=None):
+        """Return list of full keys in the given namespace.
+
+        :param namespace:   Namespace to look up.
+
+        :param lock=None:   Optional lock to use. If None, use self.read_lock.
+        """
+        if lock is None:
+            lock = self.read_lock
+        with lock:
+            return list(self._namespace_index.get(namespace, ()))
+
+    def _post_store(self, key, value, ttl_info, **opts):
+        "Add stored key to the namespace index."
+        full_key = self.make_key(key, **opts) if opts else key
+        keys = self._namespace_index.get(full_key.namespace)
+        if keys is None:
+            keys = self._namespace_index[full_key.namespace] = set()
+        keys.add(full_key)
+        super()._post_store(key, value, ttl_info, **opts)
+
+    def _pre_delete_full_key(self, full_key):
+        "Remove deleted key from the namespace index."
+        keys = self._namespace_index.get(full_key.namespace)
+        if keys is not None:
+            keys.discard(full_key)
+            if not keys:
+                del self._namespace_index[full_key.namespace]
+        super()._pre_delete_full_key(full_key)
+
+    def _post_reset(self):
+        "Clear the namespace index after a full reset."
+        self._namespace_index = {}
+        super()._post_reset()
+
+    def reset(self, lock=None, namespace=None):
+        """Reset the whole cache or just a single namespace.
+
+        :param lock=None:   Optional lock to use. If None, use self.lock.
+
+        :param namespace=None:  If None, reset everything as described in
+                                OxCacheBase.reset. Otherwise, only delete
+                                the keys in the given namespace.
+        """
+        if namespace is None:
+            return super().reset(lock=lock)
+        if lock is None:
+            lock = self.lock
+        with lock:
+            for full_key in list(self._namespace_index.get(namespace, ())):
+                self._delete_full_key(full_key, lock=NO_LOCK)
+        return None
+
+    def clean(self, lock=None, namespace=None, batch=None):
+        """Remove expired elements from the whole cache or one namespace.
+
+        :param lock=None:   Optional lock to use. If None, use self.lock.
+
+        :param batch=None:  Passed to OxCacheBase.clean if namespace is None.
+
+        :param namespace=None:  If None, clean everything as described in
+                                OxCacheBase.clean. Otherwise, only look
+                                at keys in the given namespace.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  List of (full_key, record) pairs which were removed.
+        """
+        if namespace is None:
+            return super().clean(lock=lock, batch=batch)
+        removed = []
+        if lock is None:
+            lock = self.lock
+        with lock:
+            for full_key in list(self._namespace_index.get(namespace, ())):
+                ox_rec = self._data[full_key]
+                if self.ttl_for_record(ox_rec) <= 0:
+                    self._delete_full_key(full_key, NO_LOCK)
+                    removed.append((full_key, ox_rec))
+        return removed
+
+
+_DEPENDENCY_STATE = threading.local()
+
+
+class _DependencyToken:
+    """Token marking tags which record a dependency on a tracking cache.
+
+    Tags of the form (token, full_key) mark entries depending on full_key
+    in the cache the token refers to (through a weak reference).
+    """
+
+    __slots__ = ('cache_ref',)
+
+    def __init__(self, cache):
+        self.cache_ref = weakref.ref(cache)
+
+
+def _dependency_frames():
+    "Return the per-thread stack of (cache, tags) for refreshes in progress."
+    try:
+        return _DEPENDENCY_STATE.frames
+    except AttributeError:
+        frames = _DEPENDENCY_STATE.frames = []
+        return frames
+
+
+class TagIndexMixin:
+    """Mixin to invalidate groups of keys by tag or by dependency.
+
+Including the TagIndexMixin lets you attach tags to entries when you
+store or refresh them (or via the `make_tags` hook). An inverted index
+from tag to keys lets `invalidate_tag` remove everything with a given tag
+in time proportional to the number of matching entries:
+
+>>> from ox_cache import OxCacheBase, TagIndexMixin
+>>> class TagCache(TagIndexMixin, OxCacheBase):
+...     'Cache which tags everything with the table it came from.'
+...     def make_value(self, key, **opts):
+...         return 'row %s' % key
+...     def make_tags(self, full_key, value):
+...         return [full_key.odict().get('table')]
+...
+>>> cache = TagCache()
+>>> data = [cache.get(i, table=t) for i in range(3) for t in ['a', 'b']]
+>>> cache.store('total', 6, tags=['a', 'b', 'report'])
+>>> len(cache), cache.tag_len('a'), cache.tag_len('report')
+(7, 4, 1)
+>>> removed = cache.invalidate_tag('a')
+>>> len(removed), len(cache), cache.tag_len('b'), cache.tag_len('report')
+(4, 3, 3, 0)
+
+If you set `track_dependencies` (either as a class attribute or an
+argument to __init__), then whenever computing a value for one tracking
+cache calls `get` on another (or the same) tracking cache, the outer
+entry is recorded as depending on the inner one. Invalidating the inner
+entry via `invalidate` or `invalidate_tag` then cascades to everything
+derived from it. Dependencies are remembered as long as some entry
+derived from the inner entry is still cached (even if the inner entry
+itself was evicted, deleted or reset) so the dependency map is bounded
+by the number of dependent entries:
+
+>>> from ox_cache import OxMemoizer
+>>> class DepMemoizer(TagIndexMixin, OxMemoizer):
+...     'Memoizer which tracks dependencies between memoized functions.'
+...     track_dependencies = True
+...
+>>> @DepMemoizer
+... def price(item):
+...     'Lookup price'
+...     print('lookup %s' % item)
+...     return {'apple': 2, 'pear': 3}[item]
+...
+>>> @DepMemoizer
+... def basket(first, second):
+...     'Total price for basket'
+...     return price(first) + price(second)
+...
+>>> basket('apple', 'pear')
+lookup apple
+lookup pear
+5
+>>> basket.exists('apple', 'pear')
+True
+>>> price.invalidate('pear')  # also invalidates things that used price
+>>> basket.exists('apple', 'pear'), price.exists('apple')
+(False, True)
+>>> basket('apple', 'pear')
+lookup pear
+5
+    """
+
+    track_dependencies = False
+
+    def __init__(self, *args, track_dependencies=None, **kwargs):
+        """Initializer for TagIndexMixin.
+
+        :param track_dependencies=None:  If not None, override the class
+                                         attribute of the same name to
+                                         turn dependency tracking on/off.
+
+        Otherwise *args, **kwargs are passed along to super().__init__.
+        """
+        if track_dependencies is not None:
+            self.track_dependencies = track_dependencies
+        super().__init__(*args, **kwargs)
+        self._tag_index = {}  # tag: set of full keys
+        self._key_tags = {}   # full key: set of tags
+        self._dependency_token = _DependencyToken(self)
+        self._dependency_lock = threading.Lock()
+        self._dependent_caches = {}  # full key: WeakSet of caches
+
+    def make_tags(self, full_key, value):
+        """Hook to return tags for a value being stored.
+
+        :param full_key:   Full key for the value being stored.
+
+        :param value:      Value being stored.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  Iterable of hashable tags for the entry (None is ignored).
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  Sub-classes can override to tag entries automatically
+                  (e.g., based on the opts in the key) so that entries
+                  created by `get` can be invalidated by tag.
+        """
+        dummy = self, full_key, value
+        return ()
+
+    def tag_len(self, tag):
+        "Return number of keys in the cache with the given tag."
+        return len(self._tag_index.get(tag, ()))
+
+    def tags_for(self, key, **opts):
+        "Return set of tags for the given key/**opts."
+        return set(self._key_tags.get(self.make_key(key, **opts), ()))
+
+    def _add_tags(self, full_key, tags):
+        "Add tags for full_key to the index (requires exclusive lock)."
+        key_tags = self._key_tags.get(full_key)
+        for tag in tags:
+            if tag is None:
+                continue
+            if key_tags is None:  # only make a set for tagged keys
+                key_tags = self._key_tags[full_key] = set()
+            if tag not in key_tags:
+                key_tags.add(tag)
+                keys = self._tag_index.get(tag)
+                if keys is None:
+                    keys = self._tag_index[tag] = set()
+                keys.add(full_key)
+
+    def _remove_tags(self, full_key):
+        "Remove full_key from the tag index (requires exclusive lock)."
+        for tag in self._key_tags.pop(full_key, ()):
+            keys = self._tag_index[tag]
+            keys.discard(full_key)
+            if not keys:
+                del self._tag_index[tag]
+                self._release_dependency(tag)
+
+    def _release_dependency(self, tag):
+        "If tag marks a dependency, tell its cache we no longer need it."
+        if tag.__class__ is tuple and len(tag) == 2 and (
+                tag[0].__class__ is _DependencyToken):
+            cache = tag[0].cache_ref()
+            if cache is not None:
+                cache._forget_dependent(tag[1], self)
+
+    def _forget_dependent(self, full_key, parent):
+        "Forget that parent has entries depending on full_key."
+        with self._dependency_lock:
+            parents = self._dependent_caches.get(full_key)
+            if parents is not None:
+                parents.discard(parent)
+                if not parents:
+                    del self._dependent_caches[full_key]
+
+    def _post_store(self, key, value, ttl_info, **opts):
+        "Replace tags for the stored key with those from make_tags."
+        full_key = self.make_key(key, **opts) if opts else key
+        self._remove_tags(full_key)
+        self._add_tags(full_key, self.make_tags(full_key, value))
+        super()._post_store(key, value, ttl_info, **opts)
+
+    def _pre_delete_full_key(self, full_key):
+        """Remove deleted key from the tag index.
+
+        Entries in other caches which depend on full_key stay recorded so
+        a later `invalidate` of full_key still reaches them.
+        """
+        self._remove_tags(full_key)
+        super()._pre_delete_full_key(full_key)
+
+    def _post_reset(self):
+        "Clear the tag index after a full reset."
+        tag_index = self._tag_index
+        self._tag_index = {}
+        self._key_tags = {}
+        for tag in tag_index:
+            self._release_dependency(tag)
+        super()._post_reset()
+
+    def store(self, key, value, ttl_info=None, lock=None, tags=None,
+              **opts):
+        """Store a value for the given key with optional tags.
+
+        :param tags=None:  Optional iterable of tags for the entry in
+                           addition to those from self.make_tags.
+
+        See OxCacheBase.store for other arguments.
+        """
+        if lock is None:
+            lock = self.lock
+        with lock:
+            super().store(key, value, ttl_info, lock=NO_LOCK, **opts)
+            if tags:
+                self._add_tags(self.make_key(key, **opts), tags)
+
+    def refresh(self, key, lock=None, tags=None, **opts):
+        """Refresh the value for key with optional tags.
+
+        :param tags=None:  Optional iterable of tags for the refreshed
+                           entry in addition to those from self.make_tags.
+
+        See OxCacheBase.refresh for other arguments.
+
+        If self.track_dependencies is True, then the refreshed entry is
+        also tagged with the entries of other tracking caches which were
+        accessed by `get` while computing the value.
+        """
+        if not (tags or self.track_dependencies):
+            return super().refresh(key, lock=lock, **opts)
+        if lock is None:
+            lock = self.lock
+        frames = _dependency_frames()
+        dependencies = set(tags or ())
+        with lock:
+            frames.append((self, dependencies))
+            try:
+                super().refresh(key, lock=NO_LOCK, **opts)
+                full_key = self.make_key(key, **opts)
+                if dependencies and full_key in self._data:
+                    self._add_tags(full_key, dependencies)
+            finally:
+                frames.pop()
+                for tag in dependencies:  # e.g., if refresh failed
+                    if tag not in self._tag_index:
+                        self._release_dependency(tag)
+        return None
+
+    def refresh_outside_lock(self, key, lock=None, tags=None, **opts):
+        """Refresh key outside the lock unless we need tags for it.
+
+        See OxCacheBase.refresh_outside_lock for arguments. If tags are
+        given or self.track_dependencies is True, we use `refresh` since
+        the entry and its tags must be stored under one lock (otherwise
+        an invalidation in between would miss the entry).
+        """
+        if tags or self.track_dependencies:
+            return self.refresh(key, lock=lock, tags=tags, **opts)
+        return super().refresh_outside_lock(key, lock=lock, **opts)
+
+    def _dependency_tag(self, full_key):
+        "Return tag used to mark entries in other caches using full_key."
+        return (self._dependency_token, full_key)
+
+    def get(self, key, allow_refresh=True, lock=None, default=None, **opts):
+        """Get value for key while recording dependencies if necessary.
+
+        See OxCacheBase.get for arguments. If self.track_dependencies is
+        True and another tracking cache is refreshing in this thread,
+        we record that the entry being refreshed depends on this key.
+        """
+        result = super().get(key, allow_refresh=allow_refresh, lock=lock,
+                             default=default, **opts)
+        if self.track_dependencies:
+            frames = _dependency_frames()
+            if frames:
+                parent, dependencies = frames[-1]
+                full_key = self.make_key(key, **opts)
+                dependencies.add(self._dependency_tag(full_key))
+                with self._dependency_lock:
+                    parents = self._dependent_caches.get(full_key)
+                    if parents is None:
+                        parents = self._dependent_caches[full_key] = (
+                            weakref.WeakSet())
+                    parents.add(parent)
+        return result
+
+    def invalidate_tag(self, tag, lock=None):
+        """Remove all entries with the given tag (and their dependents).
+
+        :param tag:  Tag to invalidate.
+
+        :param lock=None:   Optional lock to use. If None, use self.lock.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  List of full keys removed from this cache.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  Remove everything tagged with `tag` in time
+                  proportional to the number of matching entries. Any
+                  dependent entries in other caches are invalidated
+                  after our lock is released.
+        """
+        if lock is None:
+            lock = self.lock
+        with lock:
+            removed = list(self._tag_index.get(tag, ()))
+            todo = self._pop_dependents(removed)
+            for full_key in removed:
+                self._delete_full_key(full_key, lock=NO_LOCK)
+        self._cascade_invalidation(todo)
+        return removed
+
+    def invalidate(self, key, lock=None, **opts):
+        """Remove key if present and invalidate entries depending on it.
+
+        :param key:     Hashable key for object to invalidate.
+
+        :param lock=None:   Optional lock to use. If None, use self.lock.
+
+        :param **opts:  Keyword options for how to determine full key.
+                        See the make_key method for details on key/**opts.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  Unlike delete, this does not raise KeyError if key is
+                  missing and also cascades to dependent entries.
+        """
+        full_key = self.make_key(key, **opts)
+        if lock is None:
+            lock = self.lock
+        with lock:
+            todo = self._pop_dependents([full_key])
+            if full_key in self._data:
+                self._delete_full_key(full_key, lock=NO_LOCK)
+        self._cascade_invalidation(todo)
+
+    def _pop_dependents(self, full_keys):
+        "Remove and return list of (full_key, parent caches) for full_keys."
+        with self._dependency_lock:
+            return [(full_key, list(self._dependent_caches.pop(full_key)))
+                    for full_key in full_keys
+                    if full_key in self._dependent_caches]
+
+    def _cascade_invalidation(self, todo):
+        "Invalidate entries in other caches from _pop_dependents result."
+        for full_key, parents in todo:
+            for parent in parents:
+                parent.invalidate_tag(self._dependency_tag(full_key))
+
+
+class SortedKeyIndexMixin:
+    """Mixin to keep a sorted index of base keys for prefix/range queries.
+
+Including the SortedKeyIndexMixin maintains a sorted array of base keys
+(updated with bisect in the store/delete hooks) so that you can find or
+delete all keys with a given prefix or in a given range in O(log n + k)
+lookups instead of scanning everything. Only base keys whose type is in
+the `sorted_key_types` class attribute (str by default) are indexed since
+other keys may not be comparable. Caches which do not include this mixin
+pay nothing for it.
+
+>>> from ox_cache import OxCacheBase, SortedKeyIndexMixin
+>>> class SortedCache(SortedKeyIndexMixin, OxCacheBase):
+...     'Cache with sorted index on base keys.'
+...     def make_value(self, key, **opts):
+...         return str(key).upper()
+...
+>>> cache = SortedCache()
+>>> for key in ['user:12:a', 'user:123:a', 'user:123:b', 'user:2:a']:
+...     cache.store(key, 'v', namespace='x')
+...
+>>> cache.get('user:123:b', namespace='y'), cache.get(7)  # 7 not indexed
+('USER:123:B', '7')
+>>> [k.base_key for k in cache.keys_with_prefix('user:123:')]
+['user:123:a', 'user:123:b', 'user:123:b']
+>>> [k.base_key for k in cache.keys_in_range('user:123', 'user:2')]
+['user:123:a', 'user:123:b', 'user:123:b', 'user:12:a']
+>>> removed = cache.delete_prefix('user:12')
+>>> len(removed), len(cache), [k.base_key for k in cache.keys_with_prefix('')]
+(4, 2, ['user:2:a'])
+>>> cache.store('z\U0010ffff!', 1)  # prefix ending in max char still works
+>>> [k.base_key for k in cache.keys_with_prefix('z\U0010ffff')]
+['z\U0010ffff!']
+    """
+
+    sorted_key_types = (str,)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sorted_base_keys = []   # sorted list of indexed base keys
+        self._base_key_index = {}     # base key: set of full keys
+
+    def _post_store(self, key, value, ttl_info, **opts):
+        "Add stored key to the sorted index."
+        full_key = self.make_key(key, **opts) if opts else key
+        base_key = full_key.base_key
+        if type(base_key) in self.sorted_key_types:
+            keys = self._base_key_index.get(base_key)
+            if keys is None:
+                keys = self._base_key_index[base_key] = set()
+                bisect.insort(self._sorted_base_keys, base_key)
+            keys.add(full_key)
+        super()._post_store(key, value, ttl_info, **opts)
+
+    def _pre_delete_full_key(self, full_key):
+        "Remove deleted key from the sorted index."
+        base_key = full_key.base_key
+        keys = self._base_key_index.get(base_key)
+        if keys is not None:
+            keys.discard(full_key)
+            if not keys:
+                del self._base_key_index[base_key]
+                sorted_keys = self._sorted_base_keys
+                del sorted_keys[bisect.bisect_left(sorted_keys, base_key)]
+        super()._pre_delete_full_key(full_key)
+
+    def _post_reset(self):
+        "Clear the sorted index after a full reset."
+        self._sorted_base_keys = []
+        self._base_key_index = {}
+        super()._post_reset()
+
+    def _range_slice(self, lo, hi):
+        "Return slice of self._sorted_base_keys with lo <= key < hi."
+        sorted_keys = self._sorted_base_keys
+        start = 0 if lo is None else bisect.bisect_left(sorted_keys, lo)
+        end = len(sorted_keys) if hi is None else bisect.bisect_left(
+            sorted_keys, hi, start)
+        return slice(start, end)
+
+    @staticmethod
+    def _prefix_bounds(prefix):
+        "Return (lo, hi) such that lo <= key < hi iff key has prefix."
+        if isinstance(prefix, bytes):
+            codes, top, build = list(prefix), 0xff, bytes
+        else:
+            codes, top = [ord(char) for char in prefix], sys.maxunicode
+            build = lambda codes: ''.join(map(chr, codes))
+        while codes and codes[-1] == top:  # max value cannot be bumped
+            codes.pop()
+        if not codes:  # nothing left to bump so no upper bound
+            return (prefix or None), None
+        codes[-1] += 1
+        return prefix, build(codes)
+
+    def keys_in_range(self, lo=None, hi=None, lock=None):
+        """Return list of full keys with lo <= base_key < hi.
+
+        :param lo=None:    Inclusive lower bound (None means unbounded).
+
+        :param hi=None:    Exclusive upper bound (None means unbounded).
+
+        :param lock=None:  Optional lock to use. If None, use self.read_lock.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  List of full keys sorted by base key (full keys with
+                  the same base key are in arbitrary order).
+        """
+        if lock is None:
+            lock = self.read_lock
+        with lock:
+            index = self._base_key_index
+            return [full_key for base_key in self._sorted_base_keys[
+                self._range_slice(lo, hi)] for full_key in index[base_key]]
+
+    def keys_with_prefix(self, prefix, lock=None):
+        """Return list of full keys whose base_key starts with prefix.
+
+        :param prefix:     String prefix to look for.
+
+        :param lock=None:  Optional lock to use. If None, use self.read_lock.
+        """
+        lo, hi = self._prefix_bounds(prefix)
+        return self.keys_in_range(lo, hi, lock=lock)
+
+    def delete_range(self, lo=None, hi=None, lock=None):
+        """Delete all keys with lo <= base_key < hi.
+
+        :param lo=None, hi=None:   Bounds as for keys_in_range.
+
+        :param lock=None:  Optional lock to use. If None, use self.lock.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  List of full keys which were deleted.
+        """
+        if lock is None:
+            lock = self.lock
+        removed = []
+        with lock:
+            where = self._range_slice(lo, hi)
+            for base_key in self._sorted_base_keys[where]:
+                removed.extend(self._base_key_index.pop(base_key))
+            del self._sorted_base_keys[where]  # drop whole slice at once
+            for full_key in removed:
+                self._delete_full_key(full_key, lock=NO_LOCK)
+        return removed
+
+    def delete_prefix(self, prefix, lock=None):
+        """Delete all keys whose base_key starts with prefix.
+
+        :param prefix:     String prefix to look for.
+
+        :param lock=None:  Optional lock to use. If None, use self.lock.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  List of full keys which were deleted.
+        """
+        lo, hi = self._prefix_bounds(prefix)
+        return self.delete_range(lo, hi, lock=lock)
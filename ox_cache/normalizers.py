@@ -0,0 +1,192 @@
+"""Normalize function arguments into hashable values for memoization keys.
+
+OxMemoizer builds keys from function arguments so arguments must be
+hashable. Things like bytearray, memoryview, array.array or numpy arrays
+are not (and large bytes objects would be kept alive in the key). The
+`normalize` function converts such values into a small BufferFingerprint
+holding the type, format/dtype, shape and a blake2b digest of the raw
+buffer (computed without copying when the buffer is contiguous):
+
+>>> from ox_cache.normalizers import normalize
+>>> normalize(42), normalize('text'), normalize(b'short bytes')
+(42, 'text', b'short bytes')
+>>> fingerprint = normalize(bytearray(b'data'))
+>>> fingerprint.kind, fingerprint.dtype, fingerprint.shape
+('bytearray', 'B', (4,))
+>>> fingerprint == normalize(bytearray(b'data'))
+True
+>>> normalize(memoryview(b'data')).digest == fingerprint.digest
+True
+>>> import array
+>>> normalize(array.array('d', [1.0, 2.0])).dtype
+'d'
+
+Objects with an `__array_interface__` (e.g., numpy arrays) are handled
+without importing numpy. Their fingerprint is cached per object when the
+array and everything it views are read-only (so its contents cannot
+change while we hold the cached fingerprint).
+
+You can register normalizers for your own types:
+
+>>> from ox_cache.normalizers import register_normalizer
+>>> class Point:
+...     'Unhashable point.'
+...     __hash__ = None
+...     def __init__(self, x, y):
+...         self.x, self.y = x, y
+...
+>>> @register_normalizer(Point)
+... def normalize_point(point):
+...     return ('Point', point.x, point.y)
+...
+>>> normalize(Point(1, 2))
+('Point', 1, 2)
+"""
+
+import array
+import collections
+import doctest
+import hashlib
+import weakref
+
+
+BufferFingerprint = collections.namedtuple('BufferFingerprint', [
+    'kind', 'dtype', 'shape', 'digest'])
+
+INLINE_BYTES_LIMIT = 256  # bytes longer than this become a fingerprint
+DIGEST_SIZE = 16
+
+_PLAIN_TYPES = frozenset([int, str, float, bool, type(None)])
+_NORMALIZERS = {}  # type: function to normalize values of that type
+_RESOLVED = {}     # type: normalizer (or None) found via the MRO
+_FROZEN_FINGERPRINTS = weakref.WeakKeyDictionary()
+
+
+def register_normalizer(kind):
+    """Decorator to register a function to normalize values of type kind.
+
+    :param kind:   Type to register (sub-classes are also handled unless
+                   they have their own normalizer).
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  Decorator which registers and returns the function. The
+              function should take a value and return something hashable
+              which is equal for values that should share a cache entry.
+    """
+    def decorator(func):
+        "Register func as the normalizer for kind."
+        _NORMALIZERS[kind] = func
+        _RESOLVED.clear()
+        return func
+    return decorator
+
+
+def _resolve(kind):
+    "Find normalizer for kind from registry, MRO or array interface."
+    for base in kind.__mro__:
+        func = _NORMALIZERS.get(base)
+        if func is not None:
+            return func
+    if hasattr(kind, '__array_interface__'):
+        return normalize_array
+    return None
+
+
+def normalize(value):
+    """Return hashable version of value for use in a cache key.
+
+    :param value:   Argument to normalize.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  Result of the registered normalizer for the type of value
+              or value itself if there is no normalizer.
+    """
+    kind = type(value)
+    if kind in _PLAIN_TYPES:
+        return value
+    try:
+        func = _RESOLVED[kind]
+    except KeyError:
+        func = _RESOLVED[kind] = _resolve(kind)
+    return value if func is None else func(value)
+
+
+def _digest(buffer):
+    "Return blake2b digest of an object supporting the buffer protocol."
+    return hashlib.blake2b(buffer, digest_size=DIGEST_SIZE).digest()
+
+
+def fingerprint_buffer(value, kind=None):
+    """Return BufferFingerprint for object supporting the buffer protocol.
+
+    :param value:      Object supporting the buffer protocol.
+
+    :param kind=None:  Name to use for the kind (default is type name).
+
+    Buffers which are not C-contiguous are copied with tobytes before
+    hashing; all others are hashed in place.
+    """
+    with memoryview(value) as view:
+        data = view.cast('B') if view.c_contiguous else view.tobytes()
+        return BufferFingerprint(kind or type(value).__name__, view.format,
+                                 tuple(view.shape), _digest(data))
+
+
+@register_normalizer(bytes)
+def normalize_bytes(value):
+    "Keep short bytes as is and fingerprint long ones."
+    if len(value) <= INLINE_BYTES_LIMIT:
+        return value
+    return BufferFingerprint('bytes', 'B', (len(value),), _digest(value))
+
+
+for _kind in (bytearray, memoryview, array.array):
+    register_normalizer(_kind)(fingerprint_buffer)
+
+
+def _is_frozen(value):
+    "Return True if array-like value and everything it views is read-only."
+    while value is not None:
+        flags = getattr(value, 'flags', None)
+        if isinstance(value, bytes):
+            return True
+        if flags is None or flags.writeable:
+            return False
+        value = getattr(value, 'base', None)
+    return True
+
+
+def normalize_array(value):
+    """Return BufferFingerprint for numpy-like array with __array_interface__.
+
+    The fingerprint includes the dtype string and shape. If the array is
+    frozen (read-only all the way down), we remember the fingerprint for
+    that object (via a weak reference) so hashing happens only once.
+    """
+    frozen = _is_frozen(value)
+    if frozen:
+        try:
+            return _FROZEN_FINGERPRINTS[value]
+        except (KeyError, TypeError):  # missing or cannot weakref
+            pass
+    interface = value.__array_interface__
+    flags = getattr(value, 'flags', None)
+    if flags is not None and flags.c_contiguous:
+        data = memoryview(value).cast('B')
+    else:
+        data = value.tobytes()
+    result = BufferFingerprint(type(value).__name__, interface['typestr'],
+                               tuple(interface['shape']), _digest(data))
+    if frozen:
+        try:
+            _FROZEN_FINGERPRINTS[value] = result
+        except TypeError:  # does not support weak references
+            pass
+    return result
+
+
+if __name__ == '__main__':
+    doctest.testmod()
+    print('Finished tests')
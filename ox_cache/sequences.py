@@ -0,0 +1,170 @@
+"""Lazily filled sequences so iterators can be cached and shared.
+
+Caching a generator object is not useful since the first consumer
+exhausts it and everyone else gets nothing. A LazySequence wraps an
+iterator so that the first consumer pulls items from it a chunk at a
+time while later (or concurrent) consumers replay the items already
+produced and then continue from there:
+
+>>> from ox_cache.sequences import LazySequence
+>>> def numbers():
+...     for i in range(10):
+...         print('made %i' % i)
+...         yield i
+...
+>>> seq = LazySequence(numbers(), chunk_size=4)
+>>> first = iter(seq)
+>>> next(first), next(first)
+made 0
+made 1
+made 2
+made 3
+(0, 1)
+>>> list(seq)[:5]  # replays 0-3 and then drives the iterator further
+made 4
+made 5
+made 6
+made 7
+made 8
+made 9
+[0, 1, 2, 3, 4]
+>>> list(first), seq.produced, seq.done
+([2, 3, 4, 5, 6, 7, 8, 9], 10, True)
+
+If `memory_chunks` is given, at most that many chunks are kept in memory
+and older ones are pickled to a temporary file and read back when a
+consumer replays them:
+
+>>> seq = LazySequence(iter(range(1000)), chunk_size=100, memory_chunks=2)
+>>> sum(seq), seq.spilled_chunks, sum(seq)
+(499500, 8, 499500)
+"""
+
+import doctest
+import pickle
+import tempfile
+import threading
+
+from ox_cache.core import fresh_exception
+
+
+class _Spilled:
+    "Location of a chunk written to the spill file."
+
+    __slots__ = ('offset', 'size')
+
+    def __init__(self, offset, size):
+        self.offset = offset
+        self.size = size
+
+
+class LazySequence:
+    """Thread-safe sequence lazily filled from an iterator.
+
+    :param iterator:          Iterator (e.g., generator) to draw items
+                              from. Only the LazySequence should use it.
+
+    :param chunk_size=256:    Items to pull from iterator at a time.
+
+    :param memory_chunks=None:  If not None, keep at most this many
+                                chunks in memory and spill older ones to
+                                a temporary file (so items must pickle).
+
+    Iterate over the LazySequence as many times (and from as many threads)
+    as you like. If the iterator raises an exception, every consumer
+    which gets to that point gets a copy of it (see core.fresh_exception)
+    and `error` holds the original (without its traceback).
+    """
+
+    def __init__(self, iterator, chunk_size=256, memory_chunks=None):
+        self._iterator = iter(iterator)
+        self.chunk_size = chunk_size
+        self.memory_chunks = memory_chunks
+        self._chunks = []   # list of chunk (list) or _Spilled
+        self._in_memory = []  # indexes of chunks in memory (oldest first)
+        self._lock = threading.Lock()
+        self._spill_file = None
+        self._error = None
+        self.produced = 0
+        self.spilled_chunks = 0
+        self.done = False
+
+    def _fill(self, index):
+        """Make sure chunk index exists (if there are enough items).
+
+        :return:  True if chunk index exists, False if iterator ended.
+        """
+        with self._lock:  # only one consumer drives the iterator
+            while len(self._chunks) <= index:
+                if self._error is not None:
+                    raise fresh_exception(self._error)
+                if self.done:
+                    return False
+                chunk = []
+                try:
+                    for dummy in range(self.chunk_size):
+                        chunk.append(next(self._iterator))
+                except StopIteration:
+                    self.done = True
+                    self._iterator = None
+                except Exception as problem:
+                    self._error = problem.with_traceback(None)
+                    self._iterator = None
+                if chunk:
+                    self._add_chunk(chunk)
+            return True
+
+    @property
+    def error(self):
+        "Exception raised by the iterator (or None if it has not raised)."
+        return self._error
+
+    def _add_chunk(self, chunk):
+        "Add chunk spilling old chunks if needed (requires self._lock)."
+        self._chunks.append(chunk)
+        self._in_memory.append(len(self._chunks) - 1)
+        self.produced += len(chunk)
+        if self.memory_chunks is None:
+            return
+        while len(self._in_memory) > self.memory_chunks:
+            oldest = self._in_memory.pop(0)
+            if self._spill_file is None:
+                self._spill_file = tempfile.TemporaryFile()
+            data = pickle.dumps(self._chunks[oldest],
+                                protocol=pickle.HIGHEST_PROTOCOL)
+            self._spill_file.seek(0, 2)
+            self._chunks[oldest] = _Spilled(self._spill_file.tell(),
+                                            len(data))
+            self._spill_file.write(data)
+            self.spilled_chunks += 1
+
+    def _chunk(self, index):
+        "Return items for chunk index (reading it back if spilled)."
+        chunk = self._chunks[index]
+        if chunk.__class__ is not _Spilled:
+            return chunk
+        with self._lock:
+            self._spill_file.seek(chunk.offset)
+            return pickle.loads(self._spill_file.read(chunk.size))
+
+    def __iter__(self):
+        index = 0
+        while index < len(self._chunks) or self._fill(index):
+            yield from self._chunk(index)
+            index += 1
+
+    def close(self):
+        "Close the spill file (if any); the sequence can no longer replay."
+        with self._lock:
+            if self._spill_file is not None:
+                self._spill_file.close()
+                self._spill_file = None
+
+    def __repr__(self):
+        return '<%s produced=%i done=%s>' % (
+            self.__class__.__name__, self.produced, self.done)
+
+
+if __name__ == '__main__':
+    doctest.testmod()
+    print('Finished tests')
@@ -0,0 +1,316 @@
+"""Dict-like storage classes for caches.
+
+A cache keeps its data in whatever `make_storage` returns (an
+IndexedStorage by default). Sub-classes can return other dict-like
+structures but then lose the features described below.
+
+The in-memory storage keeps references to payloads so it never copies
+them. Storage which keeps bytes somewhere else (a file, an mmap, shared
+memory) can use `payload_segments` and `load_payload` so that large
+buffers (bytes, bytearray, memoryview, numpy arrays, etc.) are written
+as raw segments and come back as read-only views of the storage:
+
+>>> import mmap
+>>> from ox_cache.storage import payload_segments, load_payload
+>>> value = {'name': 'blob', 'data': bytes(range(200)) * 100}
+>>> segments = payload_segments(value)
+>>> size = sum(memoryview(seg).nbytes for seg in segments)
+>>> backing = mmap.mmap(-1, size)  # e.g., shared memory or a file
+>>> offset = 0
+>>> for seg in segments:
+...     seg = memoryview(seg).cast('B')
+...     backing[offset:offset + seg.nbytes] = seg
+...     offset += seg.nbytes
+...
+>>> loaded = load_payload(backing)
+>>> loaded['name'], loaded['data'] == value['data']
+('blob', True)
+>>> loaded['data'].readonly, loaded['data'].obj is backing  # not copied
+(True, True)
+>>> del loaded  # release views before closing the mmap
+>>> backing.close()
+"""
+
+import doctest
+import itertools
+import pickle
+import random
+import struct
+
+
+class LogCursor:
+    """Position in IndexedStorage.key_log which compaction keeps valid.
+
+    :param position:  Index of the next slot to look at.
+
+    :param stop:      Index to stop at.
+    """
+
+    __slots__ = ('position', 'stop')
+
+    def __init__(self, position, stop):
+        self.position = position
+        self.stop = stop
+
+
+class IndexedStorage(dict):
+    """Dict which also keeps a log of keys in insertion order.
+
+A plain dict cannot be walked a little at a time while other code
+changes it (the iterator breaks) and picking a random key requires
+something like `random.choice(list(data))` which copies every key.
+The IndexedStorage appends each new key to `self.key_log` so that:
+
+  1. `random_key` can index the log directly in O(1) (expected).
+  2. Code can walk the log by position (see OxCacheBase.iter_batches)
+     using the LogCursor returned by `pin` until calling `unpin`.
+
+Deleting a key leaves a stale slot in the log. Once stale slots
+outnumber live keys, we compact the log so the amortized cost of a
+delete stays O(1) and the log stays at most twice the size of the dict.
+This also happens while pinned: compaction moves the `position` and
+`stop` of every pinned cursor to the matching place in the new log so
+walks in progress neither skip nor repeat keys:
+
+>>> import random
+>>> from ox_cache.storage import IndexedStorage
+>>> data, rng = IndexedStorage(), random.Random(7)
+>>> for i in range(5):
+...     data[i] = i * i
+...
+>>> data[2] = 'replaced'   # replacing a value does not change the log
+>>> del data[0]            # leaves a stale slot in the log
+>>> data.key_log, len(data), data[2]
+([0, 1, 2, 3, 4], 4, 'replaced')
+>>> sorted(set(data.random_key(rng) for dummy in range(50)))
+[1, 2, 3, 4]
+>>> cursor = data.pin()    # walk from cursor.position to cursor.stop
+>>> cursor.position, cursor.stop
+(0, 5)
+>>> cursor.position = 3    # walker has looked at slots 0, 1 and 2
+>>> data.pop(3), data.pop(3, None), data.popitem()  # 3 stale > 2 live
+(9, None, (4, 16))
+>>> data.key_log, data, (cursor.position, cursor.stop)  # compacted
+([1, 2], {1: 1, 2: 'replaced'}, (2, 2))
+>>> for i in range(1000):  # churn while pinned keeps the log bounded
+...     data[10 + i % 10] = i
+...     del data[10 + i % 10]
+...
+>>> len(data.key_log) <= 2 * len(data) + 1, cursor.position, cursor.stop
+(True, 2, 2)
+>>> data.unpin(cursor)
+>>> data.clear()
+>>> len(data), data.key_log, data.random_key()
+(0, [], None)
+
+Only the methods which change keys are overridden so lookups keep the
+speed of a plain dict.
+    """
+
+    __slots__ = ('key_log', '_stale', '_pins')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.key_log = []
+        self._stale = 0     # number of slots in key_log for deleted keys
+        self._pins = set()  # tokens for callers who need stable positions
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.key_log.append(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._removed()
+
+    def _removed(self):
+        "Note that a key was removed and compact the log if worthwhile."
+        self._stale += 1
+        if self._stale > len(self):
+            self._compact()
+
+    def _compact(self):
+        "Rebuild key_log from live keys moving pinned cursors to match."
+        if self._pins:
+            log, seen = self.key_log, set()
+            keep = bytearray(len(log))  # 1 for the current slot of a key
+            for index in range(len(log) - 1, -1, -1):
+                key = log[index]
+                if key not in seen and key in self:
+                    seen.add(key)
+                    keep[index] = 1
+            kept_before = list(itertools.accumulate(keep, initial=0))
+            for cursor in self._pins:
+                cursor.position = kept_before[cursor.position]
+                cursor.stop = kept_before[cursor.stop]
+            self.key_log = list(itertools.compress(log, keep))
+        else:
+            self.key_log = list(self)
+        self._stale = 0
+
+    def pop(self, key, *default):
+        if key in self:
+            value = super().pop(key)
+            self._removed()
+            return value
+        return super().pop(key, *default)
+
+    def popitem(self):
+        item = super().popitem()
+        self._removed()
+        return item
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        super().clear()
+        for cursor in self._pins:
+            cursor.position = cursor.stop = 0
+        self.key_log = []
+        self._stale = 0
+
+    def pin(self):
+        """Return a cursor for walking key_log by position.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        :return:  LogCursor with position 0 and stop at the current end
+                  of self.key_log. Pass it to unpin when done.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  The walker reads key_log[cursor.position:cursor.stop]
+                  and advances cursor.position as it goes. Between
+                  compactions keys stay where they are (though they may
+                  be deleted from the dict) and new keys are only
+                  appended. A compaction moves position and stop of every
+                  pinned cursor to the same place in the new log. Adding
+                  a cursor to a set is atomic so this is safe under a
+                  shared lock (compaction only happens on deletes which
+                  need the exclusive lock).
+        """
+        cursor = LogCursor(0, len(self.key_log))
+        self._pins.add(cursor)
+        return cursor
+
+    def unpin(self, cursor):
+        "Release cursor from pin (compaction happens on a later delete)."
+        self._pins.discard(cursor)
+
+    def random_key(self, rng=random):
+        """Return a random key (or None if empty).
+
+        :param rng=random:  Random number generator to use.
+
+        ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+        PURPOSE:  Pick a random slot in key_log until we find a live
+                  key. Since at most half the slots are stale (unless
+                  the storage is pinned) this takes O(1) expected tries.
+        """
+        log = self.key_log
+        while self:
+            key = log[rng.randrange(len(log))]
+            if key in self:
+                return key
+        return None
+
+
+_SEGMENT_HEADER = struct.Struct('<4sII')  # magic, pickle size, buffer count
+_SEGMENT_SIZE = struct.Struct('<Q')
+_SEGMENT_MAGIC = b'OXP5'
+SEGMENT_ALIGN = 64  # raw buffers start at multiples of this (for SIMD)
+
+
+def _pad(size):
+    "Return number of bytes to pad size to a multiple of SEGMENT_ALIGN."
+    return -size % SEGMENT_ALIGN
+
+
+def payload_segments(value):
+    """Serialize value into a list of segments without copying buffers.
+
+    :param value:   Payload to serialize.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  List of objects supporting the buffer protocol which should
+              be written out back to back. Bytes, bytearray and
+              memoryview payloads (or values of a dict payload), plus
+              anything pickle protocol 5 sends out-of-band (e.g., numpy
+              arrays), are included as views of the original data
+              rather than copies. They load as read-only memoryviews.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    PURPOSE:  Storage outside the process has to copy a payload once to
+              write it. This lets it write each segment straight into
+              its destination (e.g., with `file.writelines` or slice
+              assignment into an mmap) without pickling large buffers
+              into an intermediate bytes object first.
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value = pickle.PickleBuffer(value)
+    elif isinstance(value, dict):
+        value = {key: (pickle.PickleBuffer(item) if isinstance(
+            item, (bytes, bytearray, memoryview)) else item)
+                 for key, item in value.items()}
+    buffers = []
+    header = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+    raws = [buf.raw() for buf in buffers]
+    sizes = b''.join(_SEGMENT_SIZE.pack(raw.nbytes) for raw in raws)
+    prefix = _SEGMENT_HEADER.pack(_SEGMENT_MAGIC, len(header), len(raws))
+    segments = [prefix, sizes, header]
+    position = len(prefix) + len(sizes) + len(header)
+    for raw in raws:
+        segments.append(bytes(_pad(position)))
+        position += _pad(position)
+        segments.append(raw)
+        position += raw.nbytes
+    return segments
+
+
+def load_payload(segment):
+    """Load payload written from payload_segments without copying buffers.
+
+    :param segment:   Object supporting the buffer protocol (e.g., bytes,
+                      mmap, or shared memory buffer) holding the segments
+                      from payload_segments back to back.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  The payload where out-of-band buffers are read-only views
+              backed by segment (e.g., memoryview or numpy arrays).
+              Callers must drop these views before closing an mmap.
+    """
+    view = memoryview(segment).toreadonly().cast('B')
+    magic, header_size, count = _SEGMENT_HEADER.unpack_from(view)
+    if magic != _SEGMENT_MAGIC:
+        raise ValueError('Segment does not start with %r' % _SEGMENT_MAGIC)
+    position = _SEGMENT_HEADER.size
+    sizes = []
+    for dummy in range(count):
+        sizes.append(_SEGMENT_SIZE.unpack_from(view, position)[0])
+        position += _SEGMENT_SIZE.size
+    header = view[position:position + header_size]
+    position += header_size
+    buffers = []
+    for size in sizes:
+        position += _pad(position)
+        buffers.append(view[position:position + size])
+        position += size
+    return pickle.loads(header, buffers=buffers)
+
+
+if __name__ == '__main__':
+    doctest.testmod()
+    print('Finished tests')
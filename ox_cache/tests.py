@@ -3,28 +3,9 @@
 
 import logging
 import doctest
-import random
 
-from ox_cache.mixins import TimedExpiryMixin
+from ox_cache.mixins import TimedExpiryMixin, RandomReplacementMixin
 from ox_cache.memoizers import OxMemoizer
-from ox_cache.locks import FakeLock
-
-
-class RandomReplacementMixin:
-    """Example mixin to do random replacement.
-    """
-
-    def __init__(self, *args, max_size=128, **kwargs):
-        self.max_size = max_size
-        super().__init__(*args, **kwargs)
-
-    def _pre_store(self, key, value, ttl_info=None, **opts):
-        dummy = key, value, ttl_info, opts
-        while len(self._data) >= self.max_size:
-            full_key_to_delete = random.choice(list(self._data))
-            logging.debug('%s will remove key %s',
-                          self.__class__.__name__, full_key_to_delete)
-            self._delete_full_key(full_key_to_delete, lock=FakeLock())
 
 
 class RandomReplacementMemoizer(
@@ -103,6 +84,1281 @@ opts were {'__not_keys': ('tag',), 'tag': 'foo'}
 OxCacheFullKey(...)
     """
 
+
+def _regr_test_reentrant_lock():
+    """Test that a reentrant lock lets make_value call store directly.
+
+>>> from ox_cache import OxCacheBase
+>>> from ox_cache.locks import TimeoutLock
+>>> class PairCache(OxCacheBase):
+...     'Cache which also stores the negated key when making a value.'
+...     def make_value(self, key, **opts):
+...         self.store(-key, 'neg %s' % key)  # no lock=NO_LOCK needed
+...         return 'pos %s' % key
+...
+>>> cache = PairCache(lock=TimeoutLock(timeout=2, reentrant=True))
+>>> cache.get(3)
+'pos 3'
+>>> cache.get(-3, allow_refresh=False)
+'neg 3'
+    """
+
+
+def _regr_test_read_write_mode():
+    """Test many threads hitting a cache in read-write mode.
+
+>>> import threading
+>>> from ox_cache import OxMemoizer
+>>> from ox_cache.locks import ReadWriteLock, TimeoutLock
+>>> def square(x):
+...     'Square the input'
+...     return x * x
+...
+>>> memo = OxMemoizer(square, lock=ReadWriteLock(timeout=10))
+>>> errors = []
+>>> def worker(offset):
+...     try:
+...         for i in range(2000):
+...             value = (i + offset) % 50
+...             assert memo(value) == value * value
+...             if i % 97 == 0:
+...                 try:
+...                     memo.delete(value)
+...                 except KeyError:  # another thread deleted it first
+...                     pass
+...     except Exception as problem:
+...         errors.append(problem)
+...
+>>> threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+>>> for thread in threads:
+...     thread.start()
+...
+>>> for thread in threads:
+...     thread.join()
+...
+>>> errors, len(memo) <= 50, memo.lock._readers
+([], True, 0)
+>>> class CountingMemoizer(OxMemoizer):
+...     'Memoizer which counts calls to _pre_get.'
+...     pre_gets = 0
+...     def _pre_get(self, key, allow_refresh, **opts):
+...         CountingMemoizer.pre_gets += 1
+...
+>>> memo = CountingMemoizer(square, lock=ReadWriteLock(timeout=10))
+>>> memo(3), CountingMemoizer.pre_gets  # miss only calls hook once
+(9, 1)
+>>> memo(3), CountingMemoizer.pre_gets
+(9, 2)
+>>> memo.lock = ReadWriteLock()  # read_lock follows a new lock
+>>> memo.read_lock is memo.lock.shared, memo(3), memo.lock._readers
+(True, 9, 0)
+>>> memo.lock = TimeoutLock()
+>>> memo.read_lock is memo.lock
+True
+    """
+
+
+def _regr_test_lock_free_lru_hits():
+    """Test buffered LRU hits take no lock while evictions stay correct.
+
+>>> import threading
+>>> from ox_cache import OxCacheBase, LRUReplacementMixin
+>>> class CountingLock:
+...     'Lock which counts how often it is taken.'
+...     def __init__(self):
+...         self.lock, self.count = threading.RLock(), 0
+...     def __enter__(self):
+...         self.count += 1
+...         return self.lock.__enter__()
+...     def __exit__(self, *exc):
+...         return self.lock.__exit__(*exc)
+...
+>>> class LRUCache(LRUReplacementMixin, OxCacheBase):
+...     'Buffered LRU cache.'
+...     def make_value(self, key, **opts):
+...         return key * 2
+...
+>>> cache = LRUCache(max_size=2, recency_buffer=64, lock=CountingLock())
+>>> cache.get(1), cache.get(2), cache.lock.count  # misses take the lock
+(2, 4, 2)
+>>> [cache.get(1) for dummy in range(100)] == [2] * 100, cache.lock.count
+(True, 2)
+>>> cache.get(3), cache.exists(1), cache.exists(2)  # hits still count
+(6, True, False)
+>>> cache = LRUCache(max_size=20, recency_buffer=16)
+>>> errors = []
+>>> def worker(offset):
+...     try:
+...         for i in range(3000):
+...             value = (i * 7 + offset) % 30
+...             assert cache.get(value) == value * 2
+...     except Exception as problem:
+...         errors.append(problem)
+...
+>>> threads = [threading.Thread(target=worker, args=(n,)) for n in range(6)]
+>>> for thread in threads:
+...     thread.start()
+...
+>>> for thread in threads:
+...     thread.join()
+...
+>>> cache.maintenance()
+>>> errors, len(cache) <= 20, sorted(cache._tracker) == sorted(cache)
+([], True, True)
+    """
+
+
+def _regr_test_trace_replay():
+    """Test lean and full trace replays agree and invalidations replay.
+
+>>> import os, random, tempfile
+>>> from ox_cache import OxCacheBase, TagIndexMixin, LRUReplacementMixin
+>>> from ox_cache import trace
+>>> path = os.path.join(tempfile.mkdtemp(), 'mixed.trace')
+>>> rand = random.Random(3)
+>>> with trace.TraceWriter(path) as writer:
+...     for i in range(5000):
+...         key, roll = rand.randrange(300), rand.random()
+...         if roll < 0.05:
+...             writer.record(trace.OP_DELETE, key)
+...         elif roll < 0.1:
+...             writer.record(trace.OP_REFRESH, key, cost=key / 100.0)
+...         elif roll < 0.101:
+...             writer.record(trace.OP_RESET, 0)
+...         else:
+...             writer.record(trace.OP_GET, key)
+...
+>>> lean = trace.simulate(path, 'lru', 50)
+>>> full = trace.simulate(path, LRUReplacementMixin, 50)
+>>> lean._replace(policy=None) == full._replace(policy=None)
+True
+>>> class Tagged(trace.TraceRecorderMixin, TagIndexMixin, OxCacheBase):
+...     'Tagged cache which records a trace.'
+...     def make_value(self, key, **opts):
+...         return key
+...
+>>> path = os.path.join(tempfile.mkdtemp(), 'tags.trace')
+>>> cache = Tagged(trace=path)
+>>> for key in range(4):
+...     cache.store(key, key, tags=['even' if key % 2 == 0 else 'odd'])
+...
+>>> data = [cache.get(key) for key in range(4)]
+>>> len(cache.invalidate_tag('even'))
+2
+>>> data = [cache.get(key) for key in range(4)]
+>>> cache.close_trace()
+>>> [event[1] for event in trace.read_trace(path)].count(trace.OP_DELETE)
+2
+>>> trace.simulate(path, 'lru', 100).misses  # 4 cold and 2 invalidated
+6
+    """
+
+
+def _regr_test_compact_entries():
+    """Test compact keys and items keep their old behaviour.
+
+>>> import pickle, datetime, warnings
+>>> from ox_cache import OxCacheBase, TimedExpiryMixin, OxCacheFullKey
+>>> key = OxCacheBase().make_key('f', y=2, x=1)
+>>> key.namespace, key.base_key, key.opts
+('default', 'f', (('x', 1), ('y', 2)))
+>>> pickle.loads(pickle.dumps(key)) == key
+True
+>>> key._replace(base_key='g')
+OxCacheFullKey(namespace='default', base_key='g', opts=(('x', 1), ('y', 2)))
+>>> class TimedCache(TimedExpiryMixin, OxCacheBase):
+...     'Timed cache for testing.'
+...
+>>> cache = TimedCache(expiry_seconds=100)
+>>> cache.store('old', 1, ttl_info=datetime.datetime.utcnow())
+>>> cache.store('new', 2)
+>>> with warnings.catch_warnings(record=True) as caught:
+...     warnings.simplefilter('always')
+...     cache.ttl('old') > 90, cache.ttl('new') > 90
+...
+(True, True)
+>>> [str(item.message)[:31] for item in caught
+...  if item.category is DeprecationWarning and 'ttl_info' in str(
+...      item.message)]
+['datetime ttl_info is deprecated']
+>>> namespace, base_key, opts = cache.make_key('f', x=(1, 2))
+>>> namespace, base_key, opts
+('default', 'f', (('x', (1, 2)),))
+>>> record = cache.get_record(cache.make_key('new'))
+>>> payload, ttl_info = record
+>>> payload, isinstance(ttl_info, float)
+(2, True)
+    """
+
+
+def _regr_test_hash_once():
+    """Test that keys with tuples are hashed once per operation.
+
+>>> from ox_cache import OxCacheBase, LRUReplacementMixin
+>>> class CountHash:
+...     'Hashable object which counts calls to __hash__.'
+...     calls = 0
+...     def __hash__(self):
+...         CountHash.calls += 1
+...         return 7
+...
+>>> class LRUCache(LRUReplacementMixin, OxCacheBase):
+...     'Cache for testing.'
+...     def make_value(self, key, **opts):
+...         return 'made'
+...
+>>> cache, item = LRUCache(), CountHash()
+>>> cache.get((item,)), CountHash.calls  # miss: key built twice
+('made', 2)
+>>> cache.get((item,)), CountHash.calls  # hit: key built once
+('made', 3)
+>>> full_key = cache.make_key((item,))
+>>> cache.get(full_key), cache.exists(full_key), CountHash.calls
+('made', True, 4)
+    """
+
+
+def _regr_test_namespace_quotas():
+    """Test that per-namespace LRU quotas isolate namespaces.
+
+>>> from ox_cache import OxCacheBase, LRUReplacementMixin, NamespaceIndexMixin
+>>> class QuotaCache(NamespaceIndexMixin, LRUReplacementMixin, OxCacheBase):
+...     'Cache for testing.'
+...     def make_value(self, key, **opts):
+...         return 'x' * key
+...
+>>> cache = QuotaCache(max_size=100, namespace_max_size={'noisy': 3},
+...                    namespace_max_bytes={'big': 10}, sizeof=len)
+>>> cache.get(1, namespace='quiet')
+'x'
+>>> data = [cache.get(i, namespace='noisy') for i in range(10)]
+>>> cache.namespace_len('noisy'), cache.exists(1, namespace='quiet')
+(3, True)
+>>> sorted(k.base_key for k in cache.namespace_keys('noisy'))
+[7, 8, 9]
+>>> data = [cache.get(i, namespace='big') for i in [4, 5, 3]]
+>>> sorted(k.base_key for k in cache.namespace_keys('big'))
+[3, 5]
+>>> cache.get(5, namespace='big')  # touch 5 so 3 is evicted next
+'xxxxx'
+>>> cache.store(4, 'abcd', namespace='big')
+>>> sorted(k.base_key for k in cache.namespace_keys('big'))
+[4, 5]
+>>> cache.store(4, 'ab', namespace='big')  # replacing does not evict
+>>> sorted(k.base_key for k in cache.namespace_keys('big'))
+[4, 5]
+>>> cache.reset(namespace='noisy')
+>>> len(cache), sorted(cache.namespaces())
+(3, ['big', 'quiet'])
+>>> cache.reset()
+>>> len(cache), cache.namespaces(), len(cache._tracker)
+(0, [], 0)
+>>> cache = QuotaCache(max_size=2, namespace_max_size=2)
+>>> for key in 'aba':  # global eviction removes a before a is re-stored
+...     cache.store(key, key)
+...
+>>> sorted(k.base_key for k in cache._ns_trackers['default'])
+['a', 'b']
+    """
+
+
+def _regr_test_tag_index():
+    """Test tag index with eviction and chained dependencies.
+
+>>> from ox_cache import (
+...     OxCacheBase, LRUReplacementMixin, TagIndexMixin)
+>>> class TagLRU(TagIndexMixin, LRUReplacementMixin, OxCacheBase):
+...     'Cache for testing.'
+...     track_dependencies = True
+...     def make_value(self, key, **opts):
+...         return [key]
+...
+>>> base = TagLRU(max_size=3)
+>>> class Mid(TagLRU):
+...     'Mid level cache which uses base.'
+...     def make_value(self, key, **opts):
+...         return base.get(key) + ['mid']
+...
+>>> class Top(TagLRU):
+...     'Top level cache which uses mid.'
+...     def make_value(self, key, **opts):
+...         return mid.get(key) + ['top']
+...
+>>> mid, top = Mid(), Top()
+>>> top.get('x'), top.get('y')
+(['x', 'mid', 'top'], ['y', 'mid', 'top'])
+>>> removed = base.invalidate_tag('missing')
+>>> base.invalidate('x')  # cascades through mid to top
+>>> mid.exists('x'), top.exists('x'), top.exists('y')
+(False, False, True)
+>>> data = [base.get(i) for i in range(5)]  # evicts y from base
+>>> len(base), len(base._key_tags), base.exists('y')  # no tag sets
+(3, 0, False)
+>>> len(base._dependent_caches)  # mid still depends on evicted y
+1
+>>> base.invalidate('y')  # so the cascade still reaches top
+>>> mid.exists('y'), top.exists('y'), len(top._key_tags)
+(False, False, 0)
+>>> len(base._dependent_caches), len(mid._dependent_caches)
+(0, 0)
+>>> data = [top.get(i) for i in range(20)]
+>>> len(base), len(base._dependent_caches), len(mid._dependent_caches)
+(3, 20, 20)
+>>> mid.reset()  # dependents in mid are gone so base forgets them
+>>> len(base._dependent_caches), len(mid._dependent_caches)
+(0, 20)
+>>> top.reset()
+>>> len(mid._dependent_caches)
+0
+>>> class Failing(TagLRU):
+...     'Cache whose values fail after using base.'
+...     def make_value(self, key, **opts):
+...         base.get(key)
+...         raise ValueError(key)
+...
+>>> failing = Failing()
+>>> failing.get('z')
+Traceback (most recent call last):
+...
+ValueError: z
+>>> len(base._dependent_caches)  # failed refresh leaves no edge behind
+0
+    """
+
+
+def _regr_test_sorted_key_index():
+    """Test sorted index stays consistent under deletes, evictions and reset.
+
+>>> import random
+>>> from ox_cache import (
+...     OxCacheBase, LRUReplacementMixin, SortedKeyIndexMixin,
+...     TimedExpiryMixin)
+>>> class SortedLRU(SortedKeyIndexMixin, LRUReplacementMixin,
+...                 TimedExpiryMixin, OxCacheBase):
+...     'Small LRU cache with a sorted index.'
+...     def make_value(self, key, **opts):
+...         return key
+...
+>>> def consistent(cache):
+...     'Check the sorted index matches what is in the cache.'
+...     expected = {}
+...     for full_key in cache:
+...         if isinstance(full_key.base_key, str):
+...             expected.setdefault(full_key.base_key, set()).add(full_key)
+...     return (cache._sorted_base_keys == sorted(expected) and
+...             cache._base_key_index == expected)
+...
+>>> cache, rand = SortedLRU(max_size=20), random.Random(5)
+>>> problems = []
+>>> for step in range(3000):
+...     key = rand.choice(['k%02i' % rand.randrange(40), rand.randrange(9)])
+...     namespace = rand.choice(['a', 'b'])
+...     roll = rand.random()
+...     if roll < 0.6:
+...         data = cache.get(key, namespace=namespace)  # may evict
+...     elif roll < 0.8:
+...         if cache.exists(key, namespace=namespace):
+...             cache.delete(key, namespace=namespace)
+...     elif roll < 0.95:
+...         data = cache.delete_prefix('k%i' % rand.randrange(4))
+...     elif roll < 0.99:
+...         old = cache.create_ttl(None) - 7200
+...         cache.store(key, key, ttl_info=old, namespace=namespace)
+...         data = cache.clean()
+...     else:
+...         cache.reset()
+...     if not consistent(cache):
+...         problems.append(step)
+...
+>>> problems, len(cache) <= 20
+([], True)
+>>> cache.reset()
+>>> cache._sorted_base_keys, cache._base_key_index, cache.keys_with_prefix('')
+([], {}, [])
+    """
+
+
+def _regr_test_iter_batches():
+    """Test that lazy iteration and clean survive concurrent changes.
+
+>>> import random
+>>> from ox_cache import OxCacheBase, TimedExpiryMixin
+>>> class TimedCache(TimedExpiryMixin, OxCacheBase):
+...     'Cache for testing.'
+...
+>>> cache, rng, seen = TimedCache(expiry_seconds=60), random.Random(3), set()
+>>> for i in range(200):
+...     cache.store(i, i)
+...
+>>> for chunk in cache.iter_batches(batch=7):
+...     seen.update(k.base_key for k, dummy in chunk)
+...     cache.delete(rng.choice([k.base_key for k in cache]))
+...     cache.store(1000 + len(seen), 'new')
+...
+>>> missed = {k.base_key for k in cache if k.base_key < 1000} - seen
+>>> missed, max(seen) < 1000  # new keys are not walked so the walk ends
+(set(), True)
+>>> for key in range(0, 200, 2):  # expire half of the original keys
+...     if cache.exists(key):
+...         cache.store(key, key, ttl_info=cache.create_ttl(key) - 120)
+...
+>>> expired = [k for k in cache if cache.expired(k)]
+>>> removed = cache.clean(batch=5)
+>>> sorted(k for k, dummy in removed) == sorted(expired), len(expired) > 50
+(True, True)
+>>> any(cache.expired(k) for k in cache)
+False
+>>> cache = OxCacheBase()
+>>> for i in range(100):
+...     cache.store(i, i)
+...
+>>> seen, longest = [], 0
+>>> for chunk in cache.iter_batches(batch=3):  # heavy churn while pinned
+...     seen.extend(k.base_key for k, dummy in chunk)
+...     for j in range(200):
+...         cache.store(('churn', j), j)
+...         cache.delete(('churn', j))
+...     longest = max(longest, len(cache._data.key_log))
+...
+>>> sorted(seen) == list(range(100)), longest <= 2 * len(cache) + 1
+(True, True)
+    """
+
+
+def _regr_test_sampled_lru():
+    """Test that sampled LRU tracks exact LRU hit ratio on a skewed trace.
+
+>>> from ox_cache.benchmarks import (
+...     hit_ratio, replacement_policies, zipf_trace)
+>>> trace, policies = zipf_trace(2000, 20000), replacement_policies()
+>>> ratios = {name: hit_ratio(policies[name], trace, 200)
+...           for name in ['lru', 'sampled_lru', 'random']}
+>>> abs(ratios['sampled_lru'] - ratios['lru']) < 0.02
+True
+>>> ratios['sampled_lru'] > ratios['random']
+True
+
+Sampling also works with a plain dict for storage and the access stamp
+combines with the generation stamp of GenerationalMixin on one record:
+
+>>> import random
+>>> from ox_cache import OxCacheBase, SampledLRUMixin, GenerationalMixin
+>>> class Combined(SampledLRUMixin, GenerationalMixin, OxCacheBase):
+...     'Sampled LRU cache with generations and dict storage.'
+...     def make_storage(self):
+...         return {}
+...     def make_value(self, key, **opts):
+...         return key
+...
+>>> cache = Combined(max_size=10, rng=random.Random(2))
+>>> data = [cache.get(i) for i in range(50)]
+>>> record = cache.get_record(cache.make_key(49))
+>>> len(cache), record.access > 0, record.generation is not None
+(10, True, True)
+>>> cache.bump_generation(); cache.expired(49)
+True
+    """
+
+
+def _regr_test_negative_caching():
+    """Test concurrent waiters share a cached error and recovery works.
+
+>>> import threading, time
+>>> from ox_cache import NegativeCachingMixin, TimedMemoizer
+>>> class NegativeMemoizer(NegativeCachingMixin, TimedMemoizer):
+...     'Timed memoizer which caches errors.'
+...
+>>> state = {'calls': 0, 'down': True}
+>>> def fetch(key):
+...     'Fetch from a slow backend which may be down.'
+...     state['calls'] += 1
+...     time.sleep(0.05)
+...     if state['down']:
+...         raise IOError('down')
+...     return key.upper()
+...
+>>> memo = NegativeMemoizer(fetch, error_ttl=0.2)
+>>> errors = []
+>>> def worker():
+...     try:
+...         memo('a')
+...     except IOError as problem:
+...         errors.append(str(problem))
+...
+>>> threads = [threading.Thread(target=worker) for dummy in range(8)]
+>>> for thread in threads:
+...     thread.start()
+...
+>>> for thread in threads:
+...     thread.join()
+...
+>>> errors == ['down'] * 8, state['calls']
+(True, 1)
+>>> import traceback
+>>> def depth():
+...     'Return depth of traceback for the cached error.'
+...     try:
+...         memo('a')
+...     except IOError as problem:
+...         return len(traceback.extract_tb(problem.__traceback__))
+...
+>>> depth() == depth() == depth(), state['calls']  # traceback not growing
+(True, 1)
+>>> state['down'] = False
+>>> time.sleep(0.25)  # wait for cached error to expire
+>>> memo('a'), state['calls'], memo.ttl('a') > 3000
+('A', 2, True)
+>>> def broken(key):
+...     'Function with a bug which should not be cached.'
+...     state['calls'] += 1
+...     raise KeyError(key)
+...
+>>> memo = NegativeMemoizer(broken)
+>>> for attempt in range(2):
+...     try:
+...         memo('b')
+...     except KeyError:
+...         pass
+...
+>>> state['calls'], len(memo)  # only OSError is cached by default
+(4, 0)
+    """
+
+
+def _regr_test_refresh_ahead_limits():
+    """Test refresh ahead deduplicates and rate limits refreshes.
+
+>>> import threading, time
+>>> from ox_cache import OxCacheBase, TimedExpiryMixin, RefreshAheadMixin
+>>> release, made = threading.Event(), []
+>>> class SlowCache(RefreshAheadMixin, TimedExpiryMixin, OxCacheBase):
+...     'Cache with slow refreshes.'
+...     def make_value(self, key, **opts):
+...         if made.count(key):  # background refresh waits for release
+...             release.wait(5)
+...         made.append(key)
+...         return key
+...
+>>> from ox_cache.locks import TimeoutLock
+>>> cache = SlowCache(expiry_seconds=10, refresh_ahead_fraction=1.0,
+...                   refresh_ahead_hits=1, refresh_ahead_rate=1,
+...                   lock=TimeoutLock(timeout=2))
+>>> data = [cache.get(key) for key in range(5)]
+>>> for attempt in range(10):  # all keys in window but rate allows one
+...     data = [cache.get(key) for key in range(5)]
+...
+>>> len(cache._in_flight), cache.get_record(cache.make_key(4)).ahead_hits
+(1, 11)
+>>> cache.store('other', 'ok')  # lock is free while make_value waits
+>>> release.set()
+>>> cache.shutdown_refresh_ahead()
+>>> len(made), len(cache._in_flight)
+(6, 0)
+>>> cache.get_record(cache.make_key(0)).ahead_hits  # refreshed ahead
+0
+    """
+
+
+def _regr_test_streaming_refresh():
+    """Test chunked refresh keeps memory bounded and cleans up on errors.
+
+>>> import threading, tracemalloc
+>>> from ox_cache import OxCacheBase, RefreshDictMixin
+>>> class Rows(RefreshDictMixin, OxCacheBase):
+...     'Cache refreshed from many rows.'
+...     size, chunked = 100000, True
+...     def make_dict(self, key, **opts):
+...         return {i: i for i in range(self.size)}
+...     def make_dict_chunks(self, key, **opts):
+...         if not self.chunked:
+...             yield from super().make_dict_chunks(key, **opts)
+...             return
+...         for start in range(0, self.size, 1000):
+...             yield ((i, i) for i in range(start, start + 1000))
+...
+>>> def peak_extra(cache):
+...     'Return peak memory during refresh beyond what the cache keeps.'
+...     tracemalloc.start()
+...     cache.refresh(0)
+...     current, peak = tracemalloc.get_traced_memory()
+...     tracemalloc.stop()
+...     return peak - current
+...
+>>> chunked, whole = Rows(), Rows()
+>>> whole.chunked = False
+>>> peak_extra(chunked) * 4 < peak_extra(whole)  # extra is mostly resizes
+True
+>>> class Broken(Rows):
+...     'Cache where parsing fails part way through.'
+...     prefetch_chunks = True
+...     def make_dict_chunks(self, key, **opts):
+...         yield [(1, 1)]
+...         raise ValueError('corrupt row')
+...
+>>> before = threading.active_count()
+>>> Broken().refresh(1)
+Traceback (most recent call last):
+...
+ValueError: corrupt row
+>>> threading.active_count() == before
+True
+    """
+
+
+def _regr_test_buffer_keys():
+    """Test memoizing functions of buffers and array-like arguments.
+
+>>> from ox_cache import OxMemoizer
+>>> from ox_cache.normalizers import normalize, BufferFingerprint
+>>> @OxMemoizer
+... def first_row(matrix):
+...     'Return first row of a 2-D memoryview.'
+...     return matrix.tolist()[0]
+...
+>>> grid = memoryview(bytearray(range(6))).cast('B', (2, 3))
+>>> first_row(grid)
+[0, 1, 2]
+>>> grid[0, 0] = 9  # new contents means new key
+>>> first_row(grid), len(first_row)
+([9, 1, 2], 2)
+>>> strided = memoryview(bytes(range(6)))[::2]  # not contiguous
+>>> normalize(strided) == normalize(memoryview(bytes([0, 2, 4])))
+True
+>>> big = bytes(1000)
+>>> isinstance(normalize(big), BufferFingerprint), normalize(big) == (
+...     normalize(bytes(1000)))
+(True, True)
+>>> first_row.refresh(first_row.input_to_full_key(grid))
+Traceback (most recent call last):
+...
+ValueError: Cannot call first_row for key ...
+>>> class Flags:
+...     'Flags like those of a numpy array.'
+...     writeable, c_contiguous = False, False
+...
+>>> class FakeArray:
+...     'Read-only array-like object with an __array_interface__.'
+...     flags, base, copies = Flags(), None, 0
+...     __array_interface__ = {'typestr': '<u1', 'shape': (3,)}
+...     def tobytes(self):
+...         FakeArray.copies += 1
+...         return b'abc'
+...
+>>> frozen = FakeArray()
+>>> normalize(frozen) == normalize(frozen), FakeArray.copies
+(True, 1)
+>>> FakeArray.flags.writeable = True  # no longer safe to remember
+>>> normalize(frozen) == normalize(frozen), FakeArray.copies
+(True, 3)
+>>> normalize(frozen).dtype, normalize(frozen).shape
+('<u1', (3,))
+    """
+
+
+def _regr_test_payload_segments():
+    """Test payload segments round trip and return views of the segment.
+
+>>> from ox_cache.storage import (
+...     payload_segments, load_payload, SEGMENT_ALIGN)
+>>> for value in [bytearray(b'raw'), memoryview(b'view'), 'text', [1, 2]]:
+...     segment = b''.join(payload_segments(value))
+...     print(repr(bytes(load_payload(segment)) if isinstance(
+...         value, (bytearray, memoryview)) else load_payload(segment)))
+...
+b'raw'
+b'view'
+'text'
+[1, 2]
+>>> source = bytearray(b'x' * 1000)
+>>> segments = payload_segments({'a': source, 'b': b'y' * 3, 'c': 1})
+>>> any(memoryview(seg).obj is source for seg in segments)  # no copy
+True
+>>> segment = bytearray(b''.join(segments))
+>>> loaded = load_payload(segment)
+>>> loaded['a'].obj is segment, loaded['a'].readonly, loaded['c']
+(True, True, 1)
+>>> offset = segment.find(b'x' * 1000)
+>>> offset % SEGMENT_ALIGN, bytes(loaded['b'])
+(0, b'yyy')
+>>> load_payload(b'nonsense' * 2)
+Traceback (most recent call last):
+...
+ValueError: Segment does not start with b'OXP5'
+    """
+
+
+def _regr_test_adaptive_ttl():
+    """Test adaptive TTL with digests, expiry and a mutated payload.
+
+>>> import hashlib, time
+>>> from ox_cache import OxCacheBase, AdaptiveTTLMixin
+>>> class Rows(AdaptiveTTLMixin, OxCacheBase):
+...     'Cache of a list which make_value changes in place.'
+...     rows, calls = [1], 0
+...     def make_value(self, key, **opts):
+...         self.calls += 1
+...         return self.rows
+...     def value_digest(self, value):
+...         return hashlib.sha1(repr(value).encode()).digest()
+...
+>>> cache = Rows(initial_ttl=0.2, min_ttl=0.1, max_ttl=1.0)
+>>> cache.get('rows'), cache.calls
+([1], 1)
+>>> cache.rows.append(2)  # same object so == would miss the change
+>>> cache.refresh('rows')
+>>> cache.get_record(cache.make_key('rows')).ttl_info.ttl
+0.1
+>>> time.sleep(0.15)
+>>> cache.expired('rows'), cache.get('rows'), cache.calls
+(True, [1, 2], 3)
+>>> cache.get_record(cache.make_key('rows')).ttl_info.ttl
+0.2
+
+Values which == cannot compare count as changed and other mixins which
+override refresh still run:
+
+>>> from ox_cache import NegativeCachingMixin
+>>> class Ambiguous:
+...     'Value like a numpy array where != gives no single answer.'
+...     def __ne__(self, other):
+...         raise ValueError('ambiguous')
+...
+>>> class Arrays(AdaptiveTTLMixin, NegativeCachingMixin, OxCacheBase):
+...     'Cache of values == cannot compare from a flaky backend.'
+...     down = False
+...     def make_value(self, key, **opts):
+...         if self.down:
+...             raise OSError('down')
+...         return Ambiguous()
+...
+>>> cache = Arrays(initial_ttl=8, min_ttl=1, max_ttl=100)
+>>> data = cache.get('a'); cache.refresh('a')
+>>> cache.get_record(cache.make_key('a')).ttl_info.ttl
+4.0
+>>> cache.down = True; cache.refresh('a')  # error is cached
+>>> cache.get_record(cache.make_key('a')).payload.failures
+1
+    """
+
+
+def _regr_test_cost_aware():
+    """Test GDSF bookkeeping for bytes limits, deletes, hits and resets.
+
+>>> from ox_cache import OxCacheBase, CostAwareReplacementMixin
+>>> from ox_cache.locks import ReadWriteLock
+>>> class Priced(CostAwareReplacementMixin, OxCacheBase):
+...     'Cache where cost is given by the key.'
+...     def make_value(self, key, **opts):
+...         return 'x' * key[1]
+...     def measured_cost(self, full_key, elapsed):
+...         return full_key.base_key[0]
+...
+>>> cache = Priced(max_size=100, max_bytes=30, sizeof=len)
+>>> data = [cache.get(key) for key in [(5, 10), (1, 10), (9, 10)]]
+>>> cache.total_bytes, len(cache)
+(30, 3)
+>>> data = cache.get((2, 10))  # evicts cheapest per byte: (1, 10)
+>>> cache.exists((1, 10)), cache.total_bytes, cache.inflation
+(False, 30, 0.1)
+>>> cache.store((5, 10), 'x' * 20)  # replacing grows it so evict more
+>>> sorted(k.base_key for k, dummy in cache.items()), cache.total_bytes
+([(5, 10), (9, 10)], 30)
+>>> heap_size = len(cache._heap)
+>>> for dummy in range(500):  # hits do not push onto the heap
+...     data = cache.get((9, 10))
+...
+>>> len(cache._heap) == heap_size, cache._gdsf[cache.make_key((9, 10))][1]
+(True, 501)
+>>> cache.delete((9, 10))
+>>> cache.total_bytes, len(cache._gdsf)
+(20, 1)
+>>> cache.reset()
+>>> cache.total_bytes, cache.inflation, cache._heap
+(0, 0.0, [])
+>>> cache = Priced(max_size=2, lock=ReadWriteLock())
+>>> data = [cache.get(key) for key in [(1, 1), (2, 1), (1, 1), (1, 1)]]
+>>> cache._gdsf[cache.make_key((1, 1))][1]  # hits under the shared lock
+3
+>>> data = cache.get((3, 1))  # hits on (1, 1) now outweigh (2, 1)
+>>> cache.exists((1, 1)), cache.exists((2, 1))
+(True, False)
+>>> import time
+>>> class Timed(CostAwareReplacementMixin, OxCacheBase):
+...     'Cache using the time make_value takes as the cost.'
+...     def make_value(self, key, **opts):
+...         time.sleep(key)
+...         return key
+...
+>>> cache = Timed()
+>>> cache.get(0.05) and cache._gdsf[cache.make_key(0.05)][2] >= 0.05
+True
+>>> cache.refresh_outside_lock(0.02)
+>>> cache._gdsf[cache.make_key(0.02)][2] >= 0.02
+True
+    """
+
+
+def _regr_test_thread_local_l0():
+    """Test L0 entries respect expiry, deletes and concurrent stores.
+
+>>> import threading, time
+>>> from ox_cache import (
+...     OxCacheBase, OxMemoizer, ThreadLocalL0Mixin, TimedExpiryMixin)
+>>> class Timed(ThreadLocalL0Mixin, TimedExpiryMixin, OxCacheBase):
+...     'Cache with L0 and short expiry.'
+...     calls = 0
+...     def make_value(self, key, **opts):
+...         self.calls += 1
+...         return self.calls
+...
+>>> cache = Timed(expiry_seconds=0.1)
+>>> cache.get('k'), cache.get('k')
+(1, 1)
+>>> time.sleep(0.15)
+>>> cache.get('k'), cache.get('k')  # expired L0 entry is not used
+(2, 2)
+>>> cache.delete('k')
+>>> cache.get('k', allow_refresh=False, default='gone')
+'gone'
+>>> committed, stale, done = [0], [], threading.Event()
+>>> def writer():
+...     for value in range(1, 3001):
+...         cache.store('x', value)
+...         committed[0] = value
+...     done.set()
+...
+>>> def reader():
+...     while not done.is_set():
+...         floor = committed[0]
+...         value = cache.get('x', allow_refresh=False, default=0)
+...         if value < floor:
+...             stale.append((value, floor))
+...
+>>> cache.expiry_seconds = 3600
+>>> threads = [threading.Thread(target=reader) for dummy in range(3)]
+>>> threads.append(threading.Thread(target=writer))
+>>> for thread in threads:
+...     thread.start()
+...
+>>> for thread in threads:
+...     thread.join()
+...
+>>> stale, cache.get('x')
+([], 3000)
+>>> class Memo(ThreadLocalL0Mixin, OxMemoizer):
+...     'Memoizer with an L0.'
+...
+>>> @Memo
+... def double(x):
+...     'Double x.'
+...     print('called double')
+...     return 2 * x
+...
+>>> double(4), double(4), double(x=4)
+called double
+(8, 8, 8)
+    """
+
+
+def _regr_test_coherence():
+    """Test invalidations are batched, coalesced and work over sockets.
+
+>>> import pickle, tempfile, time
+>>> from ox_cache import OxCacheBase
+>>> from ox_cache.coherence import (
+...     CoherentCacheMixin, InProcessBus, UnixDatagramTransport)
+>>> class Shared(CoherentCacheMixin, OxCacheBase):
+...     'Cache kept coherent with its peers.'
+...     def make_value(self, key, **opts):
+...         return key
+...
+>>> class RecordingBus(InProcessBus):
+...     'Bus which remembers what was published.'
+...     def __init__(self):
+...         super().__init__()
+...         self.sent = []
+...     def publish(self, data):
+...         self.sent.append(pickle.loads(data))
+...         super().publish(data)
+...
+>>> bus = RecordingBus()
+>>> writer = Shared(bus=bus, flush_interval=60, max_batch=3)
+>>> reader = Shared(bus=bus)
+>>> data = [reader.get(key) for key in 'abcd']
+>>> for dummy in range(5):  # coalesced into one pending key
+...     writer.store('a', 'new')
+...
+>>> bus.sent, writer.get('b')  # refresh on miss publishes nothing
+([], 'b')
+>>> writer.store('b', 'new')
+>>> writer.delete('c')  # not here but peers have it so max_batch reached
+Traceback (most recent call last):
+...
+KeyError: ...
+>>> [sorted(key.base_key for key in msg.keys) for msg in bus.sent]
+[['a', 'b', 'c']]
+>>> sorted(key.base_key for key, dummy in reader.items())
+['d']
+>>> writer.store('d', 'new'); writer.reset()  # reset replaces pending keys
+>>> writer.flush_invalidations()
+>>> bus.sent[-1].reset, bus.sent[-1].keys, len(bus.sent), len(reader)
+(True, (), 2, 0)
+>>> directory = tempfile.mkdtemp()
+>>> first = Shared(bus=UnixDatagramTransport(directory), flush_interval=0.01)
+>>> second = Shared(bus=UnixDatagramTransport(directory))
+>>> second.get('x')
+'x'
+>>> first.store('x', 'updated')
+>>> deadline = time.time() + 5
+>>> while second.exists('x') and time.time() < deadline:
+...     time.sleep(0.01)
+...
+>>> second.exists('x')
+False
+>>> flusher = first._flusher
+>>> for key in range(20):  # one flusher thread publishes every batch
+...     first.store(key, key)
+...     time.sleep(0.002)
+...
+>>> first._flusher is flusher, flusher.is_alive()
+(True, True)
+>>> first.close_coherence(); second.close_coherence()
+>>> flusher.join(5); flusher.is_alive()
+False
+
+Only private directories are used and big batches are split to fit:
+
+>>> import os, stat
+>>> private = os.path.join(directory, 'private')
+>>> UnixDatagramTransport(private).close()
+>>> oct(stat.S_IMODE(os.stat(private).st_mode))
+'0o700'
+>>> os.chmod(private, 0o755)
+>>> UnixDatagramTransport(private)
+Traceback (most recent call last):
+...
+ValueError: Directory ... must be owned by us with mode 0700 since ...
+>>> class SmallBus(RecordingBus):
+...     'Bus which only takes small messages.'
+...     max_datagram = 400
+...     def publish(self, data):
+...         assert len(data) <= self.max_datagram
+...         super().publish(data)
+...
+>>> bus = SmallBus()
+>>> writer = Shared(bus=bus, flush_interval=60, max_batch=1000)
+>>> for key in range(100):
+...     writer.store(key, key)
+...
+>>> writer.flush_invalidations()
+>>> len(bus.sent) > 1, sorted(key.base_key for msg in bus.sent
+...                           for key in msg.keys) == list(range(100))
+(True, True)
+>>> writer.store('x' * 1000, 'too big for one message')
+>>> writer.flush_invalidations()
+>>> bus.sent[-1].reset, bus.sent[-1].keys
+(True, ())
+    """
+
+
+def _regr_test_cluster():
+    """Test sharded client against TCP and separate server processes.
+
+>>> import os, subprocess, sys, tempfile, threading, time
+>>> from ox_cache import OxCacheBase
+>>> from ox_cache.cluster import CacheServer, ShardedCacheClient
+>>> class Picky(OxCacheBase):
+...     'Cache which fails for negative keys.'
+...     def make_value(self, key, **opts):
+...         if key < 0:
+...             raise ValueError('negative key %s' % key)
+...         return key + 1
+...
+>>> tcp = [CacheServer(Picky(), ('127.0.0.1', 0)) for dummy in range(2)]
+>>> for server in tcp:
+...     server.start()
+...
+>>> client = ShardedCacheClient([server.address for server in tcp])
+>>> client.get_many([3, -1, 4])
+Traceback (most recent call last):
+...
+ValueError: negative key -1
+>>> client.get_many([3, 4, 5]), client.get(-2, allow_refresh=False)
+([4, 5, 6], None)
+>>> errors = []
+>>> def worker(offset):
+...     for key in range(200):
+...         if client.get(key + offset) != key + offset + 1:
+...             errors.append(key)
+...
+>>> threads = [threading.Thread(target=worker, args=(i * 50,))
+...            for i in range(4)]
+>>> for thread in threads:
+...     thread.start()
+...
+>>> for thread in threads:
+...     thread.join()
+...
+>>> errors, sum(len(server.cache) for server in tcp)
+([], 350)
+>>> client.close()
+>>> for server in tcp:
+...     server.close()
+...
+>>> path = os.path.join(tempfile.mkdtemp(), 'server.sock')
+>>> code = '; '.join([
+...     'from ox_cache import OxCacheBase',
+...     'from ox_cache.cluster import CacheServer',
+...     'CacheServer(OxCacheBase(), %r).serve_forever()' % path])
+>>> process = subprocess.Popen([sys.executable, '-c', code])
+>>> deadline = time.time() + 30
+>>> while not os.path.exists(path) and time.time() < deadline:
+...     time.sleep(0.05)
+...
+>>> remote = ShardedCacheClient([path])
+>>> remote.store(('tuple', 'key'), {'value': 1})
+>>> remote.get(('tuple', 'key'), allow_refresh=False)
+{'value': 1}
+>>> remote.close(); process.terminate(); process.wait() != 0
+True
+
+Servers default to a private unix socket, TCP must be loopback, errors
+which do not pickle still reach the client and records stay remote:
+
+>>> import stat
+>>> class Unpicklable(Exception):
+...     'Error holding something which cannot be pickled.'
+...     def __init__(self):
+...         super().__init__()
+...         self.lock = threading.Lock()
+...
+>>> class Broken(OxCacheBase):
+...     'Cache whose make_value raises an error which does not pickle.'
+...     def make_value(self, key, **opts):
+...         raise Unpicklable()
+...
+>>> server = CacheServer(Broken())
+>>> server.start()
+>>> oct(stat.S_IMODE(os.stat(os.path.dirname(server.address)).st_mode))
+'0o700'
+>>> client = ShardedCacheClient([server.address], timeout=5)
+>>> client.get('x')
+Traceback (most recent call last):
+...
+RuntimeError: Unpicklable()
+>>> client.store('x', 1); client.exists('x'), client.exists('y')
+(True, False)
+>>> client.items()
+Traceback (most recent call last):
+...
+TypeError: ShardedCacheClient keeps its records on the servers
+>>> client.reset(); len(client)
+0
+>>> client.close(); server.close(); os.path.exists(server.address)
+False
+>>> CacheServer(OxCacheBase(), ('0.0.0.0', 0))
+Traceback (most recent call last):
+...
+ValueError: Refusing TCP address ('0.0.0.0', 0) which is not loopback ...
+>>> ShardedCacheClient([('192.0.2.1', 9999)])
+Traceback (most recent call last):
+...
+ValueError: Refusing TCP address ('192.0.2.1', 9999) which is not loopback ...
+    """
+
+
+def _regr_test_generations():
+    """Test generations with an L0, LRU eviction and repeated bumps.
+
+>>> from ox_cache import (OxCacheBase, GenerationalMixin, ThreadLocalL0Mixin,
+...                       LRUReplacementMixin)
+>>> class Layered(ThreadLocalL0Mixin, GenerationalMixin,
+...               LRUReplacementMixin, OxCacheBase):
+...     'Cache with L0, generations and LRU.'
+...     calls = 0
+...     def make_value(self, key, **opts):
+...         self.calls += 1
+...         return (key, self.calls)
+...
+>>> cache = Layered(max_size=3)
+>>> cache.get('k', namespace='n'), cache.get('k', namespace='n')
+(('k', 1), ('k', 1))
+>>> cache.bump_generation('n')  # L0 entry must not be used either
+>>> cache.get('k', namespace='n')
+('k', 2)
+>>> cache.bump_generation(); cache.bump_generation()
+>>> cache.get('k', namespace='n'), cache.get('k', namespace='n')
+(('k', 3), ('k', 3))
+>>> cache.bump_generation('other')  # other namespaces are not affected
+>>> cache.get('k', namespace='n'), cache.expired('k', namespace='n')
+(('k', 3), False)
+>>> data = [cache.get(i) for i in range(5)]  # stale or not, LRU evicts
+>>> len(cache)
+3
+
+Generations of namespaces are dropped once nothing is stored there:
+
+>>> for name in range(100):
+...     data = cache.get('k', namespace=name)
+...     cache.bump_generation(name)
+...
+>>> sorted(cache._generations) == sorted({
+...     key.namespace for key in cache._data}), len(cache._generations)
+(True, 3)
+>>> cache.store('k', 'v', namespace='n'); cache.store('k', 'w', namespace='n')
+>>> cache._generations['n'].count
+1
+>>> cache.delete('k', namespace='n'); 'n' in cache._generations
+False
+>>> cache.reset(); cache._generations
+{}
+    """
+
+
+def _regr_test_lazy_sequence():
+    """Test lazy sequences with concurrent consumers, spills and errors.
+
+>>> import threading
+>>> from ox_cache import LazySequenceMemoizer
+>>> from ox_cache.sequences import LazySequence
+>>> pulled = []
+>>> def produce(count):
+...     for i in range(count):
+...         pulled.append(i)
+...         yield i
+...
+>>> seq = LazySequence(produce(5000), chunk_size=64, memory_chunks=3)
+>>> results = []
+>>> threads = [threading.Thread(target=lambda: results.append(list(seq)))
+...            for dummy in range(4)]
+>>> for thread in threads:
+...     thread.start()
+...
+>>> for thread in threads:
+...     thread.join()
+...
+>>> all(result == list(range(5000)) for result in results), len(pulled)
+(True, 5000)
+>>> len([chunk for chunk in seq._chunks if isinstance(chunk, list)])
+3
+>>> def broken():
+...     yield 1
+...     raise IOError('stream lost')
+...
+>>> seq = LazySequence(broken(), chunk_size=1)
+>>> for attempt in range(2):
+...     try:
+...         print(list(seq))
+...     except IOError as problem:
+...         print(repr(problem))
+...
+OSError('stream lost')
+OSError('stream lost')
+>>> list(zip(range(1), seq))  # items before the error are still there
+[(0, 1)]
+>>> import traceback
+>>> def depth():
+...     'Return depth of traceback for the stored error.'
+...     try:
+...         list(seq)
+...     except IOError as problem:
+...         return len(traceback.extract_tb(problem.__traceback__))
+...
+>>> depth() == depth() == depth(), seq.error.__traceback__
+(True, None)
+>>> attempts = []
+>>> @LazySequenceMemoizer
+... def flaky(name):
+...     'Stream which fails the first time.'
+...     attempts.append(name)
+...     yield name
+...     if len(attempts) == 1:
+...         raise IOError('stream lost')
+...
+>>> try:
+...     list(flaky('y'))
+... except IOError as problem:
+...     print(problem)
+...
+stream lost
+>>> list(flaky('y')), len(attempts)  # errored sequence is not reused
+(['y'], 2)
+>>> @LazySequenceMemoizer
+... def lines(name):
+...     'Return plain list (not an iterator) so it is cached as is.'
+...     return [name] * 2
+...
+>>> lines('x'), lines('x') is lines('x')
+(['x', 'x'], True)
+    """
+
+
+def _regr_test_memoized_method():
+    """Test method memoization for slots, copies, threads and no docs.
+
+>>> import copy, gc, threading
+>>> from ox_cache import OxMemoizer, TimedMemoizer
+>>> @OxMemoizer
+... def undocumented(x):
+...     return x
+...
+>>> undocumented(1), undocumented.__doc__.startswith('memoized: ')
+(1, True)
+>>> class Slotted:
+...     __slots__ = ('base', '__weakref__')
+...     def __init__(self, base):
+...         self.base = base
+...     @TimedMemoizer.method(expiry_seconds=60)
+...     def add(self, x):
+...         return self.base + x
+...
+>>> one, two = Slotted(1), Slotted(2)
+>>> one.add(1), two.add(1), one.add.expiry_seconds, len(Slotted.add._side)
+(2, 3, 60, 2)
+>>> del one; dummy = gc.collect()
+>>> len(Slotted.add._side)
+1
+>>> class NoWeakref:
+...     __slots__ = ('base',)
+...     @OxMemoizer.method
+...     def get(self):
+...         return 1
+...
+>>> NoWeakref().get()
+Traceback (most recent call last):
+...
+TypeError: Cannot memoize ...get for ... (add __weakref__ to __slots__?)...
+>>> class Counter:
+...     'Class with a memoized method counting its calls.'
+...     def __init__(self):
+...         self.calls = 0
+...     @OxMemoizer.method
+...     def square(self, x):
+...         self.calls += 1
+...         return x * x
+...
+>>> original = Counter()
+>>> original.square(3)
+9
+>>> duplicate = copy.copy(original)  # copy gets its own memoizer
+>>> duplicate.square is original.square, duplicate.square(3)
+(False, 9)
+>>> original.calls, duplicate.calls
+(1, 2)
+>>> fresh, memoizers = Counter(), []
+>>> threads = [threading.Thread(target=lambda: memoizers.append(
+...     fresh.square)) for dummy in range(8)]
+>>> for thread in threads:
+...     thread.start()
+...
+>>> for thread in threads:
+...     thread.join()
+...
+>>> len(set(map(id, memoizers)))
+1
+    """
+
+
 if __name__ == '__main__':
     doctest.testmod()
     print('Finished tests')
@@ -0,0 +1,556 @@
+"""Tools to record cache access traces and replay them offline.
+
+Choosing a replacement policy or a `max_size` is much easier if you can
+replay what your cache actually saw. This module provides:
+
+  - TraceRecorderMixin:  Opt-in mixin which records get/refresh/delete/reset
+                         events for a cache into a compact binary trace.
+  - TraceWriter:         Low-level writer used by the mixin.
+  - read_trace:          Streaming reader for trace files.
+  - simulate:            Replay a trace against a replacement policy mixin
+                         for a given max_size.
+  - sweep:               Run simulate for many policies and sizes.
+
+Each event in a trace is a fixed size record containing a 64-bit key
+hash, an operation code, a timestamp and (for refresh events) the time
+`make_value` took. Keys are stored only as hashes so traces are small
+and do not leak data but note that python randomizes string hashes per
+process so hashes are only comparable within one trace.
+
+The following illustrates recording a trace and replaying it:
+
+>>> import os, tempfile
+>>> from ox_cache import OxCacheBase
+>>> from ox_cache.trace import TraceRecorderMixin, sweep
+>>> class RecordedCache(TraceRecorderMixin, OxCacheBase):
+...     'Cache which records a trace.'
+...     def make_value(self, key, **opts):
+...         return key * 2
+...
+>>> path = os.path.join(tempfile.mkdtemp(), 'example.trace')
+>>> cache = RecordedCache(trace=path)
+>>> data = [cache.get(k % 7) for k in range(100)]
+>>> cache.close_trace()
+>>> results = sweep(path, ['lru', 'random'], [4, 8])
+>>> for result in results:  # doctest: +ELLIPSIS
+...     print('%-6s %i %.2f %i' % (result.policy, result.max_size,
+...                                result.hit_ratio, result.misses))
+lru    4 0.00 100
+lru    8 0.93 7
+random 4 ... ...
+random 8 0.93 7
+
+The `...` above is just random replacement being random.
+
+You can also run a sweep from the command line with something like
+
+    python -m ox_cache.trace example.trace --policy lru --sizes 100 1000
+"""
+
+import argparse
+import array
+import collections
+import doctest
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+
+from ox_cache.core import OxCacheBase
+from ox_cache.mixins import (
+    LRUReplacementMixin, RandomReplacementMixin, SampledLRUMixin,
+    CostAwareReplacementMixin)
+
+
+TRACE_MAGIC = b'OXTRACE1'
+RECORD = struct.Struct('<QBdf')  # key hash, op, timestamp, cost
+OP_GET, OP_REFRESH, OP_DELETE, OP_RESET, OP_REMOVE = range(5)
+HASH_MASK = (1 << 64) - 1
+
+
+class TraceWriter:
+    """Buffered writer for binary cache traces.
+
+    :param path_or_file:  Path to write to or a binary file-like object.
+
+    :param buffer_records=4096:  Records to buffer before writing.
+
+    Records are appended under an internal lock so the writer can be
+    shared by threads (e.g., hits in a cache in read-write mode).
+    """
+
+    def __init__(self, path_or_file, buffer_records=4096):
+        if isinstance(path_or_file, (str, bytes)) or hasattr(
+                path_or_file, '__fspath__'):
+            self._fd = open(path_or_file, 'wb')
+            self._owns_fd = True
+        else:
+            self._fd = path_or_file
+            self._owns_fd = False
+        self._fd.write(TRACE_MAGIC)
+        self._buffer = bytearray()
+        self._limit = buffer_records * RECORD.size
+        self._lock = threading.Lock()
+        self.events = 0
+
+    def record(self, operation, key_hash, cost=0.0, timestamp=None):
+        """Record a single event.
+
+        :param operation:   One of the OP_* constants in this module.
+
+        :param key_hash:    Integer hash of the full key (masked to 64 bits).
+
+        :param cost=0.0:    Seconds spent making the value (for refreshes).
+
+        :param timestamp=None:  Time of event; defaults to time.time().
+        """
+        packed = RECORD.pack(key_hash & HASH_MASK, operation, time.time()
+                             if timestamp is None else timestamp, cost)
+        with self._lock:
+            self._buffer += packed
+            self.events += 1
+            if len(self._buffer) >= self._limit:
+                self._fd.write(self._buffer)
+                self._buffer = bytearray()
+
+    def flush(self):
+        "Write buffered records to the underlying file."
+        with self._lock:
+            self._fd.write(self._buffer)
+            self._buffer = bytearray()
+            self._fd.flush()
+
+    def close(self):
+        "Flush and close the underlying file (if we opened it)."
+        self.flush()
+        if self._owns_fd:
+            self._fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_trace(path, chunk_records=65536):
+    """Stream events from a trace file without loading it all into memory.
+
+    :param path:      Path to trace written by TraceWriter.
+
+    :param chunk_records=65536:  How many records to read at once.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  Generator of (key_hash, operation, timestamp, cost) tuples.
+    """
+    with open(path, 'rb') as my_fd:
+        magic = my_fd.read(len(TRACE_MAGIC))
+        if magic != TRACE_MAGIC:
+            raise ValueError('File %s is not an ox_cache trace' % path)
+        chunk_size = chunk_records * RECORD.size
+        while True:
+            chunk = my_fd.read(chunk_size)
+            if not chunk:
+                break
+            usable = len(chunk) - (len(chunk) % RECORD.size)
+            yield from RECORD.iter_unpack(memoryview(chunk)[:usable])
+
+
+class TraceRecorderMixin:
+    """Mixin to record a trace of cache activity to a file.
+
+Include this mixin and pass `trace=path` (or a TraceWriter) when creating
+the cache to record every `get`, refresh (with how long `make_value`
+took), delete and reset. If `trace` is None nothing is recorded. Call
+`close_trace` when done to flush the file. See the module docs for an
+example and for how to replay a trace with `simulate` or `sweep`.
+
+Removals made by the cache itself (evictions and `clean`) are recorded
+as OP_REMOVE which `simulate` ignores so the size and policy of the
+recorded cache do not leak into simulations. Removals made by
+invalidations the application asked for (`invalidate_tag` and
+`invalidate` from TagIndexMixin, `reset(namespace=...)` from
+NamespaceIndexMixin, `delete_range` and `delete_prefix` from
+SortedKeyIndexMixin) are recorded as OP_DELETE for each key removed so
+`simulate` replays them as deletes (list TraceRecorderMixin before
+those mixins in your bases):
+
+>>> import os, tempfile
+>>> from ox_cache import OxCacheBase, LRUReplacementMixin
+>>> from ox_cache.trace import TraceRecorderMixin, simulate
+>>> class SmallCache(TraceRecorderMixin, LRUReplacementMixin, OxCacheBase):
+...     'Small LRU cache which records a trace.'
+...     def make_value(self, key, **opts):
+...         return key
+...
+>>> path = os.path.join(tempfile.mkdtemp(), 'small.trace')
+>>> cache = SmallCache(max_size=4, trace=path)
+>>> data = [cache.get(k % 7) for k in range(200)]
+>>> cache.delete(3)
+>>> cache.close_trace()
+>>> result = simulate(path, 'lru', 100)
+>>> result.misses, result.hit_ratio
+(7, 0.965)
+>>> from ox_cache import NamespaceIndexMixin
+>>> class NSCache(TraceRecorderMixin, NamespaceIndexMixin, OxCacheBase):
+...     'Cache with a namespace index which records a trace.'
+...     def make_value(self, key, **opts):
+...         return key
+...
+>>> path = os.path.join(tempfile.mkdtemp(), 'ns.trace')
+>>> cache = NSCache(trace=path)
+>>> data = [cache.get(k % 5, namespace='a') for k in range(10)]
+>>> cache.reset(namespace='a')  # replayed as 5 deletes
+>>> data = [cache.get(k % 5, namespace='a') for k in range(10)]
+>>> cache.close_trace()
+>>> simulate(path, 'lru', 100).misses
+10
+    """
+
+    def __init__(self, *args, trace=None, **kwargs):
+        """Initializer for TraceRecorderMixin.
+
+        :param trace=None:  Path or TraceWriter to record events to.
+
+        Otherwise *args, **kwargs are passed along to super().__init__.
+        """
+        if trace is not None and not isinstance(trace, TraceWriter):
+            trace = TraceWriter(trace)
+        self.trace_writer = trace
+        self._trace_state = threading.local()
+        super().__init__(*args, **kwargs)
+
+    def close_trace(self):
+        "Flush and close the trace writer (if any) and stop recording."
+        if self.trace_writer is not None:
+            self.trace_writer.close()
+            self.trace_writer = None
+
+    def _trace_hash(self, key, opts):
+        "Return the hash for key/opts to record in the trace."
+        return hash(self.make_key(key, **opts))
+
+    def get(self, key, allow_refresh=True, lock=None, default=None, **opts):
+        "Record the get and then call super().get."
+        if self.trace_writer is not None:
+            self.trace_writer.record(OP_GET, self._trace_hash(key, opts))
+        return super().get(key, allow_refresh=allow_refresh, lock=lock,
+                           default=default, **opts)
+
+    def _timed_refresh(self, method, key, lock, opts):
+        "Call refresh method and record how long it took."
+        start = time.perf_counter()
+        result = method(key, lock=lock, **opts)
+        if self.trace_writer is not None:
+            self.trace_writer.record(
+                OP_REFRESH, self._trace_hash(key, opts),
+                time.perf_counter() - start)
+        return result
+
+    def refresh(self, key, lock=None, **opts):
+        "Call super().refresh and record how long it took."
+        return self._timed_refresh(super().refresh, key, lock, opts)
+
+    def refresh_outside_lock(self, key, lock=None, **opts):
+        "Call super().refresh_outside_lock and record how long it took."
+        return self._timed_refresh(super().refresh_outside_lock, key, lock,
+                                   opts)
+
+    def delete(self, key, lock=None, **opts):
+        "Record the delete and then call super().delete."
+        if self.trace_writer is not None:
+            self.trace_writer.record(OP_DELETE, self._trace_hash(key, opts))
+        return super().delete(key, lock=lock, **opts)
+
+    def _invalidating(self, method, *args, **kwargs):
+        "Call method recording the removals it makes as OP_DELETE."
+        depth = getattr(self._trace_state, 'invalidating', 0)
+        self._trace_state.invalidating = depth + 1
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self._trace_state.invalidating = depth
+
+    def invalidate_tag(self, tag, lock=None):
+        "Call super().invalidate_tag recording removals as deletes."
+        return self._invalidating(super().invalidate_tag, tag, lock=lock)
+
+    def invalidate(self, key, lock=None, **opts):
+        "Call super().invalidate recording removals as deletes."
+        return self._invalidating(super().invalidate, key, lock=lock,
+                                  **opts)
+
+    def reset(self, lock=None, **kwargs):
+        "Call super().reset recording removals (e.g., namespace) as deletes."
+        return self._invalidating(super().reset, lock=lock, **kwargs)
+
+    def delete_range(self, lo=None, hi=None, lock=None):
+        "Call super().delete_range recording removals as deletes."
+        return self._invalidating(super().delete_range, lo, hi, lock=lock)
+
+    def delete_prefix(self, prefix, lock=None):
+        "Call super().delete_prefix recording removals as deletes."
+        return self._invalidating(super().delete_prefix, prefix, lock=lock)
+
+    def _pre_delete_full_key(self, full_key):
+        """Record removal before passing along to super().
+
+        Removals during one of the invalidation methods above are
+        recorded as OP_DELETE. Others (evictions and removals by clean)
+        depend on the policy and size of the recorded cache so they are
+        recorded as OP_REMOVE which `simulate` ignores.
+        """
+        if self.trace_writer is not None:
+            self.trace_writer.record(
+                OP_DELETE if getattr(self._trace_state, 'invalidating', 0)
+                else OP_REMOVE, hash(full_key))
+        super()._pre_delete_full_key(full_key)
+
+    def _post_reset(self):
+        "Record the reset before passing along to super()."
+        if self.trace_writer is not None:
+            self.trace_writer.record(OP_RESET, 0)
+        super()._post_reset()
+
+
+POLICIES = collections.OrderedDict([
+    ('lru', lambda: LRUReplacementMixin),
+    ('sampled_lru', lambda: SampledLRUMixin),
+    ('random', lambda: RandomReplacementMixin),
+    ('gdsf', lambda: CostAwareReplacementMixin),
+])
+
+
+SimulationResult = collections.namedtuple('SimulationResult', [
+    'policy', 'max_size', 'gets', 'misses', 'hit_ratio', 'recompute_cost',
+    'peak_entries', 'peak_bytes'])
+SimulationResult.__doc__ = '''Result of replaying a trace with simulate.
+
+  - policy:          Name of replacement policy.
+  - max_size:        Cache size simulated.
+  - gets:            Number of get events replayed.
+  - misses:          Number of gets which required a refresh.
+  - hit_ratio:       Fraction of gets which were hits.
+  - recompute_cost:  Total seconds of make_value time for the misses
+                     (based on refresh costs recorded in the trace).
+  - peak_entries:    Largest number of entries held by the cache.
+  - peak_bytes:      Peak memory allocated during replay if memory was
+                     measured (else None).
+'''
+
+
+class _RecordedCostMixin:
+    """Mixin for simulate so cost-aware policies use costs from the trace.
+
+    Without this, CostAwareReplacementMixin would use the (tiny) time the
+    simulated refresh took.
+    """
+
+    def measured_cost(self, full_key, elapsed):
+        "Return cost recorded in the trace for full_key (if known yet)."
+        cost = self.costs[full_key.base_key]
+        return cost if cost >= 0 else (elapsed or 0.0)
+
+
+class _SimulatedCache(OxCacheBase):
+    """Cache used by simulate: keys are dense ints and values are None.
+
+    Misses are counted and charged the recorded cost for the key.
+    """
+
+    def __init__(self, *args, costs=None, **kwargs):
+        self.costs = costs
+        self.misses = 0
+        self.recompute_cost = 0.0
+        self.pending = {}  # key: misses whose cost is not yet in the trace
+        super().__init__(*args, **kwargs)
+
+    def make_value(self, key, **opts):
+        self.misses += 1
+        cost = self.costs[key]
+        if cost >= 0:
+            self.recompute_cost += cost
+        else:
+            self.pending[key] = self.pending.get(key, 0) + 1
+
+
+def _replay_lru(path, max_size):
+    """Replay trace for the 'lru' policy without going through OxCacheBase.
+
+    This does the same thing as replaying against LRUReplacementMixin
+    but keeps the cache as a bare OrderedDict of key hashes so each
+    event costs a few dict operations instead of a full `get`.
+
+    :return:  Tuple of (gets, misses, recompute_cost, peak_entries).
+    """
+    tracker = collections.OrderedDict()
+    move_to_end, evict = tracker.move_to_end, tracker.popitem
+    costs, pending = {}, {}
+    gets = misses = peak_entries = 0
+    recompute_cost = 0.0
+    for key_hash, operation, dummy, cost in read_trace(path):
+        if operation == OP_GET:
+            gets += 1
+            if key_hash in tracker:
+                move_to_end(key_hash)
+                continue
+            misses += 1
+            known = costs.get(key_hash)
+            if known is None:
+                pending[key_hash] = pending.get(key_hash, 0) + 1
+            else:
+                recompute_cost += known
+            while len(tracker) >= max_size:
+                evict(last=False)
+            tracker[key_hash] = None
+            if len(tracker) > peak_entries:
+                peak_entries = len(tracker)
+        elif operation == OP_REFRESH:
+            costs[key_hash] = cost
+            if key_hash in pending:
+                recompute_cost += pending.pop(key_hash) * cost
+        elif operation == OP_DELETE:
+            tracker.pop(key_hash, None)
+        elif operation == OP_RESET:
+            tracker.clear()
+    return gets, misses, recompute_cost, peak_entries
+
+
+LEAN_REPLAYS = {'lru': _replay_lru}
+
+
+def simulate(path, policy, max_size, measure_memory=False):
+    """Replay a trace against a replacement policy.
+
+    :param path:       Path to trace file written by TraceWriter.
+
+    :param policy:     Name in POLICIES or a mixin class taking `max_size`
+                       in __init__ (e.g., LRUReplacementMixin).
+
+    :param max_size:   Cache size to simulate.
+
+    :param measure_memory=False:  If True, use tracemalloc to measure peak
+                                  memory (slows down the replay).
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  Instance of SimulationResult.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    PURPOSE:  Replay get, refresh, delete and reset events from a trace.
+              Key hashes are mapped to dense integer ids and recorded
+              costs are kept in an array indexed by id so memory stays
+              small even for traces with tens of millions of events.
+              A miss is charged the cost recorded for the key in the
+              trace (if the key was first refreshed later in the trace,
+              we charge it when we see that refresh).
+
+              Policies named in LEAN_REPLAYS (e.g., 'lru') are replayed
+              by a dedicated loop over bare dicts which is much faster
+              than a full cache `get` per event. Pass the mixin class
+              instead of its name to replay through the cache instead.
+    """
+    if isinstance(policy, str) and policy in LEAN_REPLAYS:
+        if measure_memory:
+            tracemalloc.start()
+        gets, misses, cost, peak_entries = LEAN_REPLAYS[policy](
+            path, max_size)
+        peak_bytes = None
+        if measure_memory:
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return SimulationResult(
+            policy, max_size, gets, misses,
+            1.0 - misses / float(gets) if gets else 0.0, cost,
+            peak_entries, peak_bytes)
+    if isinstance(policy, str):
+        name, mixin = policy, POLICIES[policy]()
+    else:
+        name, mixin = policy.__name__, policy
+    sim_class = type('Simulated' + mixin.__name__, (
+        _RecordedCostMixin, mixin, _SimulatedCache), {})
+    costs = array.array('d')
+    ids = {}
+    cache = sim_class(max_size=max_size, costs=costs)
+    cache_get, pending = cache.get, cache.pending
+    gets = peak_entries = 0
+    if measure_memory:
+        tracemalloc.start()
+    for key_hash, operation, dummy, cost in read_trace(path):
+        if operation == OP_REMOVE:  # simulated policy does its own removal
+            continue
+        ident = ids.get(key_hash)
+        if ident is None:
+            ident = ids[key_hash] = len(costs)
+            costs.append(-1.0)
+        if operation == OP_GET:
+            gets += 1
+            cache_get(ident)
+            if len(cache) > peak_entries:
+                peak_entries = len(cache)
+        elif operation == OP_REFRESH:
+            costs[ident] = cost
+            if ident in pending:
+                cache.recompute_cost += pending.pop(ident) * cost
+        elif operation == OP_DELETE:
+            if cache.exists(ident):
+                cache.delete(ident)
+        elif operation == OP_RESET:
+            cache.reset()
+    peak_bytes = None
+    if measure_memory:
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return SimulationResult(
+        name, max_size, gets, cache.misses,
+        1.0 - cache.misses / float(gets) if gets else 0.0,
+        cache.recompute_cost, peak_entries, peak_bytes)
+
+
+def sweep(path, policies, sizes, measure_memory=False):
+    """Run simulate for every combination of policies and sizes.
+
+    :param path:       Path to trace file written by TraceWriter.
+
+    :param policies:   Sequence of policies (see simulate).
+
+    :param sizes:      Sequence of max_size values to try.
+
+    :param measure_memory=False:  Passed to simulate.
+
+    ~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-~-
+
+    :return:  List of SimulationResult instances.
+    """
+    return [simulate(path, policy, size, measure_memory)
+            for policy in policies for size in sizes]
+
+
+def main(argv=None):
+    "Command line interface to run a sweep over a trace file."
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('trace', help='Path to trace file.')
+    parser.add_argument('--policy', action='append', help=(
+        'Policy to simulate (can repeat; choices: %s).' % ', '.join(
+            POLICIES)))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000],
+                        help='Cache sizes to simulate.')
+    parser.add_argument('--memory', action='store_true',
+                        help='Measure peak memory (slower).')
+    args = parser.parse_args(argv)
+    print('%-12s %10s %10s %10s %10s %14s %12s %12s' % (
+        SimulationResult._fields))
+    for result in sweep(args.trace, args.policy or list(POLICIES),
+                        args.sizes, args.memory):
+        print('%-12s %10i %10i %10i %10.4f %14.6g %12i %12s' % result)
+    return 0
+
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        sys.exit(main())
+    doctest.testmod()
+    print('Finished tests')